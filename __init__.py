@@ -17,23 +17,30 @@ __py_deps__	= ['pathspec']
 TRIGGERS = globals().get('__triggers__') or []
 import os
 import sys
+import subprocess
 MAIN_DIR = os.path.realpath(os.path.dirname(__file__))
 sys.path.append(MAIN_DIR)
 from files.launcher import Launcher
 Launcher.set('albert')
 from files.service import FilesService
 from files.icon import IconRegistry
-from albert import ProcAction, Item
+from files.result import StatResult
+from albert import FuncAction, ClipAction, Item
 
 home = os.path.expanduser('~')
 replace_home = lambda path: path.replace(home, '~', 1)
 
+def open_path(path):
+    # Record the open so the path ranks higher next time
+    FilesService().record_open(path)
+    subprocess.Popen(['xdg-open', path])
+
 def initialize():
     FilesService().load_settings_albert(os.path.join(MAIN_DIR, 'settings.ini'))
     FilesService().run()
 
 def finalize():
-    FilesService.stop()
+    FilesService().stop()
 
 def handleQuery(query):
     if TRIGGERS and not query.isTriggered:
@@ -42,7 +49,10 @@ def handleQuery(query):
     if not query_str:
         return
     query.disableSort()
-    results = FilesService().search(query_str)
+    results = FilesService().search_latest(query_str)
+    # A newer query replaced this one
+    if results is None:
+        return None
     items = []
 
     for result in results:
@@ -51,13 +61,17 @@ def handleQuery(query):
         
         icon = IconRegistry().get_icon(result)
         text = name
-        subtext = replace_home(path)
-        actions = [
-            ProcAction(
-                text='Open {}'.format(path),
-                commandline=['xdg-open', path],
-            ),
-        ]
+        if isinstance(result, StatResult):
+            subtext = result.description
+            actions = [ClipAction(text='Copy', clipboardText='{}: {}'.format(name, subtext))]
+        else:
+            subtext = replace_home(path)
+            actions = [
+                FuncAction(
+                    text='Open {}'.format(path),
+                    callable=lambda path=path: open_path(path),
+                ),
+            ]
         items.append(Item(
             id=__title__,
             icon=icon,
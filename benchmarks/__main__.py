@@ -0,0 +1,165 @@
+import os
+import sys
+import json
+import platform
+import argparse
+import subprocess
+import tempfile
+import multiprocessing
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from .tree import TreeGenerator
+from .measure import ROOT_DIR, IGNORE_FILENAME, measure, measure_startup
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    output = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'numpy': numpy is not None,
+        'cpus': os.cpu_count(),
+        'seed': args.seed,
+        'processes': args.processes,
+        'fuzzy': args.fuzzy,
+        'runs': [],
+    }
+    for files in args.files:
+        path = os.path.join(args.directory, '{}-{}'.format(files, args.seed))
+        now = perf_counter()
+        TreeGenerator(path, files, args.seed, IGNORE_FILENAME).generate()
+        print('Tree of {} files ready in {:.1f}s: {}'.format(files, perf_counter() - now, path), file=sys.stderr)
+
+        # A fresh interpreter for every size, forked ones would share the parent's memory
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            result = executor.submit(measure, path, args.sequences, args.seed, args.processes, args.fuzzy).result()
+        result['files'] = files
+        output['runs'].append(result)
+        print('{files} files, {entries} entries: scan {scan_seconds:.2f}s, rescan {rescan_seconds:.2f}s, '
+              'peak RSS {peak_rss_kb}KB, search p50 {p50:.2f}ms p99 {p99:.2f}ms'.format(
+                  p50=result['search']['p50_ms'], p99=result['search']['p99_ms'], **result), file=sys.stderr)
+        print('\tstore {store_bytes}B, names {names_chars} chars in {names_bytes}B, '
+              'lowercase relative paths {lowers_chars} chars in {lowers_bytes}B'.format(
+                  store_bytes=result['store_bytes'], **result['arenas']), file=sys.stderr)
+
+    text = json.dumps(output, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+def startup(args):
+    # Import and startup times of the service in fresh interpreters, the
+    # first run scans the tree and the next ones load the saved index
+    path = os.path.join(args.directory, '{}-{}'.format(args.files, args.seed))
+    TreeGenerator(path, args.files, args.seed, IGNORE_FILENAME).generate()
+    runs = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for i in range(args.runs):
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(measure_startup, path, cache_dir).result()
+            runs.append(result)
+            print('{} import {import_ms:.1f}ms, startup {startup_ms:.1f}ms, ready {ready_ms:.1f}ms'.format(
+                'scan' if i == 0 else 'load', **result), file=sys.stderr)
+
+    # The cold run pays for the disk cache too, the budget is for the others
+    startup_ms = max(result['startup_ms'] for result in runs[1:] or runs)
+    print('Imported {}'.format(', '.join(runs[0]['imported'])), file=sys.stderr)
+    if startup_ms > args.budget:
+        print('Startup took {:.1f}ms, over the budget of {}ms'.format(startup_ms, args.budget), file=sys.stderr)
+        return 1
+    print('Startup took {:.1f}ms, within the budget of {}ms'.format(startup_ms, args.budget), file=sys.stderr)
+    return 0
+
+
+def get_metrics(run):
+    metrics = {
+        'scan_seconds': run['scan_seconds'],
+        'rescan_seconds': run['rescan_seconds'],
+        'peak_rss_kb': run['peak_rss_kb'],
+    }
+    # Not measured by older runs
+    if 'store_bytes' in run:
+        metrics['store_bytes'] = run['store_bytes']
+    for key in ('mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms'):
+        metrics['search_' + key] = run['search'][key]
+    return metrics
+
+
+def compare(args):
+    # Ratios of the new results to the old ones for the sizes in both
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    old_runs = {run['files']: run for run in old['runs']}
+    print('{} -> {}'.format(old.get('commit'), new.get('commit')))
+    regressed = False
+    for run in new['runs']:
+        if run['files'] not in old_runs:
+            continue
+        print('{} files:'.format(run['files']))
+        old_metrics = get_metrics(old_runs[run['files']])
+        for key, value in get_metrics(run).items():
+            if key not in old_metrics:
+                continue
+            old_value = old_metrics[key]
+            ratio = value / old_value if old_value else float('inf')
+            flag = ''
+            if ratio > 1 + args.tolerance:
+                flag = ' <- slower' if key not in ('peak_rss_kb', 'store_bytes') else ' <- larger'
+                regressed = True
+            print('\t{:<20} {:>12.3f} {:>12.3f} {:>7.2f}x{}'.format(key, old_value, value, ratio, flag))
+    return 1 if regressed and args.strict else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Scan and search benchmarks on synthetic trees')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='generate the trees and measure scans and searches')
+    run_parser.add_argument('--files', type=int, nargs='+', default=[10000, 100000], help='files of each tree')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--sequences', type=int, default=40, help='names typed letter by letter')
+    run_parser.add_argument('--processes', type=int, default=0, help='SEARCH_PROCESSES')
+    run_parser.add_argument('--fuzzy', action='store_true', help='FUZZY_SEARCH')
+    run_parser.add_argument('--directory', default=os.path.join(tempfile.gettempdir(), 'ulauncher-albert-files-benchmarks'),
+                            help='where the trees are kept between runs')
+    run_parser.add_argument('--output', help='JSON file, printed if not set')
+    run_parser.set_defaults(func=run)
+
+    startup_parser = commands.add_parser('startup', help='measure the import and startup times against a budget')
+    startup_parser.add_argument('--files', type=int, default=10000, help='files of the tree')
+    startup_parser.add_argument('--seed', type=int, default=0)
+    startup_parser.add_argument('--runs', type=int, default=5)
+    startup_parser.add_argument('--budget', type=float, default=250, help='milliseconds, exit with 1 above it')
+    startup_parser.add_argument('--directory', default=os.path.join(tempfile.gettempdir(), 'ulauncher-albert-files-benchmarks'),
+                                help='where the trees are kept between runs')
+    startup_parser.set_defaults(func=startup)
+
+    compare_parser = commands.add_parser('compare', help='compare two JSON results')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1, help='ratio above 1 reported as a regression')
+    compare_parser.add_argument('--strict', action='store_true', help='exit with 1 on regressions')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import os
+import sys
+import resource
+from time import perf_counter, sleep
+from random import Random
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+IGNORE_FILENAME = '.albertignore2'
+# Keystrokes of the typed names, longer ones are cut
+MAX_TYPED = 12
+
+
+def get_peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes everywhere else
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def get_percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def get_keystrokes(names, sequences, seed):
+    # Queries as they are typed, one per keystroke: names letter by letter,
+    # some with a typo and a backspace, and a few wildcard queries
+    random = Random(seed)
+    queries = []
+    for i in range(sequences):
+        name = random.choice(names).lower()
+        name = name.split('.', 1)[0] or name
+        typed = name[:MAX_TYPED]
+        typo = random.randrange(len(typed)) if i % 4 == 3 else -1
+        for j in range(1, len(typed) + 1):
+            queries.append(typed[:j])
+            if j - 1 == typo:
+                queries.append(typed[:j] + 'q')
+                queries.append(typed[:j])
+    for extension in ('.py', '.pdf', '.tar.gz'):
+        queries.extend('*' + extension[:j] for j in range(1, len(extension) + 1))
+    for name in random.sample(names, min(len(names), sequences // 4 + 1)):
+        queries.append('{}*{}'.format(name[:3].lower(), name[-3:].lower()))
+    return queries
+
+
+def measure(path, sequences, seed, processes, fuzzy):
+    # Runs in its own process so the peak memory is the scan's
+    sys.path.insert(0, ROOT_DIR)
+    from files.cache import Cache
+    cache = Cache()
+    cache.set_ignore_filename(IGNORE_FILENAME)
+    cache.set_search_after_characters(2)
+    cache.set_search_max_results(10)
+    cache.set_search_threshold(0.5)
+    cache.set_search_processes(processes)
+    cache.set_search_fuzzy(fuzzy)
+    cache.set_paths([path], [0])
+    rss_before = get_peak_rss_kb()
+
+    now = perf_counter()
+    cache.scan()
+    scan_seconds = perf_counter() - now
+    peak_rss_kb = get_peak_rss_kb()
+    scan_stats = cache.get_stats()['scan']
+
+    now = perf_counter()
+    cache.scan()
+    rescan_seconds = perf_counter() - now
+
+    store = cache._snapshot.store
+    names = sorted({store.name(entry_id) for entry_id in range(len(store))})
+    queries = get_keystrokes(names, sequences, seed)
+    latencies = []
+    results = 0
+    for query in queries:
+        now = perf_counter()
+        results += len(cache.search(query))
+        latencies.append(1000 * (perf_counter() - now))
+    cache.stop()
+
+    return {
+        'entries': len(store),
+        'scan_seconds': scan_seconds,
+        'rescan_seconds': rescan_seconds,
+        'peak_rss_kb': peak_rss_kb,
+        'scan_rss_kb': peak_rss_kb - rss_before,
+        'scan_stats': scan_stats,
+        'store_bytes': store.get_memory_size(),
+        'arenas': store.get_arena_stats(),
+        'search': {
+            'queries': len(queries),
+            'results': results,
+            'mean_ms': sum(latencies) / len(latencies),
+            'p50_ms': get_percentile(latencies, 50),
+            'p90_ms': get_percentile(latencies, 90),
+            'p99_ms': get_percentile(latencies, 99),
+            'max_ms': max(latencies),
+        },
+        'search_stats': cache.get_search_stats(),
+    }
+
+
+def measure_startup(path, cache_dir):
+    # Runs in a fresh interpreter so the imports are part of the startup,
+    # the index is saved in cache_dir and loaded by the next runs
+    os.environ['XDG_CACHE_HOME'] = cache_dir
+    sys.path.insert(0, ROOT_DIR)
+    modules = set(sys.modules)
+    now = perf_counter()
+    from files.service import FilesService
+    from files.cache import Cache
+    import_ms = 1000 * (perf_counter() - now)
+    imported = sorted({name.split('.', 1)[0] for name in set(sys.modules) - modules})
+
+    now = perf_counter()
+    service = FilesService()
+    service.load_settings_ulauncher('15', path, '2', '10', '0.5', IGNORE_FILENAME, 'square-o', 'false', 'false', '0', 'false', '0')
+    service.run()
+    run_ms = 1000 * (perf_counter() - now)
+    # Searches find the files once the index is loaded or scanned
+    while not Cache().get_stats()['index']['entries']:
+        sleep(0.001)
+    ready_ms = 1000 * (perf_counter() - now)
+    service.stop()
+
+    return {
+        'import_ms': import_ms,
+        'run_ms': run_ms,
+        'startup_ms': import_ms + run_ms,
+        'ready_ms': ready_ms,
+        'imported': imported,
+    }
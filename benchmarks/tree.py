@@ -0,0 +1,107 @@
+import os
+import shutil
+from random import Random
+
+WORDS = [
+    'report', 'data', 'notes', 'image', 'project', 'draft', 'music', 'photo', 'invoice', 'backup',
+    'config', 'utils', 'server', 'client', 'model', 'view', 'test', 'main', 'index', 'résumé',
+]
+EXTENSIONS = ['.py', '.js', '.md', '.txt', '.pdf', '.png', '.jpg', '.json', '.tar.gz', '.log', '']
+PACKAGE_FILES = ['index.js', 'package.json', 'README.md', 'LICENSE', 'lib/index.js', 'lib/utils.js', 'dist/index.min.js']
+
+# Ignore files of the projects, the docs directory takes back the logs
+PROJECT_IGNORE = 'node_modules/\nbuild/\n*.log\n.*\n'
+DOCS_IGNORE = '!*.log\n'
+
+MARKER = '.benchmark-tree'
+
+
+class TreeGenerator:
+    # Writes a deterministic tree of about files files under path: projects
+    # with node_modules fan out and nested ignore files, deep source
+    # directories and large flat directories like Downloads. The same files
+    # and seed always give the same tree, an existing one is reused.
+    def __init__(self, path, files, seed=0, ignore_filename='.albertignore2'):
+        self.path = path
+        self.files = files
+        self.seed = seed
+        self.ignore_filename = ignore_filename
+        self._random = Random(seed)
+        self._created = 0
+
+    def generate(self):
+        marker = os.path.join(self.path, MARKER)
+        key = '{} {} {}'.format(self.files, self.seed, self.ignore_filename)
+        if os.path.isfile(marker):
+            with open(marker) as f:
+                if f.read() == key:
+                    return self.path
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+
+        random = self._random
+        projects = 0
+        folders = 0
+        while self._created < self.files:
+            if random.random() < 0.7:
+                self._add_project(os.path.join(self.path, 'projects', '{}_{}'.format(self._word(), projects)))
+                projects += 1
+            else:
+                self._add_flat(os.path.join(self.path, random.choice(['Downloads', 'Documents', 'Pictures']), 'folder{}'.format(folders)))
+                folders += 1
+
+        with open(marker, 'w') as f:
+            f.write(key)
+        return self.path
+
+    def _word(self):
+        return self._random.choice(WORDS)
+
+    def _name(self, i):
+        return '{}_{}{}{}'.format(self._word(), self._word(), i, self._random.choice(EXTENSIONS))
+
+    def _write(self, path):
+        with open(path, 'w'):
+            pass
+        self._created += 1
+
+    def _add_project(self, path):
+        random = self._random
+        os.makedirs(path)
+        with open(os.path.join(path, self.ignore_filename), 'w') as f:
+            f.write(PROJECT_IGNORE)
+        self._write(os.path.join(path, 'README.md'))
+        self._write(os.path.join(path, '.env'))
+
+        # Deep source directories
+        for i in range(random.randint(1, 4)):
+            directory = os.path.join(path, 'src', *(self._word() + str(j) for j in range(random.randint(1, 10))))
+            os.makedirs(directory, exist_ok=True)
+            for j in range(random.randint(5, 30)):
+                self._write(os.path.join(directory, self._name(j)))
+
+        docs = os.path.join(path, 'docs')
+        os.makedirs(docs)
+        with open(os.path.join(docs, self.ignore_filename), 'w') as f:
+            f.write(DOCS_IGNORE)
+        for i in range(random.randint(2, 10)):
+            self._write(os.path.join(docs, self._name(i)))
+
+        build = os.path.join(path, 'build')
+        os.makedirs(build)
+        for i in range(random.randint(5, 20)):
+            self._write(os.path.join(build, self._name(i)))
+
+        # Wide and ignored
+        for i in range(random.randint(5, 40)):
+            package = os.path.join(path, 'node_modules', '{}-{}'.format(self._word(), i))
+            for package_file in PACKAGE_FILES:
+                package_file = os.path.join(package, package_file)
+                os.makedirs(os.path.dirname(package_file), exist_ok=True)
+                self._write(package_file)
+
+    def _add_flat(self, path):
+        os.makedirs(path)
+        for i in range(self._random.randint(100, 1000)):
+            self._write(os.path.join(path, self._name(i)))
@@ -1,14 +1,20 @@
 import os
+from itertools import count
 from queue import Queue
 from re import search
-from time import time
-import math
-import itertools
-from threading import RLock
-from .search_results import SearchResults
-from .entry import CacheEntry
+from time import time, perf_counter
+from threading import RLock, Thread
+from . import scoring
+from .scoring import SearchCancelled
+from .scanner import Scanner
+from .shards import ShardPool
+from .snapshot import CacheSnapshot
+from .stats import LatencyHistogram
+from .storage import IndexStorage
+from .store import EntryStore
+from .usage import UsageStore
 from .. import logging
-from ..match import Ignore, Match
+from ..match import Ignore, Match, FuzzyMatch
 from ..utils import Singleton, lock
 
 
@@ -21,20 +27,47 @@ class Cache(metaclass=Singleton):
         'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'odt', 'tex', 'csv',
         'html', 'html'
     ])
+    # Boost of the most used entries, entries opened USAGE_HALF times
+    # recently get half of it
+    USAGE_WEIGHT = 0.25
+    USAGE_HALF = 2.0
 
     def __init__(self):
         self._search_after_characters = 2
         self._search_max_results = 5
         self._search_threshold = 0.5
+        self._search_processes = 0
+        self._search_fuzzy = False
+        self._search_budget = 0.0
+        self._shard_pool = None
+        self._sharing = False
         self._root_paths = ()
         self._depths = ()
-        self._entries = {}
+        self._snapshot = CacheSnapshot()
+        self._index_storage = None
+        self._usage = None
+        self._changes = None
+        self._merging = False
+        self._listings = {}
         self._common_prefix = ''
         self._shortest_path = 0
         self._longest_path = 1
+        self._scan_stats = None
+        # Every search takes the next generation before waiting for the lock,
+        # older searches still waiting or running give up
+        self._generations = count(1)
+        self._search_generation = 0
+        self._search_cancelled = 0
+        # Latencies of all the searches and by how they were answered
+        self._search_latencies = {
+            'all': LatencyHistogram(),
+            'cached': LatencyHistogram(),
+            'prefix': LatencyHistogram(),
+            'index': LatencyHistogram(),
+        }
         self._lock = RLock()
+        self._scan_lock = RLock()
         self._logger = logging.getLogger(__name__)
-        self._search_results = SearchResults()
 
     @lock
     def set_search_after_characters(self, search_after_characters):
@@ -43,10 +76,80 @@ class Cache(metaclass=Singleton):
     @lock
     def set_search_max_results(self, search_max_results):
         self._search_max_results = search_max_results
+        self._snapshot.search_results.clear()
 
     @lock
     def set_search_threshold(self, search_threshold):
         self._search_threshold = search_threshold
+        self._snapshot.search_results.clear()
+
+    @lock
+    def set_search_budget(self, search_budget_milliseconds):
+        # Searches taking longer report their results so far this often, 0 to disable
+        self._search_budget = max(search_budget_milliseconds, 0) / 1000
+
+    @lock
+    def set_search_fuzzy(self, search_fuzzy):
+        self._search_fuzzy = search_fuzzy
+        self._snapshot.search_results.clear()
+
+    @lock
+    def set_search_processes(self, search_processes):
+        # Large searches are split across this many processes, 0 or 1 to disable
+        self._search_processes = search_processes
+        self._stop_shard_pool()
+
+    @lock
+    def stop(self):
+        self._stop_shard_pool()
+
+    def _stop_shard_pool(self):
+        if self._shard_pool is not None:
+            self._shard_pool.shutdown()
+            self._shard_pool = None
+
+    def _get_shard_pool(self, snapshot):
+        # Returns the pool once it has the store of the snapshot. It is
+        # started and given the store in a thread, without the lock, and
+        # searches are done in process meanwhile.
+        if self._search_processes <= 1:
+            return None
+        shard_pool = self._shard_pool
+        if shard_pool is not None and shard_pool.store is snapshot.store:
+            return shard_pool
+        if not self._sharing:
+            self._sharing = True
+            Thread(target=self._share_store, daemon=True).start()
+        return None
+
+    def _share_store(self):
+        try:
+            with self._lock:
+                store = self._snapshot.store
+                shard_pool = self._shard_pool
+                processes = self._search_processes
+            if shard_pool is None:
+                shard_pool = ShardPool(processes)
+                with self._lock:
+                    # The settings changed meanwhile
+                    if self._search_processes != processes or self._shard_pool is not None:
+                        shard_pool.shutdown()
+                        return
+                    self._shard_pool = shard_pool
+            handle = ShardPool.share(store)
+            with self._lock:
+                if self._shard_pool is not shard_pool:
+                    ShardPool.unshare(handle)
+                    return
+                shard_pool.set_store(store, handle)
+        except (ValueError, OSError) as e:
+            self._logger.warning('Could not start search processes, searching in process: {}'.format(e))
+            with self._lock:
+                self._search_processes = 0
+                self._stop_shard_pool()
+        finally:
+            with self._lock:
+                self._sharing = False
 
     @lock
     def set_ignore_filename(self, ignore_filename):
@@ -63,137 +166,444 @@ class Cache(metaclass=Singleton):
         self._depths = depths
 
     @lock
-    def __contains__(self, path):
-        paths = set(itertools.chain.from_iterable(self._data.values()))
-        return CacheEntry(path, None) in paths
+    def get_paths(self):
+        return dict(zip(self._root_paths, self._depths))
 
-    @property
     @lock
-    def paths(self):
-        return list(itertools.chain(*self._dirs_d.values(), *self._files_d.values()))
+    def set_index_path(self, index_path):
+        self._index_storage = IndexStorage(index_path) if index_path else None
 
-    @property
     @lock
-    def search_names(self):
-        return list(itertools.chain(self._dirs_d.keys(), self._files_d.keys(), self._files_no_ext_d.keys()))
+    def set_usage_path(self, usage_path):
+        self._usage = UsageStore(usage_path) if usage_path else None
+        self._snapshot.search_results.clear()
+
+    def record_open(self, path):
+        # Opened entries rank higher in the next searches. The usage is saved
+        # without the lock, the results ranked before are not returned again
+        # as they were ranked with an older version of it.
+        with self._lock:
+            usage = self._usage
+        if usage is not None:
+            usage.add(path)
 
-    @staticmethod
-    def _walklevel(directory, level=None):
-        num_sep = directory.count(os.sep)
-        for root, dirs, files in os.walk(directory):
-            num_sep_this = root.count(os.sep)
-            if level is not None and level > 0 and num_sep + level <= num_sep_this:
-                del dirs[:]
-                del files[:]
-            yield root, dirs, files
+    @lock
+    def __contains__(self, path):
+        return path in self._snapshot
+
+    def _get_key(self):
+        return IndexStorage.get_key(self._root_paths, self._depths, Ignore.IGNORE_FILENAME)
+
+    def load(self):
+        # Load the index saved by the last scan if it was made with the same
+        # settings. Directory listings are not saved, the first scan after a
+        # load reads every directory.
+        with self._scan_lock:
+            with self._lock:
+                key = self._get_key()
+                if self._snapshot.key == key:
+                    return True
+                index_storage = self._index_storage
+            if index_storage is None:
+                return False
+
+            now = time()
+            store = index_storage.load(key)
+            if store is None:
+                return False
+            snapshot = CacheSnapshot(store, key)
+            snapshot.build_features(self._search_fuzzy)
+            with self._lock:
+                self._set_snapshot(snapshot)
+            self._logger.info('Loaded {} entries from {} in {:.2f}ms'.format(len(snapshot), index_storage.path, 1000 * (time() - now)))
+            return True
+
+    def _set_snapshot(self, snapshot):
+        # The search results cache and its counters carry over
+        search_results = self._snapshot.search_results
+        search_results.clear()
+        snapshot.search_results = search_results
+        self._snapshot = snapshot
 
-    @staticmethod
-    def _get_search_names(path, base_name=True):
-        name = path
-        if base_name:
-            name = os.path.basename(path)
-        name_no_ext, ext = os.path.splitext(name)
-        search_name_no_ext = Cache.SEARCH_TERM_REGEX.sub('', name_no_ext).lower()
-        search_name = search_name_no_ext + ext
-        return search_name, search_name_no_ext, ext
+    @lock
+    def get_search_stats(self):
+        return self._snapshot.search_results.get_stats()
 
     @lock
-    def scan(self):
+    def get_stats(self):
+        snapshot = self._snapshot
+        search_results = snapshot.search_results.get_stats()
+        lookups = search_results['hits'] + search_results['prefix_hits'] + search_results['misses']
+        search_results['hit_ratio'] = search_results['hits'] / lookups if lookups else 0.0
+        search_results['prefix_hit_ratio'] = search_results['prefix_hits'] / lookups if lookups else 0.0
+        return {
+            'scan': self._scan_stats,
+            'index': {
+                'entries': len(snapshot),
+                'added': len(snapshot.added) - len(snapshot.added_removed),
+                'removed': len(snapshot.removed),
+                'directories': len(snapshot.directories),
+                'store_bytes': snapshot.store.get_memory_size() + snapshot.added.get_memory_size(),
+                'index_bytes': snapshot.index.get_memory_size(),
+                'used': len(self._usage) if self._usage is not None else 0,
+            },
+            'search': {
+                'results_cache': search_results,
+                'cancelled': self._search_cancelled,
+                'latencies': {kind: histogram.get_stats() for kind, histogram in self._search_latencies.items()},
+            },
+        }
+
+    def scan(self, root_paths=None, is_cancelled=None):
+        # Only one scan at a time, searches keep using the current snapshot.
+        # Scans the roots in root_paths, all of them by default, the entries
+        # of the other roots are carried over from the current snapshot with
+        # their changes. Roots given up with is_cancelled(root_path) are
+        # carried over too. Returns False when the settings changed meanwhile.
+        with self._scan_lock:
+            with self._lock:
+                all_root_paths = self._root_paths
+                depths = self._depths
+                key = self._get_key()
+                index_storage = self._index_storage
+                previous = self._snapshot
+                self._changes = []
+            scanned = set(all_root_paths if root_paths is None else root_paths)
+            try:
+                snapshot, scan_stats, carried = self._scan(all_root_paths, depths, key, scanned, previous, is_cancelled)
+                with self._lock:
+                    if self._get_key() != key:
+                        self._logger.info('Settings changed while scanning, dropping the scan')
+                        return False
+                    # Replay changes of the carried roots and changes reported
+                    # while scanning, they may have been missed
+                    for added, path in previous.get_changes(carried) + self._changes:
+                        if added:
+                            self._add_path(snapshot, path)
+                        else:
+                            self._remove_path(snapshot, path)
+                    self._set_snapshot(snapshot)
+                    self._scan_stats = scan_stats
+            finally:
+                with self._lock:
+                    self._changes = None
+            # Saved after full scans only, the ones of some roots would
+            # write the whole index for them
+            if index_storage is not None and not carried:
+                index_storage.save(key, snapshot.store)
+            return True
+
+    @staticmethod
+    def _get_nested(root_path, root_paths):
+        prefix = root_path + os.sep
+        return {other for other in root_paths if other.startswith(prefix)}
+
+    def _get_carried(self, root_paths, depths, scanned, previous):
+        # Roots whose entries can be copied from the previous snapshot: not
+        # scanned, scanned with the same settings and with no roots inside
+        # them. Entries of a root can be under the directories of a root
+        # inside it, their parents would not follow when that one changes.
+        ranges = previous.get_root_ranges()
+        ignore_filename = Ignore.IGNORE_FILENAME
+        carried = {}
+        for root_path, depth in zip(root_paths, depths):
+            if root_path in scanned or root_path not in ranges or previous.roots.get(root_path) != (depth, ignore_filename):
+                continue
+            if Cache._get_nested(root_path, root_paths) or Cache._get_nested(root_path, previous.roots):
+                continue
+            carried[root_path] = ranges[root_path]
+        return carried
+
+    def _scan(self, root_paths, depths, key, scanned, previous, is_cancelled=None):
+        # Returns (snapshot, scan_stats, carried root paths)
         self._logger.info('Scanning folders')
         now = time()
-        
+
+        carried = self._get_carried(root_paths, depths, scanned, previous)
+        # Carried if given up, when they can be
+        cancelled_ranges = self._get_carried(root_paths, depths, (), previous)
         directories_num = 0
         files_num = 0
-        paths_dict = {}
+        store = EntryStore()
+        root_files = set()
+        directories = {}
+        roots = {}
         root_matcher = Ignore.get_root_matcher()
-        matchers = {}
-
-        for root_path, depth in zip(self._root_paths, self._depths):
-            if root_path in paths_dict:
-                continue
-            if not os.path.exists(root_path):
-                continue
-            if os.path.isfile(root_path):
-                entry = CacheEntry(root_path, None)
-                paths_dict[root_path] = entry
-                files_num += 1
-                continue
-            
-            for root_dir, _, file_names in Cache._walklevel(root_path, depth):
-                if root_dir in paths_dict:
+        # Seconds spent matching files and adding entries, entries per root
+        match_seconds = 0.0
+        add_seconds = 0.0
+        root_entries = {}
+
+        def carry(root_path, start, end):
+            store.extend(previous.store, start, end)
+            if not previous.store.is_directory(start):
+                root_files.add(root_path)
+            for path, directory_info in previous.directories.items():
+                if directory_info[1] == root_path:
+                    directories[path] = directory_info
+            roots[root_path] = previous.roots[root_path]
+            root_entries[root_path] = end - start
+            carried[root_path] = (start, end)
+
+        with Scanner(self._listings) as scanner:
+            # Read all roots at once, a slow mount does not hold back the others
+            for root_path in root_paths:
+                if root_path not in carried and os.path.isdir(root_path):
+                    scanner.prefetch(root_path)
+
+            for root_path, depth in zip(root_paths, depths):
+                if root_path in store.directories or root_path in root_files:
+                    continue
+                if root_path in carried:
+                    carry(root_path, *carried[root_path])
+                    continue
+                if not os.path.exists(root_path):
+                    continue
+                roots[root_path] = (depth, Ignore.IGNORE_FILENAME)
+                if os.path.isfile(root_path):
+                    store.add_root(root_path, False)
+                    root_files.add(root_path)
+                    root_entries[root_path] = 1
+                    files_num += 1
                     continue
 
-                # Get matcher to ignore or not
-                parent_matcher = matchers.get(os.path.dirname(root_dir), root_matcher)
-                matcher = Ignore.get_matcher(root_dir, file_names, parent_matcher)
-                matchers[root_dir] = matcher
+                root_start = len(store)
+                root_directories = []
+                for root_dir, root_dir_relpath, root_dir_depth, matcher, file_names in scanner.walk(root_path, depth, root_matcher):
+                    if is_cancelled is not None and is_cancelled(root_path):
+                        break
+                    if root_dir in store.directories:
+                        continue
 
-                # Check root dir if matches
-                root_dir_relpath = os.path.relpath(root_dir, root_path)
-                if not matcher(root_dir_relpath.rstrip(os.sep) + os.sep):
+                    directories_num += 1
+
+                    added_at = perf_counter()
+                    if root_dir == root_path:
+                        root_dir_id = store.add_root(root_path, True)
+                    else:
+                        parent_id = store.directories[os.path.dirname(root_dir)]
+                        root_dir_id = store.add(os.path.basename(root_dir), parent_id, root_dir_relpath, True, root_dir)
+
+                    if matcher is not None:
+                        directories[root_dir] = (matcher, root_path, root_dir_relpath, root_dir_depth, depth)
+                        root_directories.append(root_dir)
+
+                    matched_at = perf_counter()
+                    matched_names = []
+                    for file_name in file_names:
+                        if root_files and os.path.join(root_dir, file_name) in root_files:
+                            continue
+                        file_relpath = os.path.join(root_dir_relpath, file_name)
+                        if matcher(file_relpath):
+                            matched_names.append(file_name)
+
+                    files_at = perf_counter()
+                    for file_name in matched_names:
+                        store.add(file_name, root_dir_id, Scanner.join_relpath(root_dir_relpath, file_name), False)
+                    files_num += len(matched_names)
+                    match_seconds += files_at - matched_at
+                    add_seconds += matched_at - added_at + perf_counter() - files_at
+                else:
+                    root_entries[root_path] = len(store) - root_start
                     continue
 
-                directories_num += 1
+                # Given up, the previous entries of the root are kept if they can be
+                self._logger.info('Scan of {} cancelled'.format(root_path))
+                store.truncate(root_start)
+                for root_dir in root_directories:
+                    del directories[root_dir]
+                del roots[root_path]
+                if root_path in cancelled_ranges:
+                    carry(root_path, *cancelled_ranges[root_path])
+
+        # Listings of the carried roots are kept for their next scan
+        prefixes = tuple(root_path + os.sep for root_path in carried)
+        listings = {
+            path: listing for path, listing in self._listings.items()
+            if path in carried or (prefixes and path.startswith(prefixes))
+        }
+        listings.update(scanner.listings)
+        self._listings = listings
+        indexed_at = perf_counter()
+        snapshot = CacheSnapshot(store, key, directories, roots)
+        snapshot.build_features(self._search_fuzzy)
+        index_seconds = perf_counter() - indexed_at
+        seconds = time() - now
+        self._logger.info('Finished scanning in {:.2f}ms found {} directories and {} files, {} directories unchanged, {} roots carried over'.format(
+            1000 * seconds, directories_num, files_num, scanner.reused, len(carried)))
+        scan_stats = {
+            'finished': time(),
+            'seconds': seconds,
+            'walk_seconds': scanner.list_seconds,
+            'ignore_seconds': scanner.match_seconds + match_seconds,
+            'entries_seconds': add_seconds,
+            'index_seconds': index_seconds,
+            'directories': directories_num,
+            'files': files_num,
+            'pruned': scanner.pruned,
+            'unchanged': scanner.reused,
+            'carried': len(carried),
+            'roots': root_entries,
+        }
+        return snapshot, scan_stats, list(carried)
 
-                root_dir_parent_entry = paths_dict.get(root_path)
-                if root_dir_parent_entry is None:
-                    root_dir_parent_entry = CacheEntry(root_path, None, is_directory=True)
-                    root_dir_entry = root_dir_parent_entry
-                else:
-                    root_dir_entry = CacheEntry(root_dir, root_dir_parent_entry, is_directory=True)
+    @lock
+    def get_directories(self):
+        return list(self._snapshot.directories)
 
-                paths_dict[root_dir] = root_dir_entry
+    def get_directory_names(self):
+        # Lowercase names of the scanned directories, the store of a
+        # snapshot does not change so it is read without the lock
+        with self._lock:
+            store = self._snapshot.store
+        flags = store.flags
+        return {store.name_lower(entry_id) for entry_id in range(len(store)) if flags[entry_id] & EntryStore.DIRECTORY}
 
-                for file_name in file_names:
-                    file_path = os.path.join(root_dir, file_name)
-                    if file_path in paths_dict:
-                        continue
-                    file_relpath = os.path.join(root_dir_relpath, file_name)
-                    if not matcher(file_relpath):
-                        continue
+    @lock
+    def add_path(self, path):
+        # Returns the directories that were added and read
+        if self._changes is not None:
+            self._changes.append((True, path))
+        return self._add_path(self._snapshot, path)
 
-                    files_num += 1
-                    entry = CacheEntry(file_path, paths_dict[root_path])
-                    paths_dict[file_path] = entry
+    @lock
+    def remove_path(self, path):
+        if self._changes is not None:
+            self._changes.append((False, path))
+        self._remove_path(self._snapshot, path)
+
+    @lock
+    def flush_changes(self):
+        # Called after a batch of changes, returns True when the added
+        # entries should be merged with merge_changes
+        snapshot = self._snapshot
+        snapshot.added.freeze()
+        if self._merging or len(snapshot.added) < CacheSnapshot.MAX_ADDED:
+            return False
+        self._merging = True
+        return True
+
+    def merge_changes(self):
+        # Merges the added entries into the store off-lock like a scan, the
+        # changes reported meanwhile are applied again to the merged snapshot
+        with self._scan_lock:
+            with self._lock:
+                previous = self._snapshot
+                overlay = previous.get_overlay()
+                self._changes = []
+            try:
+                now = time()
+                snapshot = previous.merge(overlay)
+                snapshot.build_features(self._search_fuzzy)
+                with self._lock:
+                    if self._snapshot is not previous:
+                        return False
+                    for added, path in self._changes:
+                        if added:
+                            self._add_path(snapshot, path)
+                        else:
+                            self._remove_path(snapshot, path)
+                    self._set_snapshot(snapshot)
+                self._logger.info('Merged {} added entries in {:.2f}ms'.format(overlay[0], 1000 * (time() - now)))
+                return True
+            finally:
+                with self._lock:
+                    self._changes = None
+                    self._merging = False
+
+    def _add_path(self, snapshot, path):
+        if path in snapshot:
+            return []
+        directory_info = snapshot.directories.get(os.path.dirname(path))
+        if directory_info is None:
+            return []
+        matcher, root_path, relpath, depth, level = directory_info
+        if root_path not in snapshot or not os.path.lexists(path):
+            return []
 
-        self._search_results.clear()
-        self._entries = set(paths_dict.values())
-        self._logger.info('Finished scanning in {:.2f}ms found {} directories and {} files'.format(1000 * (time() - now), files_num, directories_num))
+        name = os.path.basename(path)
+        if not os.path.isdir(path):
+            if not matcher(os.path.join(relpath, name)):
+                return []
+            snapshot.add(path, Scanner.join_relpath(relpath, name), False)
+            return []
 
-    def _get_score(self, entry_attr, query, relpath=False):
-        try:
-            index = entry_attr.index(query)
-            if relpath:
-                entry_end = entry_attr[index + len(query):]
-                if '/' in entry_end: return 0
+        # Symlinked directories are not followed, as in os.walk
+        dir_relpath = Scanner.join_relpath(relpath, name)
+        if os.path.islink(path) or not matcher(dir_relpath + os.sep):
+            return []
 
-            score = len(query) / len(entry_attr)
-            score_index = (len(query) - index) / len(query)
-            return score + score_index
-        except ValueError:
-            return 0
+        directories = []
+        for root_dir, root_dir_relpath, root_dir_depth, matcher, file_names in Scanner().walk(path, level, matcher, dir_relpath, depth + 1):
+            if root_dir not in snapshot:
+                snapshot.add(root_dir, root_dir_relpath, True)
+            if matcher is None:
+                continue
+            snapshot.directories[root_dir] = (matcher, root_path, root_dir_relpath, root_dir_depth, level)
+            directories.append(root_dir)
 
-    def _get_path_score(self, entry):
-        return 1.36787944117 - math.exp(-1 + entry.relpath_len / 6)
+            for file_name in file_names:
+                file_path = os.path.join(root_dir, file_name)
+                if file_path in snapshot or not matcher(os.path.join(root_dir_relpath, file_name)):
+                    continue
+                snapshot.add(file_path, Scanner.join_relpath(root_dir_relpath, file_name), False)
+        return directories
+
+    def _remove_path(self, snapshot, path):
+        snapshot.remove(path)
+
+    def search(self, query, on_results=None):
+        # Returns None when a newer search started before this one finished.
+        # Searches longer than the budget call on_results with the results
+        # so far every budget, from the searching thread.
+        started = perf_counter()
+        generation = next(self._generations)
+        self._search_generation = generation
+        shard_pool = self._shard_pool
+        if shard_pool is not None:
+            shard_pool.generation.value = generation
+
+        with self._lock:
+            if self._is_cancelled(generation):
+                self._search_cancelled += 1
+                return None
+            now = perf_counter()
+            try:
+                results, kind = self._search(query, generation, started, on_results)
+            except SearchCancelled:
+                self._search_cancelled += 1
+                return None
+            if kind is not None:
+                latency_ms = 1000 * (perf_counter() - now)
+                self._search_latencies['all'].add(latency_ms)
+                self._search_latencies[kind].add(latency_ms)
+            return results
+
+    def cancel_search(self):
+        # Searches running or waiting for the lock give up
+        self._search_generation = next(self._generations)
+
+    def _is_cancelled(self, generation):
+        return self._search_generation != generation
 
-    @lock
-    def search(self, query):
+    @staticmethod
+    def _get_results(scorer):
+        return [store.to_result(entry_id, score=score) for score, _, _, store, entry_id in scorer.get_items()]
+
+    def _search(self, query, generation, started, on_results):
+        # Returns the results and how they were found, None when not searched
+        snapshot = self._snapshot
+        search_results = snapshot.search_results
         query = query.strip()
         original_query = query
         if not self._search_after_characters <= 0 and len(query) <= self._search_after_characters:
-            return []
+            return [], None
 
-        prev_results = self._search_results.get_results(original_query)
+        usage_version = self._usage.version if self._usage is not None else 0
+        prev_results = search_results.get_results(original_query, usage_version)
         if prev_results is not None:
-            self._logger.info('Returning previous results')
-            return prev_results
-
-        prev_entries = self._search_results.get_entries(original_query)
-        if prev_entries is not None:
-            self._logger.info('Searching from previous entries')
-            entries_to_search = prev_entries
-        else:
-            entries_to_search = self._entries
+            self._logger.debug('Returning previous results')
+            return prev_results, 'cached'
 
         # Search previous results
         query = query.lower()
@@ -202,50 +612,72 @@ class Cache(metaclass=Singleton):
             query = query + query_ext
         if query.endswith('/'):
             query = query[:-1]
+        if not query:
+            return [], None
 
-        matcher = Match(query)
-
-        result_scores = {}
-        for entry in entries_to_search:
-            score = (
-                # (matcher(entry.relpath) and 2.0) or
-                (matcher(entry.relpath, ignorecase=True) and 2.0) or
-                # (matcher(entry.name) and 1.9) or 
-                (matcher(entry.name, ignorecase=True) and 1.95)
-            )
-
-            if not score:
-                if query_ext:
-                    relpath = entry.relpath_lower
-                    name = entry.name_lower
-                else:
-                    relpath = entry.relpath_basename_lower
-                    name = entry.basename_lower
-                
-                score = (
-                    self._get_score(relpath, query, relpath=True),
-                    self._get_score(name, query, relpath=False)
-                )
-                score = max(score)
-
-            if not score:
-                continue
-            
-            final_score = (score + self._get_path_score(entry)) / 3
-            result_scores[entry] = final_score
-
-        self._search_results.add_entries(original_query, list(result_scores.keys()))
-
-        result_scores = sorted(result_scores.items(), key=lambda item: (item[1], 1 / (item[0].relpath_len + 1)), reverse=True)
-        results = []
-        i = 0
-        for entry, score in result_scores:
-            if score < self._search_threshold  or i >= self._search_max_results:
-                break
-
-            result = entry.to_result(score=score)
-            results.append(result)
-            i += 1
-
-        self._search_results.add_results(original_query, results)
-        return results
+        prev_entries = search_results.get_entries(original_query)
+        if prev_entries is not None:
+            self._logger.debug('Searching from previous entries')
+            entries_to_search = prev_entries
+            kind = 'prefix'
+        else:
+            kind = 'index'
+            fuzzy_mask = None
+            if self._search_fuzzy and not Match.is_pattern(query):
+                fuzzy_mask = FuzzyMatch.get_mask(query)
+            entries_to_search = snapshot.get_candidates(query, fuzzy_mask)
+
+        # Nothing can match, longer plain queries cannot either. A longer
+        # pattern can, its prefixes do not narrow it down.
+        if not any(len(entry_ids) for _, entry_ids in entries_to_search):
+            if not Match.is_pattern(original_query):
+                search_results.add_entries(original_query, [])
+            search_results.add_results(original_query, [], usage_version)
+            return [], kind
+
+        budget = self._search_budget
+        deadline = started + budget
+        def _on_chunk(scorer):
+            nonlocal deadline
+            if self._is_cancelled(generation):
+                raise SearchCancelled()
+            if on_results is None or budget <= 0 or perf_counter() < deadline:
+                return
+            results = Cache._get_results(scorer)
+            if results:
+                on_results(results)
+            deadline = perf_counter() + budget
+
+        scorer = scoring.Scorer(
+            query, query_ext, self._search_threshold, self._search_max_results,
+            fuzzy=self._search_fuzzy, on_chunk=_on_chunk
+        )
+        boosts = {}
+        if self._usage is not None:
+            boosts = snapshot.get_boosts(self._usage, Cache.USAGE_WEIGHT, Cache.USAGE_HALF)
+        matched_entries = []
+        for store, entry_ids in entries_to_search:
+            store_boosts = boosts.get(store)
+            if store_boosts and len(entry_ids):
+                scorer.score_boosted(store, snapshot.get_features(store), store_boosts)
+            matched_ids = None
+            if store is snapshot.store and len(entry_ids) >= ShardPool.MIN_ENTRIES:
+                shard_pool = self._get_shard_pool(snapshot)
+                if shard_pool is not None:
+                    try:
+                        matched_ids = shard_pool.search(scorer, entry_ids, generation, store_boosts)
+                    except SearchCancelled:
+                        raise
+                    except Exception as e:
+                        self._logger.warning('Search processes failed, searching in process: {}'.format(e))
+                        self._search_processes = 0
+                        self._stop_shard_pool()
+            if matched_ids is None:
+                matched_ids = scorer.score(store, snapshot.get_features(store), entry_ids, skip=store_boosts)
+            matched_entries.append((store, matched_ids))
+
+        search_results.add_entries(original_query, matched_entries)
+        results = Cache._get_results(scorer)
+
+        search_results.add_results(original_query, results, usage_version)
+        return results, kind
@@ -0,0 +1,107 @@
+import sys
+from array import array
+from bisect import bisect_left
+from ..match import Match
+
+
+class NGramIndex:
+    N = 3
+
+    def __init__(self, store):
+        self._store = store
+        self._postings = {}
+        # Characters and bigrams found in the entries, shorter literals are
+        # checked against them
+        self._short_ngrams = set()
+        self._build()
+
+    @staticmethod
+    def get_ngrams(value):
+        n = NGramIndex.N
+        return set(value[i:i + n] for i in range(len(value) - n + 1))
+
+    def _build(self):
+        # Lowercase relative paths end with the name, roots only have the name
+        postings = self._postings
+        short_ngrams = self._short_ngrams
+        lowers = self._store.lowers
+        offsets = self._store.lower_offsets
+        for entry_id in range(len(self._store)):
+            value = lowers[offsets[entry_id]:offsets[entry_id + 1]]
+            if len(value) < NGramIndex.N:
+                short_ngrams.update(value)
+                short_ngrams.add(value)
+                continue
+            ngrams = NGramIndex.get_ngrams(value)
+            for ngram in ngrams:
+                posting = postings.get(ngram)
+                if posting is None:
+                    posting = array('I')
+                    postings[ngram] = posting
+                posting.append(entry_id)
+
+        # Every character and bigram of a longer value is part of one of its trigrams
+        for ngram in postings:
+            short_ngrams.update(ngram)
+            short_ngrams.add(ngram[:2])
+            short_ngrams.add(ngram[1:])
+
+    def get_memory_size(self):
+        # Postings and their keys, approximately
+        postings = self._postings
+        size = sys.getsizeof(postings) + sys.getsizeof(self._short_ngrams)
+        size += sum(sys.getsizeof(ngram) + posting.itemsize * len(posting) for ngram, posting in postings.items())
+        return size + sum(map(sys.getsizeof, self._short_ngrams))
+
+    @staticmethod
+    def get_literals(query):
+        # Wildcard queries are narrowed down with their literal parts
+        literals, _ = Match.get_literals(query)
+        return [literal for literal in literals if len(literal) >= NGramIndex.N]
+
+    def may_match(self, query):
+        # False when some literal part of the query is in no entry
+        literals, _ = Match.get_literals(query)
+        for literal in literals:
+            if len(literal) < NGramIndex.N:
+                if literal not in self._short_ngrams:
+                    return False
+            elif any(ngram not in self._postings for ngram in NGramIndex.get_ngrams(literal)):
+                return False
+        return True
+
+    def candidates(self, query):
+        # Returns the entry ids containing the query or all the literal parts
+        # of a wildcard query, or None when the index cannot narrow it down
+        literals = NGramIndex.get_literals(query)
+        if not literals:
+            return None
+
+        postings = []
+        for ngram in set().union(*(NGramIndex.get_ngrams(literal) for literal in literals)):
+            posting = self._postings.get(ngram)
+            if posting is None:
+                return []
+            postings.append(posting)
+
+        postings.sort(key=len)
+        entry_ids = postings[0]
+        for posting in postings[1:]:
+            entry_ids = NGramIndex._intersect(entry_ids, posting)
+            if not entry_ids:
+                return []
+        return list(entry_ids)
+
+    @staticmethod
+    def _intersect(entry_ids, posting):
+        # Both are sorted, probe the larger one when the smaller is tiny
+        if len(entry_ids) * 16 < len(posting):
+            posting_len = len(posting)
+            result = []
+            for entry_id in entry_ids:
+                i = bisect_left(posting, entry_id)
+                if i < posting_len and posting[i] == entry_id:
+                    result.append(entry_id)
+            return result
+        posting = set(posting)
+        return [entry_id for entry_id in entry_ids if entry_id in posting]
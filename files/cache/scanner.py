@@ -0,0 +1,140 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import time_ns, perf_counter
+from ..match import Ignore
+
+
+class Scanner:
+    # Directory listings modified this close to the scan are read again next
+    # time, the mtime granularity may hide a later change
+    RACY_NS = 2 * 10 ** 9
+    # Directories are listed by a pool of threads, scandir and stat release
+    # the GIL so roots on different disks are read at the same time
+    WORKERS = min(16, (os.cpu_count() or 1) + 4)
+
+    def __init__(self, listings=None, workers=None):
+        # Listings of the previous scan: path -> (mtime_ns, inode, dir_names, file_names, symlink_names)
+        self._previous = listings or {}
+        self._racy_ns = time_ns() - Scanner.RACY_NS
+        self._workers = Scanner.WORKERS if workers is None else workers
+        self._executor = None
+        self._futures = {}
+        self.listings = {}
+        self.reused = 0
+        # Directories skipped by the ignore files, seconds spent reading
+        # directories and matching them
+        self.pruned = 0
+        self.list_seconds = 0.0
+        self.match_seconds = 0.0
+
+    def __enter__(self):
+        if self._workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='files-scan')
+        return self
+
+    def __exit__(self, *args):
+        if self._executor is not None:
+            for future in self._futures.values():
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._futures = {}
+
+    @staticmethod
+    def _scandir(directory):
+        dir_names = []
+        file_names = []
+        symlink_names = set()
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    file_names.append(entry.name)
+                    continue
+                dir_names.append(entry.name)
+                try:
+                    if entry.is_symlink():
+                        symlink_names.add(entry.name)
+                except OSError:
+                    pass
+        return dir_names, file_names, symlink_names
+
+    def _read(self, directory):
+        # Runs in the workers, returns (listing, reused). The previous listing
+        # is reused when the directory has not changed since.
+        stat = os.stat(directory)
+        listing = self._previous.get(directory)
+        if listing is not None and listing[0] == stat.st_mtime_ns and listing[1] == stat.st_ino:
+            return listing, True
+        return (stat.st_mtime_ns, stat.st_ino) + Scanner._scandir(directory), False
+
+    def prefetch(self, directory):
+        # Start listing the directory in the background, walk picks it up
+        if self._executor is not None and directory not in self._futures:
+            self._futures[directory] = self._executor.submit(self._read, directory)
+
+    def _list(self, directory):
+        future = self._futures.pop(directory, None)
+        listing, reused = future.result() if future is not None else self._read(directory)
+        if reused:
+            self.reused += 1
+        if listing[0] < self._racy_ns:
+            self.listings[directory] = listing
+        return listing[2:]
+
+    @staticmethod
+    def join_relpath(relpath, name):
+        return name if relpath == '.' else os.path.join(relpath, name)
+
+    def walk(self, directory, level, parent_matcher, relpath='.', depth=0):
+        # Top down walk like os.walk, but ignored directories and directories
+        # deeper than level are pruned before they are read. Directories at
+        # the depth limit are yielded without a matcher and files. Listings
+        # of the directories to visit are prefetched by the workers while the
+        # walk itself keeps the sequential order, so results do not depend on
+        # the number of workers.
+        stack = [(directory, relpath, depth, parent_matcher)]
+        while stack:
+            directory, relpath, depth, parent_matcher = stack.pop()
+            if level is not None and level > 0 and depth >= level:
+                yield directory, relpath, depth, None, []
+                continue
+
+            now = perf_counter()
+            try:
+                dir_names, file_names, symlink_names = self._list(directory)
+            except OSError:
+                continue
+            finally:
+                self.list_seconds += perf_counter() - now
+
+            # Get matcher to ignore or not
+            now = perf_counter()
+            matcher = Ignore.get_matcher(directory, file_names, parent_matcher)
+            if not matcher(relpath.rstrip(os.sep) + os.sep):
+                self.pruned += 1
+                self.match_seconds += perf_counter() - now
+                continue
+            self.match_seconds += perf_counter() - now
+
+            yield directory, relpath, depth, matcher, file_names
+
+            now = perf_counter()
+            subdirectories = []
+            for dir_name in dir_names:
+                # Symlinked directories are not followed, as in os.walk
+                if dir_name in symlink_names:
+                    continue
+                dir_relpath = Scanner.join_relpath(relpath, dir_name)
+                if not matcher(dir_relpath + os.sep):
+                    self.pruned += 1
+                    continue
+                subdirectory = os.path.join(directory, dir_name)
+                if level is None or level <= 0 or depth + 1 < level:
+                    self.prefetch(subdirectory)
+                subdirectories.append((subdirectory, dir_relpath, depth + 1, matcher))
+            stack.extend(reversed(subdirectories))
+            self.match_seconds += perf_counter() - now
@@ -0,0 +1,338 @@
+import os
+import math
+import heapq
+from array import array
+from .store import EntryStore
+from ..match import Match, FuzzyMatch
+
+numpy = None
+_numpy_imported = False
+
+def _import_numpy():
+    # NumPy takes a while to import, it is imported by the first features
+    global numpy, _numpy_imported
+    if not _numpy_imported:
+        try: import numpy
+        except ImportError: numpy = None
+        _numpy_imported = True
+    return numpy
+
+
+def contains_in_order(string, literals, start, end):
+    # Whether the literals are found one after the other in string[start:end]
+    for literal in literals:
+        start = string.find(literal, start, end)
+        if start < 0:
+            return False
+        start += len(literal)
+    return True
+
+def get_path_score(relpath_len):
+    return 1.36787944117 - math.exp(-1 + relpath_len / 6)
+
+
+class Features:
+    # Values of the entries that do not depend on the query, computed once
+    # per store. Match scores are at most 2 so bounds are the best final
+    # score an entry can get. With NumPy the candidates are filtered and the
+    # best results selected with array operations.
+    def __init__(self, store):
+        self.size = len(store)
+        relpath_lens = store.relpath_lens
+        path_scores_by_len = [get_path_score(relpath_len) for relpath_len in range(max(relpath_lens, default=0) + 1)]
+        self.path_scores = array('d', map(path_scores_by_len.__getitem__, relpath_lens))
+        self.bounds = array('d', ((2.0 + path_score) / 3 for path_score in self.path_scores))
+        self.min_bound = min(self.bounds, default=0.0)
+
+        # Offsets of the names in the lowercase arena
+        lowers = store.lowers
+        offsets = store.lower_offsets
+        self.name_starts = array('I', (
+            lowers.rfind(os.sep, offsets[entry_id], offsets[entry_id + 1]) + 1 or offsets[entry_id]
+            for entry_id in range(self.size)
+        ))
+
+        self._store = store
+        self._masks = None
+        self._shallow_first = None
+
+        if _import_numpy() is not None:
+            self.path_scores_array = numpy.array(self.path_scores, dtype=numpy.float64)
+            self.bounds_array = numpy.array(self.bounds, dtype=numpy.float64)
+            self.relpath_lens_array = numpy.array(relpath_lens, dtype=numpy.int64)
+
+    def filter(self, entry_ids, threshold, boosts=None):
+        # Drops the entries that can never reach the threshold, boosted
+        # entries are kept when the largest boost can make them reach it
+        if boosts:
+            threshold -= max(boosts.values())
+        if numpy is None or threshold <= self.min_bound:
+            return entry_ids
+        if isinstance(entry_ids, range):
+            ids = numpy.arange(entry_ids.start, entry_ids.stop, dtype=numpy.intp)
+        else:
+            ids = numpy.array(entry_ids, dtype=numpy.intp)
+        return ids[self.bounds_array[ids] >= threshold].tolist()
+
+    def get_masks(self):
+        # Character masks of the entries for fuzzy queries, built on first use
+        if self._masks is not None:
+            return self._masks
+        store = self._store
+        lowers = store.lowers
+        offsets = store.lower_offsets
+        if numpy is not None and self.size:
+            codes = numpy.frombuffer(lowers.encode('utf-32-le', 'surrogatepass'), dtype=numpy.uint32)
+            bits = numpy.where(
+                (codes >= 97) & (codes <= 122), codes - 97, numpy.where(
+                    (codes >= 48) & (codes <= 57), codes - 22, 36 + codes % 28
+                )
+            ).astype(numpy.uint64)
+            char_masks = numpy.left_shift(numpy.uint64(1), bits)
+            starts = numpy.array(offsets[:-1], dtype=numpy.intp)
+            masks = numpy.zeros(self.size, dtype=numpy.uint64)
+            # reduceat needs ranges that are not empty
+            filled = starts < numpy.array(offsets[1:], dtype=numpy.intp)
+            if filled.any():
+                masks[filled] = numpy.bitwise_or.reduceat(char_masks, starts[filled])
+            self._masks = masks
+        else:
+            # Relative paths are the parent's with the name, names repeat
+            get_mask = FuzzyMatch.get_mask
+            separator = FuzzyMatch.get_bit(os.sep)
+            parents = store.parents
+            flags = store.flags
+            name_starts = self.name_starts
+            name_masks = {}
+            masks = array('Q')
+            for entry_id in range(self.size):
+                parent_id = parents[entry_id]
+                if parent_id < 0:
+                    masks.append(get_mask(lowers[offsets[entry_id]:offsets[entry_id + 1]]))
+                    continue
+                name = lowers[name_starts[entry_id]:offsets[entry_id + 1]]
+                mask = name_masks.get(name)
+                if mask is None:
+                    mask = name_masks[name] = get_mask(name)
+                if not flags[parent_id] & EntryStore.ROOT:
+                    mask |= masks[parent_id] | separator
+                masks.append(mask)
+            self._masks = masks
+        return self._masks
+
+    def get_shallow_first(self):
+        # All the ids by relative path length, the best results are found
+        # first. The sort is stable so ties are still broken in store order.
+        if self._shallow_first is None:
+            self._shallow_first = array('I', sorted(range(self.size), key=self._store.relpath_lens.__getitem__))
+        return self._shallow_first
+
+    def filter_mask(self, entry_ids, mask):
+        # Entries containing every character of the mask
+        masks = self.get_masks()
+        if numpy is None:
+            return [entry_id for entry_id in entry_ids if masks[entry_id] & mask == mask]
+        if isinstance(entry_ids, range):
+            ids = numpy.arange(entry_ids.start, entry_ids.stop, dtype=numpy.intp)
+        else:
+            ids = numpy.array(entry_ids, dtype=numpy.intp)
+        mask = numpy.uint64(mask)
+        return ids[masks[ids] & mask == mask].tolist()
+
+    def select_top(self, entry_ids, scores, threshold, max_results, order):
+        # Best (final_score, -relpath_len, order, entry_id) of the matched
+        # entries, orders count down from order in the matching order
+        if max_results <= 0 or not len(entry_ids):
+            return []
+        ids = numpy.array(entry_ids, dtype=numpy.intp)
+        final_scores = (numpy.array(scores, dtype=numpy.float64) + self.path_scores_array[ids]) / 3
+        keep = numpy.flatnonzero(final_scores >= threshold)
+        if len(keep) > max_results:
+            kth = numpy.partition(final_scores[keep], len(keep) - max_results)[len(keep) - max_results]
+            keep = keep[final_scores[keep] >= kth]
+        relpath_lens = self.relpath_lens_array[ids[keep]]
+        top = numpy.lexsort((keep, relpath_lens, -final_scores[keep]))[:max_results]
+        return [
+            (float(final_scores[keep[i]]), -int(relpath_lens[i]), order - 1 - int(keep[i]), int(ids[keep[i]]))
+            for i in top
+        ]
+
+
+class SearchCancelled(Exception):
+    pass
+
+
+class Scorer:
+    # Scores the entries of the stores for a query and keeps the best
+    # max_results as (final_score, -relpath_len, order, store, entry_id), ties
+    # go to shallower entries, then to the first one found. Plain queries are
+    # compared as they are, wildcard queries only run the pattern on entries
+    # ending with its literal suffix and containing its other literals in
+    # order. Strings are compared in place in the
+    # arena, without slicing. Fuzzy plain queries also match the entries
+    # they are a subsequence of. on_chunk is called with the scorer between
+    # chunks of entries, it may read the results so far or stop the search
+    # with SearchCancelled. Entries with a usage boost are scored first with
+    # it, then skipped by the pass over all the candidates.
+    CHUNK = 4096
+
+    def __init__(self, query, query_ext, threshold, max_results, order=0, fuzzy=False, on_chunk=None):
+        self.query = query
+        self.query_ext = query_ext
+        self.threshold = threshold
+        self.max_results = max_results
+        self.matcher = Match(query)
+        self.exact = query if self.matcher.is_plain else None
+        self.suffix = self.matcher.suffix
+        # Literals of patterns other than the suffix, found before the pattern is run
+        literals = self.matcher.literals
+        self.literals = None if self.exact is not None else literals[:-1] if self.suffix else literals
+        self.fuzzy = fuzzy
+        self.fuzzy_matcher = FuzzyMatch(query) if fuzzy and self.exact is not None else None
+        self.batch = _import_numpy() is not None
+        self.order = order
+        self.on_chunk = on_chunk
+        self._heap = []
+        self._worst_score = None
+        self._worst_len = None
+
+    def _push(self, item):
+        heap = self._heap
+        if len(heap) < self.max_results:
+            heapq.heappush(heap, item)
+            if len(heap) < self.max_results:
+                return
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+        else:
+            return
+        self._worst_score = heap[0][0]
+        self._worst_len = -heap[0][1]
+
+    def add_items(self, store, items):
+        # Best items scored somewhere else, without their store
+        for final_score, relpath_len, order, entry_id in items:
+            self._push((final_score, relpath_len, order, store, entry_id))
+
+    def get_items(self):
+        return sorted(self._heap, reverse=True)
+
+    def score_boosted(self, store, features, boosts):
+        # Most used first, the boosts are added to the final scores. The ids
+        # it matches are not returned: the ones among the candidates are
+        # returned by the pass over them, which skips them with their boost.
+        self.score(store, features, sorted(boosts, key=boosts.get, reverse=True), boosts=boosts)
+
+    def score(self, store, features, entry_ids, boosts=None, skip=None):
+        # Returns the ids that matched or were not scored, entries that can
+        # never reach the threshold are dropped, and entries that cannot beat
+        # the worst kept result are not scored but are kept as candidates for
+        # longer queries. Entries in skip were ranked with the boost they
+        # map to, the boost still counts to keep them as candidates.
+        query = self.query
+        query_len = len(query)
+        query_ext = self.query_ext
+        exact = self.exact
+        suffix = self.suffix
+        literals = self.literals
+        matcher = self.matcher
+        fuzzy_matcher = self.fuzzy_matcher
+        threshold = self.threshold
+        max_results = self.max_results
+        batch = self.batch and boosts is None
+        push = self._push
+        heap = self._heap
+
+        bounds = features.bounds
+        path_scores = features.path_scores
+        name_starts = features.name_starts
+        lowers = store.lowers
+        lower_offsets = store.lower_offsets
+        ext_lens = store.ext_lens
+        relpath_lens = store.relpath_lens
+        flags = store.flags
+        matched_ids = array('I')
+        # Boosts of the entries, added to their bounds
+        entry_boosts = boosts if boosts is not None else skip
+        if boosts is None:
+            entry_ids = features.filter(entry_ids, threshold, skip)
+        on_chunk = self.on_chunk
+        for chunk_start in range(0, len(entry_ids), Scorer.CHUNK):
+            if chunk_start and on_chunk is not None:
+                on_chunk(self)
+            # Scored ids and their scores of the chunk, ranked after it
+            scored_ids = array('I')
+            scores = array('d')
+            for entry_id in entry_ids[chunk_start:chunk_start + Scorer.CHUNK]:
+                bound = bounds[entry_id]
+                if entry_boosts:
+                    bound += entry_boosts.get(entry_id, 0.0)
+                if bound < threshold:
+                    continue
+                relpath_len = relpath_lens[entry_id]
+                worst_score = self._worst_score
+                if worst_score is not None and (bound < worst_score or (bound == worst_score and relpath_len >= self._worst_len)):
+                    matched_ids.append(entry_id)
+                    continue
+
+                start = lower_offsets[entry_id]
+                end = lower_offsets[entry_id + 1]
+                name_start = name_starts[entry_id]
+                # Roots have no relative path, only their name is matched
+                is_root = flags[entry_id] & EntryStore.ROOT
+
+                if exact is not None:
+                    score = (
+                        (not is_root and end - start == query_len and lowers.startswith(exact, start) and 2.0) or
+                        (end - name_start == query_len and lowers.startswith(exact, name_start) and 1.95)
+                    )
+                elif suffix and not lowers.endswith(suffix, start, end):
+                    score = 0
+                elif literals and not contains_in_order(lowers, literals, start, end):
+                    score = 0
+                else:
+                    score = (
+                        (matcher('' if is_root else lowers[start:end], ignorecase=True) and 2.0) or
+                        (matcher(lowers[name_start:end], ignorecase=True) and 1.95)
+                    )
+
+                if not score:
+                    stop = end if query_ext else end - ext_lens[entry_id]
+                    # The query in the relative path but not in a parent
+                    # directory name, or the query in the name
+                    index = -1 if is_root else lowers.find(query, start, stop)
+                    if index >= 0 and lowers.find('/', index + query_len, stop) < 0:
+                        score = query_len / (stop - start) + (query_len - index + start) / query_len
+                    index = lowers.find(query, name_start, stop)
+                    if index >= 0:
+                        score = max(score, query_len / (stop - name_start) + (query_len - index + name_start) / query_len)
+                    if not score and fuzzy_matcher is not None:
+                        # Fuzzy scores are at most 1
+                        if worst_score is not None and (1.0 + path_scores[entry_id]) / 3 < worst_score:
+                            matched_ids.append(entry_id)
+                            continue
+                        score = fuzzy_matcher.score(lowers, start, end)
+
+                if not score:
+                    continue
+
+                matched_ids.append(entry_id)
+                if skip is not None and entry_id in skip:
+                    continue
+                if batch:
+                    scored_ids.append(entry_id)
+                    scores.append(score)
+                    continue
+                final_score = (score + path_scores[entry_id]) / 3
+                if boosts is not None:
+                    final_score += boosts.get(entry_id, 0.0)
+                if final_score < threshold or max_results <= 0:
+                    continue
+                self.order -= 1
+                if len(heap) < max_results or final_score >= heap[0][0]:
+                    push((final_score, -relpath_len, self.order, store, entry_id))
+
+            if batch:
+                self.add_items(store, features.select_top(scored_ids, scores, threshold, max_results, self.order))
+                self.order -= len(scored_ids)
+        return matched_ids
@@ -1,70 +1,146 @@
-from time import time
+from collections import OrderedDict
+from ..match import Match
 
 class SearchResults:
-    KEEP_MAX = 4
-    KEEP_FOR = 0
+    # Results of the last queries and the entries they matched, for the
+    # current snapshot. Entries of a plain query are searched again for any
+    # plain query it is a prefix of. The least recently used queries are evicted once
+    # more than MAX_ENTRIES entries and results are kept. Results are kept
+    # with the version of the usage they were ranked with, the entries do
+    # not depend on it.
+    MAX_ENTRIES = 2000000
 
     def __init__(self):
-        self._results = _SearchResults()
-        self._entries = _SearchResults()
+        self._root = _Node()
+        # query -> number of entries and results kept for it
+        self._sizes = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-    def get_results(self, query):
-        return self._results.get(query, exact=True)
+    def get_results(self, query, version=0):
+        node = self._find(query)
+        if node is None or node.results is None or node.version != version:
+            return None
+        self._sizes.move_to_end(query)
+        self.hits += 1
+        return node.results
 
     def get_entries(self, query):
-        return self._entries.get(query)
+        # Entries of the query, or of its longest cached prefix for plain
+        # queries only: a pattern can match entries its prefixes do not, as
+        # *.py does the ones that *. does not
+        node = self._root
+        found = None
+        found_at = 0
+        if Match.is_pattern(query):
+            node = self._find(query)
+            if node is not None and node.entries is not None:
+                found = node
+                found_at = len(query)
+        else:
+            if node.entries is not None:
+                found = node
+            for i, c in enumerate(query):
+                node = node.children.get(c)
+                if node is None:
+                    break
+                if node.entries is not None:
+                    found = node
+                    found_at = i + 1
+
+        if found is None:
+            self.misses += 1
+            return None
+        self._sizes.move_to_end(query[:found_at])
+        if found_at == len(query):
+            self.hits += 1
+        else:
+            self.prefix_hits += 1
+        return found.entries
 
-    def add_results(self, query, results):
-        self._results.add(query, results)
+    def add_results(self, query, results, version=0):
+        node = self._add(query)
+        node.version = version
+        self._resize(query, node, results=results)
 
     def add_entries(self, query, entries):
-        self._entries.add(query, entries)
+        node = self._add(query)
+        self._resize(query, node, entries=entries)
 
     def clear(self):
-        self._results.clear()
-        self._entries.clear()
+        self._root = _Node()
+        self._sizes = OrderedDict()
+        self._size = 0
+
+    def get_stats(self):
+        return {
+            'queries': len(self._sizes),
+            'entries': self._size,
+            'hits': self.hits,
+            'prefix_hits': self.prefix_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _find(self, query):
+        node = self._root
+        for c in query:
+            node = node.children.get(c)
+            if node is None:
+                return None
+        return node
+
+    def _add(self, query):
+        node = self._root
+        for c in query:
+            child = node.children.get(c)
+            if child is None:
+                child = node.children[c] = _Node()
+            node = child
+        return node
+
+    def _resize(self, query, node, entries=None, results=None):
+        if entries is not None:
+            node.entries = entries
+        if results is not None:
+            node.results = results
+        size = node.get_size()
+        self._size += size - self._sizes.pop(query, 0)
+        self._sizes[query] = size
+
+        while self._size > SearchResults.MAX_ENTRIES and len(self._sizes) > 1:
+            evicted, evicted_size = self._sizes.popitem(last=False)
+            self._size -= evicted_size
+            self._remove(evicted)
+            self.evictions += 1
+
+    def _remove(self, query):
+        # Removes the query and the nodes only it was using
+        path = [self._root]
+        for c in query:
+            path.append(path[-1].children[c])
+        path[-1].entries = None
+        path[-1].results = None
+        for i in range(len(query), 0, -1):
+            node = path[i]
+            if node.children or node.entries is not None or node.results is not None:
+                break
+            del path[i - 1].children[query[i - 1]]
+
+class _Node:
+    __slots__ = ('children', 'entries', 'results', 'version')
 
-class _SearchResults:
     def __init__(self):
-        self._terms = []
-        self._data = {}
-        self._times = {}
-
-    def _time_or_get(self, key):
-        if time() - self._times[key] > SearchResults.KEEP_FOR:
-            del self._data[key]
-            del self._times[key]
-            self._terms.remove(key)
-        else:
-            self._times[key] = time()
-            return self._data[key]
-
-    def get(self, query, exact=False):
-        if query in self._data:
-            return self._time_or_get(query)
-        
-        if exact: return
-
-        search_terms = sorted(self._terms, key=len, reverse=True)
-        for term in search_terms:
-            if query.startswith(term):
-                result = self._time_or_get(term)
-                if result: return result
-
-    def add(self, query, items):
-        if SearchResults.KEEP_FOR == 0:
-            self.clear()
-            return
-        self._terms.append(query)
-        self._data[query] = items
-        self._times[query] = time()
-
-        while len(self._terms) > SearchResults.KEEP_MAX:
-            entry = self._terms.pop(0)
-            del self._data[entry]
-            del self._times[entry]
-        
-    def clear(self):
-        self._terms = []
-        self._data = {}
-        self._times = {}
\ No newline at end of file
+        self.children = {}
+        self.entries = None
+        self.results = None
+        self.version = 0
+
+    def get_size(self):
+        size = len(self.results) if self.results is not None else 0
+        if self.entries is not None:
+            size += sum(len(entry_ids) for _, entry_ids in self.entries)
+        return size
@@ -0,0 +1,134 @@
+import os
+import sys
+from array import array
+from .scoring import Features, Scorer, SearchCancelled
+from .storage import IndexStorage
+
+# Store and features the worker last loaded and the file they were loaded
+# from, and the generation of the latest search shared with the parent
+_handle = None
+_store = None
+_features = None
+_generation = None
+
+
+def _init(generation):
+    global _generation
+    _generation = generation
+
+
+def _load(handle):
+    global _handle, _store, _features
+    if handle == _handle:
+        return
+    store = IndexStorage(handle).load(ShardPool.KEY)
+    if store is None:
+        raise OSError('Could not load the shared store from {}'.format(handle))
+    _handle, _store, _features = handle, store, Features(store)
+
+
+def _search(handle, query, query_ext, threshold, max_results, entry_ids, order, fuzzy, generation, skip):
+    _load(handle)
+    def _on_chunk(scorer):
+        if _generation.value != generation:
+            raise SearchCancelled()
+
+    scorer = Scorer(query, query_ext, threshold, max_results, order, fuzzy, _on_chunk)
+    matched_ids = scorer.score(_store, _features, entry_ids, skip=skip)
+    return matched_ids, [(score, relpath_len, order, entry_id) for score, relpath_len, order, _, entry_id in scorer.get_items()]
+
+
+class ShardPool:
+    # Worker processes kept across snapshots. They are forked from a
+    # forkserver process started without threads: the extension runs the
+    # scheduler, scanner and GTK threads, a child forked from it could
+    # inherit a lock held by one of them and deadlock. The forkserver runs
+    # sys.executable, so they cannot be started when Python is embedded in
+    # the launcher as in Albert.
+    # The store of each snapshot is written once to a file in shared memory
+    # and every worker loads it on its first search of that snapshot, the
+    # strings of the store are decoded so each worker still has its own copy.
+    # Candidates are split in contiguous shards, each worker returns its best
+    # results and they are merged by the Scorer of the search. Workers stop
+    # when the generation is set to a newer search. They do not report their
+    # results so far, split searches only return once all shards are done.
+    MIN_ENTRIES = 50000
+    # Orders of each shard start this far apart to keep the merge order
+    ORDER_STRIDE = 1 << 32
+    KEY = bytes(20)
+
+    def __init__(self, processes):
+        if not ShardPool.is_available():
+            raise ValueError('{} is not a Python interpreter'.format(sys.executable or 'The executable'))
+        # Only needed when searches are split, not imported at startup
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        self.store = None
+        self.processes = processes
+        self._handle = None
+        context = multiprocessing.get_context('forkserver')
+        self.generation = context.Value('Q', 0, lock=False)
+        self._executor = ProcessPoolExecutor(
+            max_workers=processes, mp_context=context,
+            initializer=_init, initargs=(self.generation,)
+        )
+
+    @staticmethod
+    def is_available():
+        return os.path.basename(sys.executable or '').startswith(('python', 'pypy'))
+
+    @staticmethod
+    def share(store):
+        # Writes the store for the workers, returns its handle
+        import tempfile
+        directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        fd, handle = tempfile.mkstemp(prefix='ulauncher-files-', suffix='.store', dir=directory)
+        os.close(fd)
+        if not IndexStorage(handle).save(ShardPool.KEY, store):
+            ShardPool.unshare(handle)
+            raise OSError('Could not share the store in {}'.format(handle))
+        return handle
+
+    def set_store(self, store, handle):
+        # Searches of the previous store have returned, its file is removed
+        ShardPool.unshare(self._handle)
+        self.store = store
+        self._handle = handle
+
+    @staticmethod
+    def unshare(handle):
+        if handle is None:
+            return
+        try: os.remove(handle)
+        except OSError: pass
+
+    def search(self, scorer, entry_ids, generation, skip=None):
+        # Returns the matched ids like Scorer.score
+        if self.generation.value < generation:
+            self.generation.value = generation
+        shard_size = -(-len(entry_ids) // self.processes)
+        futures = []
+        for i in range(self.processes):
+            shard = entry_ids[i * shard_size:(i + 1) * shard_size]
+            if not len(shard):
+                break
+            # Ranges are sent as they are, lists as arrays which pickle as bytes
+            if isinstance(shard, list):
+                shard = array('I', shard)
+            futures.append(self._executor.submit(
+                _search, self._handle, scorer.query, scorer.query_ext, scorer.threshold, scorer.max_results,
+                shard, scorer.order - i * ShardPool.ORDER_STRIDE, scorer.fuzzy, generation, skip
+            ))
+        results = [future.result() for future in futures]
+
+        matched_ids = array('I')
+        for shard_matched_ids, items in results:
+            matched_ids.extend(shard_matched_ids)
+            scorer.add_items(self.store, items)
+        scorer.order -= len(futures) * ShardPool.ORDER_STRIDE
+        return matched_ids
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+        ShardPool.unshare(self._handle)
+        self._handle = None
@@ -0,0 +1,203 @@
+import os
+from array import array
+from .index import NGramIndex
+from .scoring import Features
+from .search_results import SearchResults
+from .store import EntryStore
+
+
+class CacheSnapshot:
+    # Built off-lock by Cache.scan and never rebuilt once published. Changes
+    # reported by the file watcher are kept in the added store and the removed
+    # ids until the next scan, they are applied under the Cache lock. Once
+    # MAX_ADDED entries were added they are merged into the store of a new
+    # snapshot.
+    MAX_ADDED = 10000
+
+    def __init__(self, store=None, key=None, directories=None, roots=None):
+        self.key = key
+        self.store = (store or EntryStore()).freeze()
+        self.index = NGramIndex(self.store)
+        # Directories that were read: path -> (matcher, root_path, relpath, depth, level)
+        self.directories = directories if directories is not None else {}
+        # Roots scanned into the store: root_path -> (level, ignore filename),
+        # only scanned snapshots have them, loaded ones have no matchers
+        self.roots = roots if roots is not None else {}
+        self.search_results = SearchResults()
+        self.added = EntryStore()
+        self.removed = set()
+        self.added_removed = set()
+        self._features = {}
+        self._boosts = {}
+        self._boosts_key = None
+
+    def get(self, path):
+        # Returns (store, entry_id) or None
+        entry_id = self.added.find(path)
+        if entry_id is not None and entry_id not in self.added_removed:
+            return self.added, entry_id
+        entry_id = self.store.find(path)
+        if entry_id is not None and entry_id not in self.removed:
+            return self.store, entry_id
+        return None
+
+    def add(self, path, relpath, is_directory):
+        # The added store is frozen once for all the changes of a batch, or
+        # by the next search
+        self.added.add(os.path.basename(path), -1, relpath, is_directory, path)
+        self.search_results.clear()
+
+    def remove(self, path):
+        # Removes the path and everything under it
+        found = self.get(path)
+        if found is None:
+            return
+        store, removed_id = found
+        removed = self.removed if store is self.store else self.added_removed
+        removed.add(removed_id)
+
+        if store.is_directory(removed_id):
+            # Entries are stored depth first so the subtree follows the directory
+            for entry_id in range(removed_id + 1, len(store)):
+                if not store.is_descendant(entry_id, removed_id):
+                    break
+                removed.add(entry_id)
+            prefix = path + os.sep
+            for added_id, added_path in self.added.paths.items():
+                if added_path.startswith(prefix):
+                    self.added_removed.add(added_id)
+            for directory in [d for d in self.directories if d == path or d.startswith(prefix)]:
+                del self.directories[directory]
+        self.search_results.clear()
+
+    def get_root_ranges(self):
+        # Entries of the roots in the store: root_path -> (start, end), the
+        # store holds the roots one after the other
+        store = self.store
+        root_ids = sorted(entry_id for entry_id in store.paths if store.flags[entry_id] & EntryStore.ROOT)
+        return {store.paths[start]: (start, end) for start, end in zip(root_ids, root_ids[1:] + [len(store)])}
+
+    def get_changes(self, root_paths):
+        # Changes of the watcher under the roots as (added, path)
+        prefixes = tuple(root_path + os.sep for root_path in root_paths)
+        if not prefixes:
+            return []
+        removed_paths = (self.store.path(entry_id) for entry_id in sorted(self.removed))
+        changes = [(False, path) for path in removed_paths if path.startswith(prefixes)]
+        changes.extend(
+            (True, path) for entry_id, path in sorted(self.added.paths.items())
+            if entry_id not in self.added_removed and path.startswith(prefixes)
+        )
+        return changes
+
+    def get_candidates(self, query, fuzzy_mask=None):
+        # Returns a list of (store, entry_ids) to search. Fuzzy queries are
+        # not substrings, entries are only filtered by their characters.
+        # Entries of full scans come shallowest first.
+        if fuzzy_mask is not None:
+            entry_ids = self.get_features(self.store).filter_mask(self.get_features(self.store).get_shallow_first(), fuzzy_mask)
+        else:
+            entry_ids = self.index.candidates(query)
+            if entry_ids is None:
+                entry_ids = self.get_features(self.store).get_shallow_first() if self.index.may_match(query) else []
+        if self.removed:
+            removed = self.removed
+            entry_ids = [entry_id for entry_id in entry_ids if entry_id not in removed]
+        candidates = [(self.store, entry_ids)]
+        if len(self.added):
+            self.added.freeze()
+            added_removed = self.added_removed
+            entry_ids = [entry_id for entry_id in range(len(self.added)) if entry_id not in added_removed]
+            if fuzzy_mask is not None:
+                entry_ids = self.get_features(self.added).filter_mask(entry_ids, fuzzy_mask)
+            candidates.append((self.added, entry_ids))
+        return candidates
+
+    def get_overlay(self):
+        # Changes of the watcher to merge, read under the Cache lock as the
+        # watcher keeps adding to them
+        self.added.freeze()
+        return len(self.added), set(self.removed), set(self.added_removed), dict(self.directories)
+
+    def merge(self, overlay):
+        # Returns a snapshot with the store and the added entries of the
+        # overlay in one store, in the order of a scan: the added entries of
+        # a directory come after its files, before its directories
+        size, removed, added_removed, directories = overlay
+        store = self.store
+        added = self.added
+        children = {}
+        for added_id in range(size):
+            if added_id in added_removed:
+                continue
+            parent_path = os.path.dirname(added.paths[added_id])
+            parent_id = added.find(parent_path)
+            if parent_id is not None and parent_id < added_id and parent_id not in added_removed:
+                children.setdefault((added, parent_id), []).append(added_id)
+                continue
+            parent_id = store.find(parent_path)
+            if parent_id is not None and parent_id not in removed:
+                children.setdefault((store, parent_id), []).append(added_id)
+
+        merged = EntryStore()
+        paths = {}
+        def append_added(parent, merged_parent_id):
+            for added_id in sorted(children.pop(parent, ()), key=added.is_directory):
+                merged_id = merged.append_entry(added, added_id, merged_parent_id)
+                if added.is_directory(added_id):
+                    append_added((added, added_id), merged_id)
+
+        merged_ids = array('i', [-1]) * len(store)
+        # Directory whose added entries come after its files
+        current = None
+        for entry_id in range(len(store)):
+            parent_id = store.parents[entry_id]
+            if entry_id in removed or (parent_id >= 0 and merged_ids[parent_id] < 0):
+                continue
+            if current is not None and (store.is_directory(entry_id) or parent_id != current):
+                append_added((store, current), merged_ids[current])
+                current = None
+            merged_ids[entry_id] = merged.append_entry(store, entry_id, merged_ids[parent_id] if parent_id >= 0 else -1)
+            if entry_id in store.paths:
+                paths[merged_ids[entry_id]] = store.paths[entry_id]
+            if store.is_directory(entry_id):
+                current = entry_id
+        if current is not None:
+            append_added((store, current), merged_ids[current])
+        merged.set_paths(paths)
+        return CacheSnapshot(merged, self.key, directories, self.roots)
+
+    def get_boosts(self, usage, weight, half):
+        # Usage boosts of the entries: store -> {entry_id: boost}, a path
+        # opened half times gets half the weight
+        key = (usage.version, len(self.added), len(self.removed), len(self.added_removed))
+        if self._boosts_key != key:
+            self._boosts = {}
+            for path, usage_weight in usage.get_weights().items():
+                found = self.get(path)
+                if found is not None:
+                    store, entry_id = found
+                    self._boosts.setdefault(store, {})[entry_id] = weight * usage_weight / (usage_weight + half)
+            self._boosts_key = key
+        return self._boosts
+
+    def build_features(self, masks=False):
+        # Features of the store, built before the snapshot is published so
+        # searches only build the ones of the small added store
+        features = self.get_features(self.store)
+        features.get_shallow_first()
+        if masks:
+            features.get_masks()
+
+    def get_features(self, store):
+        # Built again for the added store when it grew
+        features = self._features.get(store)
+        if features is None or features.size != len(store):
+            features = self._features[store] = Features(store)
+        return features
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def __len__(self):
+        return len(self.store) - len(self.removed) + len(self.added) - len(self.added_removed)
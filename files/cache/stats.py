@@ -0,0 +1,47 @@
+from bisect import bisect_right
+from collections import deque
+
+
+class LatencyHistogram:
+    # Counts of the latencies per bucket since the start, percentiles are
+    # computed from the most recent ones
+    BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+    RECENT = 1000
+
+    def __init__(self):
+        self.counts = [0] * (len(LatencyHistogram.BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self._recent = deque(maxlen=LatencyHistogram.RECENT)
+
+    def add(self, latency_ms):
+        self.counts[bisect_right(LatencyHistogram.BUCKETS_MS, latency_ms)] += 1
+        self.count += 1
+        self.total_ms += latency_ms
+        self.max_ms = max(self.max_ms, latency_ms)
+        self._recent.append(latency_ms)
+
+    @staticmethod
+    def _percentile(values, percentile):
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+    def get_stats(self):
+        recent = sorted(self._recent)
+        buckets = {}
+        lower = 0
+        for upper, count in zip(LatencyHistogram.BUCKETS_MS, self.counts):
+            buckets['{}-{}ms'.format(lower, upper)] = count
+            lower = upper
+        buckets['{}ms+'.format(lower)] = self.counts[-1]
+        return {
+            'count': self.count,
+            'mean_ms': self.total_ms / self.count if self.count else 0.0,
+            'p50_ms': LatencyHistogram._percentile(recent, 50),
+            'p90_ms': LatencyHistogram._percentile(recent, 90),
+            'p99_ms': LatencyHistogram._percentile(recent, 99),
+            'max_ms': self.max_ms,
+            'buckets': buckets,
+        }
@@ -0,0 +1,118 @@
+import os
+import sys
+import struct
+import hashlib
+from array import array
+from .store import EntryStore
+from .. import logging
+
+
+class IndexStorage:
+    # Layout: header, then the EntryStore columns and the root ids in native
+    # byte order, the flags, then the fs encoded names, lowercase relpaths
+    # and root paths. Columns are read straight into their arrays, the names
+    # are decoded to new strings anyway so the file is not mapped.
+    MAGIC = b'ULAF'
+    VERSION = 2
+    HEADER = struct.Struct('<4sHH20sQQQQQ')
+    BYTEORDER = {'little': 1, 'big': 2}
+    COLUMNS = (
+        ('name_offsets', 'I', 1),
+        ('lower_offsets', 'I', 1),
+        ('parents', 'i', 0),
+        ('ext_lens', 'H', 0),
+        ('relpath_lens', 'H', 0),
+    )
+
+    def __init__(self, path):
+        self._path = path
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def path(self):
+        return self._path
+
+    @staticmethod
+    def get_key(root_paths, depths, ignore_filename):
+        value = repr((IndexStorage.VERSION, tuple(root_paths), tuple(depths), ignore_filename))
+        return hashlib.sha1(value.encode('utf-8')).digest()
+
+    @staticmethod
+    def _encode(value):
+        return value.encode('utf-8', 'surrogateescape')
+
+    @staticmethod
+    def _decode(value):
+        return bytes(value).decode('utf-8', 'surrogateescape')
+
+    def save(self, key, store):
+        root_ids = array('i', sorted(store.paths))
+        names = IndexStorage._encode(store.names)
+        lowers = IndexStorage._encode(store.lowers)
+        roots = IndexStorage._encode('\0'.join(store.paths[root_id] for root_id in root_ids))
+        header = IndexStorage.HEADER.pack(
+            IndexStorage.MAGIC, IndexStorage.VERSION, IndexStorage.BYTEORDER[sys.byteorder],
+            key, len(store), len(root_ids), len(names), len(lowers), len(roots)
+        )
+        tmp_path = '{}.{}.tmp'.format(self._path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(header)
+                for name, _, _ in IndexStorage.COLUMNS:
+                    getattr(store, name).tofile(f)
+                root_ids.tofile(f)
+                f.write(store.flags)
+                f.write(names)
+                f.write(lowers)
+                f.write(roots)
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            self._logger.warning('Could not save index to {}: {}'.format(self._path, e))
+            try: os.remove(tmp_path)
+            except OSError: pass
+            return False
+        return True
+
+    def load(self, key):
+        try:
+            with open(self._path, 'rb') as f:
+                return self._read(f, key)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, struct.error) as e:
+            self._logger.warning('Could not load index from {}: {}'.format(self._path, e))
+            return None
+
+    def _read(self, f, key):
+        header = IndexStorage.HEADER.unpack(f.read(IndexStorage.HEADER.size))
+        magic, version, byteorder, file_key, count, roots_count, names_size, lowers_size, roots_size = header
+        if magic != IndexStorage.MAGIC or version != IndexStorage.VERSION:
+            return None
+        if byteorder != IndexStorage.BYTEORDER[sys.byteorder] or file_key != key:
+            return None
+
+        store = EntryStore()
+
+        def read(size):
+            data = f.read(size)
+            if len(data) != size:
+                raise ValueError('truncated index file')
+            return data
+
+        # fromfile raises EOFError when the file is truncated
+        for name, typecode, extra in IndexStorage.COLUMNS:
+            column = array(typecode)
+            column.fromfile(f, count + extra)
+            setattr(store, name, column)
+        root_ids = array('i')
+        root_ids.fromfile(f, roots_count)
+        store.flags = bytearray(read(count))
+        store.names = IndexStorage._decode(read(names_size))
+        store.lowers = IndexStorage._decode(read(lowers_size))
+        roots = IndexStorage._decode(read(roots_size)).split('\0') if roots_count else []
+        if len(roots) != roots_count or store.name_offsets[-1] != len(store.names) or store.lower_offsets[-1] != len(store.lowers):
+            raise ValueError('corrupted index file')
+
+        store.set_paths(dict(zip(root_ids, roots)))
+        return store
@@ -0,0 +1,221 @@
+import os
+import sys
+from array import array
+from ..result import Result
+
+
+class EntryStore:
+    # Columnar storage of the cached entries. Names (original case) and
+    # lowercase relative paths live in two string arenas addressed by offset
+    # arrays, full paths are rebuilt from parent indices only when needed.
+    # Root entries keep their lowercase name in place of the relative path.
+    # The relative paths repeat the ones of their parents so the scorer can
+    # match them in place, the lowercase arena is a few times the size of
+    # the names one (see get_arena_stats). A single name out of Latin-1
+    # makes a whole arena take 2 or 4 bytes per character.
+    DIRECTORY = 1
+    ROOT = 2
+
+    def __init__(self):
+        self.names = ''
+        self.lowers = ''
+        self.name_offsets = array('I', [0])
+        self.lower_offsets = array('I', [0])
+        self.parents = array('i')
+        self.ext_lens = array('H')
+        self.relpath_lens = array('H')
+        self.flags = bytearray()
+        # Full paths of roots and of entries added by path
+        self.paths = {}
+        self._path_ids = {}
+        self._directories = {}
+        self._pending_names = []
+        self._pending_lowers = []
+
+    def __len__(self):
+        return len(self.flags)
+
+    def _append(self, name, lower, parent_id, flags, relpath_len):
+        entry_id = len(self.flags)
+        _, ext = os.path.splitext(name)
+        self._pending_names.append(name)
+        self._pending_lowers.append(lower)
+        self.name_offsets.append(self.name_offsets[-1] + len(name))
+        self.lower_offsets.append(self.lower_offsets[-1] + len(lower))
+        self.parents.append(parent_id)
+        self.ext_lens.append(len(ext))
+        self.relpath_lens.append(relpath_len)
+        self.flags.append(flags)
+        return entry_id
+
+    def add_root(self, path, is_directory):
+        name = os.path.basename(path)
+        flags = EntryStore.ROOT | (EntryStore.DIRECTORY if is_directory else 0)
+        entry_id = self._append(name, name.lower(), -1, flags, 0)
+        self.paths[entry_id] = path
+        self._path_ids[path] = entry_id
+        if is_directory:
+            self.directories[path] = entry_id
+        return entry_id
+
+    def add(self, name, parent_id, relpath, is_directory, path=None):
+        # Directories and entries without a parent need their full path,
+        # entries without a parent are the ones added after a scan
+        flags = EntryStore.DIRECTORY if is_directory else 0
+        entry_id = self._append(name, relpath.lower(), parent_id, flags, relpath.count(os.sep))
+        if parent_id < 0:
+            self.paths[entry_id] = path
+            self._path_ids[path] = entry_id
+        if is_directory:
+            self.directories[path] = entry_id
+        return entry_id
+
+    def append_entry(self, store, entry_id, parent_id):
+        # Appends an entry of another store with its relative path
+        lower = store.lowers[store.lower_offsets[entry_id]:store.lower_offsets[entry_id + 1]]
+        return self._append(store.name(entry_id), lower, parent_id, store.flags[entry_id], store.relpath_lens[entry_id])
+
+    def set_paths(self, paths):
+        # Used for loaded stores, directories are found again on first use
+        self.paths = paths
+        self._path_ids = {path: entry_id for entry_id, path in paths.items()}
+        self._directories = None
+
+    def freeze(self):
+        # Joins the pending strings into the arenas, call before reading
+        if self._pending_names:
+            self.names += ''.join(self._pending_names)
+            self.lowers += ''.join(self._pending_lowers)
+            self._pending_names = []
+            self._pending_lowers = []
+        return self
+
+    def extend(self, store, start, end):
+        # Appends the entries start to end of another store, a root and its
+        # subtree so the parents are in the range too
+        shift = len(self.flags) - start
+        name_start = store.name_offsets[start]
+        lower_start = store.lower_offsets[start]
+        name_shift = self.name_offsets[-1] - name_start
+        lower_shift = self.lower_offsets[-1] - lower_start
+        self._pending_names.append(store.names[name_start:store.name_offsets[end]])
+        self._pending_lowers.append(store.lowers[lower_start:store.lower_offsets[end]])
+        self.name_offsets.extend(offset + name_shift for offset in store.name_offsets[start + 1:end + 1])
+        self.lower_offsets.extend(offset + lower_shift for offset in store.lower_offsets[start + 1:end + 1])
+        self.parents.extend(parent_id + shift if parent_id >= 0 else parent_id for parent_id in store.parents[start:end])
+        self.ext_lens.extend(store.ext_lens[start:end])
+        self.relpath_lens.extend(store.relpath_lens[start:end])
+        self.flags += store.flags[start:end]
+        for entry_id, path in store.paths.items():
+            if start <= entry_id < end:
+                self.paths[entry_id + shift] = path
+                self._path_ids[path] = entry_id + shift
+        directories = self.directories
+        for path, entry_id in store.directories.items():
+            if start <= entry_id < end:
+                directories[path] = entry_id + shift
+
+    def truncate(self, size):
+        # Drops the entries from size on
+        self.freeze()
+        self.names = self.names[:self.name_offsets[size]]
+        self.lowers = self.lowers[:self.lower_offsets[size]]
+        del self.name_offsets[size + 1:]
+        del self.lower_offsets[size + 1:]
+        del self.parents[size:]
+        del self.ext_lens[size:]
+        del self.relpath_lens[size:]
+        del self.flags[size:]
+        for entry_id in [entry_id for entry_id in self.paths if entry_id >= size]:
+            del self._path_ids[self.paths.pop(entry_id)]
+        directories = self.directories
+        for path in [path for path, entry_id in directories.items() if entry_id >= size]:
+            del directories[path]
+
+    @property
+    def directories(self):
+        if self._directories is None:
+            self._directories = {}
+            dir_paths = {}
+            for entry_id, flags in enumerate(self.flags):
+                if not flags & EntryStore.DIRECTORY:
+                    continue
+                path = self.paths.get(entry_id)
+                if path is None:
+                    parent_path = dir_paths.get(self.parents[entry_id])
+                    path = os.path.join(parent_path, self.name(entry_id)) if parent_path else self.path(entry_id)
+                dir_paths[entry_id] = path
+                self._directories[path] = entry_id
+        return self._directories
+
+    def find(self, path):
+        entry_id = self._path_ids.get(path)
+        if entry_id is None:
+            entry_id = self.directories.get(path)
+        if entry_id is not None:
+            return entry_id
+
+        # Files are stored right after their directory
+        parent_id = self.directories.get(os.path.dirname(path))
+        if parent_id is None:
+            return None
+        name = os.path.basename(path)
+        flags = self.flags
+        parents = self.parents
+        for entry_id in range(parent_id + 1, len(flags)):
+            if flags[entry_id] & EntryStore.DIRECTORY or parents[entry_id] != parent_id:
+                break
+            if self.name(entry_id) == name:
+                return entry_id
+        return None
+
+    def is_descendant(self, entry_id, ancestor_id):
+        parents = self.parents
+        entry_id = parents[entry_id]
+        while entry_id >= 0:
+            if entry_id == ancestor_id:
+                return True
+            entry_id = parents[entry_id]
+        return False
+
+    def name(self, entry_id):
+        return self.names[self.name_offsets[entry_id]:self.name_offsets[entry_id + 1]]
+
+    def relpath_lower(self, entry_id):
+        if self.flags[entry_id] & EntryStore.ROOT:
+            return ''
+        return self.lowers[self.lower_offsets[entry_id]:self.lower_offsets[entry_id + 1]]
+
+    def name_lower(self, entry_id):
+        lower = self.lowers[self.lower_offsets[entry_id]:self.lower_offsets[entry_id + 1]]
+        return lower[lower.rfind(os.sep) + 1:]
+
+    def is_directory(self, entry_id):
+        return bool(self.flags[entry_id] & EntryStore.DIRECTORY)
+
+    def path(self, entry_id):
+        names = []
+        path = self.paths.get(entry_id)
+        while path is None:
+            names.append(self.name(entry_id))
+            entry_id = self.parents[entry_id]
+            path = self.paths.get(entry_id)
+        return os.path.join(path, *reversed(names))
+
+    def to_result(self, entry_id, score=None):
+        return Result(self.path(entry_id), self.is_directory(entry_id), score)
+
+    def get_memory_size(self):
+        arrays = (self.name_offsets, self.lower_offsets, self.parents, self.ext_lens, self.relpath_lens)
+        size = sum(a.itemsize * len(a) for a in arrays) + len(self.flags)
+        return size + sys.getsizeof(self.names) + sys.getsizeof(self.lowers)
+
+    def get_arena_stats(self):
+        # Characters and bytes of the arenas, the bytes per character grow
+        # with the widest character
+        return {
+            'names_chars': len(self.names),
+            'names_bytes': sys.getsizeof(self.names),
+            'lowers_chars': len(self.lowers),
+            'lowers_bytes': sys.getsizeof(self.lowers),
+        }
@@ -0,0 +1,164 @@
+import os
+import math
+import struct
+from time import time
+from threading import RLock
+from .. import logging
+from ..utils import lock
+
+
+class UsageStore:
+    # Opened paths with a weight that halves every HALF_LIFE (frecency). Each
+    # open is appended to a log of (time, weight, path) records, the log is
+    # rewritten with one record per path once it has COMPACT_RATIO times more
+    # records than paths. Paths that are almost forgotten are dropped then.
+    # The weights are read and updated under the lock, the file is written
+    # under the write lock only so the readers do not wait for the disk. A
+    # log that cannot be read is rewritten by the next open.
+    MAGIC = b'ULAU'
+    VERSION = 1
+    HEADER = struct.Struct('<4sH')
+    RECORD = struct.Struct('<dfH')
+    HALF_LIFE = 14 * 24 * 3600
+    COMPACT_RATIO = 4
+    MIN_RECORDS = 64
+    MIN_WEIGHT = 0.05
+    MAX_PATHS = 5000
+
+    def __init__(self, path):
+        self._path = path
+        # path -> (weight, time of the weight)
+        self._weights = {}
+        self._records = 0
+        self._loaded = False
+        self._corrupted = False
+        # Changes with every open, for the ones caching the weights
+        self.version = 0
+        self._lock = RLock()
+        self._write_lock = RLock()
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def path(self):
+        return self._path
+
+    @staticmethod
+    def _decay(weight, seconds):
+        return weight * math.pow(0.5, max(seconds, 0) / UsageStore.HALF_LIFE)
+
+    def _fold(self, timestamp, weight, path):
+        previous = self._weights.get(path)
+        if previous is not None:
+            previous_weight, previous_time = previous
+            if previous_time > timestamp:
+                weight, timestamp = UsageStore._decay(weight, previous_time - timestamp), previous_time
+            weight += UsageStore._decay(previous_weight, timestamp - previous_time)
+        self._weights[path] = (weight, timestamp)
+
+    @lock
+    def load(self):
+        self._loaded = True
+        self._weights = {}
+        self._records = 0
+        self._corrupted = False
+        try:
+            with open(self._path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            self._logger.warning('Could not load usage from {}: {}'.format(self._path, e))
+            return
+        if len(data) < UsageStore.HEADER.size or UsageStore.HEADER.unpack_from(data, 0) != (UsageStore.MAGIC, UsageStore.VERSION):
+            self._logger.warning('Could not read usage from {}, it will be rewritten'.format(self._path))
+            self._corrupted = True
+            return
+
+        # A record cut short by a crash ends the log
+        offset = UsageStore.HEADER.size
+        record_size = UsageStore.RECORD.size
+        while offset + record_size <= len(data):
+            timestamp, weight, path_size = UsageStore.RECORD.unpack_from(data, offset)
+            offset += record_size
+            if offset + path_size > len(data):
+                break
+            path = data[offset:offset + path_size].decode('utf-8', 'surrogateescape')
+            offset += path_size
+            self._fold(timestamp, weight, path)
+            self._records += 1
+
+    @staticmethod
+    def _pack(timestamp, weight, path):
+        path = path.encode('utf-8', 'surrogateescape')
+        return UsageStore.RECORD.pack(timestamp, weight, len(path)) + path
+
+    def add(self, path, now=None):
+        # Writes are done in the order of the updates
+        with self._write_lock:
+            with self._lock:
+                if not self._loaded:
+                    self.load()
+                now = time() if now is None else now
+                self._fold(now, 1.0, path)
+                self._records += 1
+                self.version += 1
+                records = None
+                if self._corrupted or (self._records > UsageStore.MIN_RECORDS and self._records > UsageStore.COMPACT_RATIO * len(self._weights)):
+                    records = self._compact(now)
+            if records is not None:
+                self._rewrite(records)
+                return
+            try:
+                os.makedirs(os.path.dirname(self._path), exist_ok=True)
+                new = not os.path.exists(self._path)
+                with open(self._path, 'ab') as f:
+                    f.write((UsageStore.HEADER.pack(UsageStore.MAGIC, UsageStore.VERSION) if new else b'') + UsageStore._pack(now, 1.0, path))
+            except OSError as e:
+                self._logger.warning('Could not save usage to {}: {}'.format(self._path, e))
+
+    def compact(self, now=None):
+        with self._write_lock:
+            with self._lock:
+                if not self._loaded:
+                    self.load()
+                records = self._compact(now)
+            self._rewrite(records)
+
+    def _compact(self, now):
+        # Returns the records of the kept paths, oldest first so appended
+        # records always come later
+        weights = self.get_weights(now)
+        kept = sorted((path for path, weight in weights.items() if weight >= UsageStore.MIN_WEIGHT), key=weights.get, reverse=True)
+        self._weights = {path: self._weights[path] for path in kept[:UsageStore.MAX_PATHS]}
+        self._records = len(self._weights)
+        self._corrupted = False
+        self.version += 1
+        return [(timestamp, weight, path) for path, (weight, timestamp) in sorted(self._weights.items(), key=lambda item: item[1][1])]
+
+    def _rewrite(self, records):
+        tmp_path = '{}.{}.tmp'.format(self._path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(UsageStore.HEADER.pack(UsageStore.MAGIC, UsageStore.VERSION))
+                for timestamp, weight, path in records:
+                    f.write(UsageStore._pack(timestamp, weight, path))
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            self._logger.warning('Could not save usage to {}: {}'.format(self._path, e))
+            try: os.remove(tmp_path)
+            except OSError: pass
+
+    @lock
+    def get_weights(self, now=None):
+        # Weights of the paths decayed to now
+        if not self._loaded:
+            self.load()
+        now = time() if now is None else now
+        return {path: UsageStore._decay(weight, now - timestamp) for path, (weight, timestamp) in self._weights.items()}
+
+    @lock
+    def __len__(self):
+        if not self._loaded:
+            self.load()
+        return len(self._weights)
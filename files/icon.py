@@ -1,24 +1,48 @@
 import os
 import re
+import json
+from collections import OrderedDict
+from itertools import islice
+from threading import RLock
+from . import logging
 from .launcher import Launcher
-from .utils import Singleton
+from .utils import lock, Singleton
 
 iconLookup = lambda _: None
+getIconThemeName = lambda: None
 if Launcher.get() == Launcher.ALBERT:
     try: from albert import iconLookup as iconLookup
     except ImportError: pass
 elif Launcher.get() == Launcher.ULAUNCHER:
-    try:
-        from gi.repository import Gtk
-        icon_theme = Gtk.IconTheme.get_default()
-        def iconLookup(icon_name):
-            icon = icon_theme.lookup_icon(icon_name, 48, 0)
-            if icon:
-                return icon.get_filename()
+    Gtk = None
+    def _import_gtk():
+        # Gtk takes a while to import, it is imported on the first lookup
+        global Gtk
+        if Gtk is None:
+            try: from gi.repository import Gtk
+            except ImportError: Gtk = False
+        return Gtk
+
+    def iconLookup(icon_name):
+        if not _import_gtk():
             return None
-    except ImportError: pass
+        icon = Gtk.IconTheme.get_default().lookup_icon(icon_name, 48, 0)
+        if icon:
+            return icon.get_filename()
+        return None
+
+    def getIconThemeName():
+        if not _import_gtk():
+            return None
+        settings = Gtk.Settings.get_default()
+        return settings.get_property('gtk-icon-theme-name') if settings else None
 
 class IconRegistry(metaclass=Singleton):
+    # Icons are resolved off the rendering path: file icons by extension when
+    # the icon pack is set, the theme's folder icons once per theme, and the
+    # folder kind of every scanned directory name after each scan. The kinds
+    # of the folder names are kept in a bounded LRU and saved with the folder
+    # icons, under the theme they were resolved with.
     ICON_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
     FOLDER_ICONS_REGEX = re.compile(
         r'^\s*'
@@ -60,41 +84,139 @@ class IconRegistry(metaclass=Singleton):
         r'(?P<folder_home>homes?)|'
         r'(?P<user_trash>(trash|bin)?)'
         r'\s*$', flags=re.IGNORECASE)
+    # Folder names whose kind is kept, '' is the kind of the plain folders
+    MAX_FOLDERS = 20000
+    VERSION = 1
 
     def __init__(self):
+        self._lock = RLock()
         self._icon_pack = None
         self._icons = {}
-        self._learned_folders = {}
+        self._use_built_in_folder_theme = False
+        # Kind of folder -> icon of the theme, resolved on first use
+        self._folder_icons = None
+        # Lowercase folder name -> kind of folder
+        self._folder_kinds = OrderedDict()
+        self._cache_path = None
+        self._cache_key = None
+        self._changed = False
+        self._logger = logging.getLogger(__name__)
 
+    @lock
     def get_icon(self, result):
         default = self._icons.get('default')
         if not result.is_directory:
-            if not result.ext:
+            ext = result.ext
+            if not ext:
                 return default
-            return self._icons.get(result.ext[1:], default)
-        
-        result_name = result.name
-        result_name_lower = result_name.lower()
+            return self._icons.get(ext[1:].lower(), default)
 
         if self._use_built_in_folder_theme:
             return self._icons.get('folder', default)
 
-        icon = self._learned_folders.get(result_name_lower)
-        if icon:
-            return icon
+        if self._folder_icons is None:
+            self._load_folder_icons()
+        name = result.name.lower()
+        kind = self._folder_kinds.get(name)
+        if kind is None:
+            kind = self._add_folder(name)
+        else:
+            self._folder_kinds.move_to_end(name)
+        return self._folder_icons.get(kind) or self._folder_icons['']
 
-        icon_name_match = IconRegistry.FOLDER_ICONS_REGEX.match(result_name_lower)
+    @staticmethod
+    def _get_folder_kind(name_lower):
+        icon_name_match = IconRegistry.FOLDER_ICONS_REGEX.match(name_lower)
         if icon_name_match:
-            icon_name_dict = icon_name_match.groupdict()
-            for key, value in icon_name_dict.items():
-                if value is None:
-                    continue
-                icon = iconLookup(key.replace('_', '-'))
-                break
+            for key, value in icon_name_match.groupdict().items():
+                if value is not None:
+                    return key
+        return ''
 
-        icon = icon or iconLookup('folder') or self._icons.get('folder', default)
-        self._learned_folders[result_name_lower] = icon
-        return icon
+    def _add_folder(self, name_lower):
+        kind = self._folder_kinds[name_lower] = IconRegistry._get_folder_kind(name_lower)
+        if len(self._folder_kinds) > IconRegistry.MAX_FOLDERS:
+            self._folder_kinds.popitem(last=False)
+        self._changed = True
+        return kind
+
+    def add_folders(self, names):
+        # Resolves the kinds of the folder names ahead of the searches. Only
+        # the names that are not known yet are matched, without the lock, and
+        # only while there is room: a full LRU is left to the searches rather
+        # than evicting the names they use.
+        with self._lock:
+            if self._use_built_in_folder_theme:
+                return
+            if self._folder_icons is None:
+                self._load_folder_icons()
+            room = IconRegistry.MAX_FOLDERS - len(self._folder_kinds)
+            folder_kinds = self._folder_kinds
+            names = list(islice((name for name in names if name not in folder_kinds), max(room, 0)))
+        if names:
+            kinds = [(name, IconRegistry._get_folder_kind(name)) for name in names]
+            with self._lock:
+                for name, kind in kinds:
+                    if len(self._folder_kinds) >= IconRegistry.MAX_FOLDERS:
+                        break
+                    if name not in self._folder_kinds:
+                        self._folder_kinds[name] = kind
+                        self._changed = True
+        self.save()
+
+    def _get_cache_key(self):
+        return '{} {} {}'.format(Launcher.get_name(), self._icon_pack, getIconThemeName())
+
+    def _resolve_folder_icons(self):
+        folder = iconLookup('folder') or self._icons.get('folder', self._icons.get('default'))
+        folder_icons = {'': folder}
+        for key in IconRegistry.FOLDER_ICONS_REGEX.groupindex:
+            folder_icons[key] = iconLookup(key.replace('_', '-')) or folder
+        return folder_icons
+
+    def _load_folder_icons(self):
+        self._cache_key = self._get_cache_key()
+        if self._cache_path is not None:
+            try:
+                with open(self._cache_path) as f:
+                    data = json.load(f)
+                if data.get('version') == IconRegistry.VERSION:
+                    folder_kinds = OrderedDict(data['folders'])
+                    folder_icons = data['icons']
+                    # Icons of another theme, or gone with an update of the theme, are resolved again
+                    if data['key'] == self._cache_key and all(icon is None or os.path.isfile(icon) for icon in folder_icons.values()):
+                        self._folder_icons = folder_icons
+                    if not self._folder_kinds:
+                        self._folder_kinds = folder_kinds
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self._logger.warning('Could not load the icons from {}: {}'.format(self._cache_path, e))
+        if self._folder_icons is None:
+            self._folder_icons = self._resolve_folder_icons()
+            self._changed = True
+
+    @lock
+    def save(self):
+        if not self._changed or self._cache_path is None or self._folder_icons is None:
+            return
+        self._changed = False
+        data = {
+            'version': IconRegistry.VERSION,
+            'key': self._cache_key,
+            'icons': self._folder_icons,
+            'folders': list(self._folder_kinds.items()),
+        }
+        tmp_path = '{}.{}.tmp'.format(self._cache_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self._cache_path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self._cache_path)
+        except OSError as e:
+            self._logger.warning('Could not save the icons to {}: {}'.format(self._cache_path, e))
+            try: os.remove(tmp_path)
+            except OSError: pass
 
     @staticmethod
     def _get_icons(icon_pack_path):
@@ -105,9 +227,10 @@ class IconRegistry(metaclass=Singleton):
             icon_name, icon_ext = os.path.splitext(icon_file_name)
             if icon_ext not in exts:
                 continue
-            icons[icon_name] = icon_path
+            icons[icon_name.lower()] = icon_path
         return icons
 
+    @lock
     def set_icon_pack(self, icon_pack):
         icon_pack_path = os.path.join(IconRegistry.ICON_DIR, 'images', icon_pack)
         if not os.path.isdir(icon_pack_path):
@@ -117,7 +240,17 @@ class IconRegistry(metaclass=Singleton):
         directories_icon_pack_path = os.path.join(IconRegistry.ICON_DIR, 'images', 'extra')
         if os.path.isdir(directories_icon_pack_path):
             icons = {**icons, **IconRegistry._get_icons(directories_icon_pack_path)}
+        self._icon_pack = icon_pack
         self._icons = icons
+        # The folder icons fall back on the pack's
+        self._folder_icons = None
 
+    @lock
     def set_use_built_in_folder_theme(self, use_built_in_folder_theme):
-        self._use_built_in_folder_theme = use_built_in_folder_theme
\ No newline at end of file
+        self._use_built_in_folder_theme = use_built_in_folder_theme
+
+    @lock
+    def set_cache_path(self, cache_path):
+        if cache_path != self._cache_path:
+            self._cache_path = cache_path
+            self._folder_icons = None
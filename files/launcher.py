@@ -14,3 +14,11 @@ class Launcher:
     @classmethod
     def get(cls):
         return cls._launcher
+
+    @classmethod
+    def get_name(cls):
+        if cls._launcher == cls.ALBERT:
+            return 'albert'
+        if cls._launcher == cls.ULAUNCHER:
+            return 'ulauncher'
+        return None
@@ -1,76 +1,246 @@
 import os
 import re
-from pathspec import PathSpec
 import fnmatch
-from pathspec.patterns import GitWildMatchPattern
+from threading import Lock
 from . import logging
 
+PathSpec = GitWildMatchPattern = normalize_file = None
+_pathspec_lock = Lock()
+
+def _import_pathspec():
+    # pathspec takes a while to import and is only needed for ignore files.
+    # normalize_file is set last, the others are set once it is.
+    global PathSpec, GitWildMatchPattern, normalize_file
+    if normalize_file is not None:
+        return
+    with _pathspec_lock:
+        if normalize_file is None:
+            from pathspec import PathSpec as path_spec
+            from pathspec.patterns import GitWildMatchPattern as pattern
+            from pathspec.util import normalize_file as normalize
+            PathSpec, GitWildMatchPattern = path_spec, pattern
+            normalize_file = normalize
+
 class Ignore:
     IGNORE_FILENAME = None
     _logger = logging.getLogger(__name__)
+    # Compiled ignore files: path -> (mtime_ns, size, patterns)
+    _compiled = {}
 
-    def __init__(self, pathspec, match_str):
-        self.match_str = match_str
-        self._pathspec = pathspec
+    def __init__(self, patterns, parent=None):
+        # Patterns of a single ignore file, last one first. The parent is
+        # asked when none of them matches, the result is the same as with
+        # the concatenated files where the last matching pattern wins.
+        self._patterns = patterns
+        self._parent = parent
 
     @classmethod
     def set_ignore_filename(cls, ignore_filename):
         cls.IGNORE_FILENAME = ignore_filename
+        cls._compiled = {}
     
     def should_include(self, value):
         return self(value)
 
     def __call__(self, value):
-        if self._pathspec is None or self.match_str == '':
+        # Matchers with patterns come from compiled ignore files, pathspec is imported then
+        if not self._patterns and self._parent is None:
             return True
-        return not self._pathspec.match_file(value)
+        matcher = self
+        value = normalize_file(value)
+        while matcher is not None:
+            for regex, include in matcher._patterns:
+                if regex.match(value) is not None:
+                    return not include
+            matcher = matcher._parent
+        return True
 
     @staticmethod
     def get_root_matcher():
-        return Ignore(None, '')
+        return Ignore(())
+
+    @staticmethod
+    def _compile(ignore_path):
+        # Ignore files are compiled once and again only when they change
+        stat = os.stat(ignore_path)
+        compiled = Ignore._compiled.get(ignore_path)
+        if compiled is not None and compiled[0] == stat.st_mtime_ns and compiled[1] == stat.st_size:
+            return compiled[2]
+        with open(ignore_path, 'r') as f:
+            match_str = f.read()
+        _import_pathspec()
+        pathspec = PathSpec.from_lines(GitWildMatchPattern, match_str.splitlines())
+        patterns = tuple(
+            (pattern.regex, pattern.include)
+            for pattern in reversed(list(pathspec.patterns)) if pattern.include is not None
+        )
+        Ignore._compiled[ignore_path] = (stat.st_mtime_ns, stat.st_size, patterns)
+        return patterns
 
     @staticmethod
     def get_matcher(directory, file_names, parent_matcher):
+        parent_matcher = parent_matcher or Ignore.get_root_matcher()
         if Ignore.IGNORE_FILENAME not in file_names:
-            return parent_matcher or Ignore.get_root_matcher()
-        try:
-            albertignore_path = os.path.join(directory, Ignore.IGNORE_FILENAME)
-            with open(albertignore_path, 'r') as f:
-                match_str = f.read()
-        except Exception as e:
-            Ignore._logger('Got exception when reading ignore file {}: {}'.format(albertignore_path, e))
-            return parent_matcher or Ignore.get_root_matcher()
+            return parent_matcher
+        ignore_path = os.path.join(directory, Ignore.IGNORE_FILENAME)
         try:
-            if parent_matcher.match_str:
-                match_str = parent_matcher.match_str + '\n' + match_str
-            pathspec = PathSpec.from_lines(GitWildMatchPattern, match_str.splitlines())
+            patterns = Ignore._compile(ignore_path)
         except Exception as e:
-            Ignore._logger('Got exception when creating pathspec matcher with str {}: {}'.format(match_str, e))
-            return parent_matcher or Ignore.get_root_matcher()
-        
-        return Ignore(pathspec, match_str)
+            Ignore._logger.warning('Got exception when reading ignore file {}: {}'.format(ignore_path, e))
+            return parent_matcher
+        if not patterns:
+            return parent_matcher
+        return Ignore(patterns, parent_matcher)
 
 
 class Match:
+    PATTERN_CHARS = set('*?[')
+
     def __init__(self, value):
         value = value.strip()
-        if not value:
-            self._matcher = None
-            self._matcher_ignorecase = None
-            return
-        value = fnmatch.translate(value)
+        self._value = value
+        self._value_lower = value.lower()
+        self._matcher = None
+        self._matcher_ignorecase = None
+        self.is_plain = not Match.is_pattern(value)
+        # Every match contains the literals and ends with the suffix
+        self.literals, self.suffix = Match.get_literals(value)
+
+    @staticmethod
+    def is_pattern(value):
+        return any(c in Match.PATTERN_CHARS for c in value)
+
+    @staticmethod
+    def get_literals(value):
+        # Returns (literals, suffix), the parts of the pattern outside of
+        # wildcards and character sets, and the literal end of the pattern
+        literals = []
+        start = 0
+        i = 0
+        n = len(value)
+        while i < n:
+            c = value[i]
+            if c not in Match.PATTERN_CHARS:
+                i += 1
+                continue
+            if start < i:
+                literals.append(value[start:i])
+            i += 1
+            if c == '[':
+                # Same rules as fnmatch, a lone [ is kept as a wildcard here
+                j = i
+                if j < n and value[j] == '!':
+                    j += 1
+                if j < n and value[j] == ']':
+                    j += 1
+                while j < n and value[j] != ']':
+                    j += 1
+                if j < n:
+                    i = j + 1
+            start = i
+        suffix = ''
+        if start < n:
+            suffix = value[start:]
+            literals.append(suffix)
+        return literals, suffix
+
+    def _compile(self):
+        value = fnmatch.translate(self._value)
         self._matcher = re.compile(value)
         self._matcher_ignorecase = re.compile(value, flags=re.IGNORECASE)
 
     def matches(self, value):
-        if not self._matcher:
+        if not self._value:
             return False
+        if self.is_plain:
+            return value == self._value
+        if self._matcher is None:
+            self._compile()
         return self._matcher.match(value) is not None
 
     def matches_ignorecase(self, value):
-        if not self._matcher_ignorecase:
+        if not self._value:
             return False
+        if self.is_plain:
+            return value.lower() == self._value_lower
+        if self._matcher_ignorecase is None:
+            self._compile()
         return self._matcher_ignorecase.match(value) is not None
 
     def __call__(self, value, ignorecase=False):
         return self.matches(value) if not ignorecase else self.matches_ignorecase(value)
+
+
+class FuzzyMatch:
+    # fzf like matching of the query as a subsequence. The shortest window
+    # ending at the first match is scored: every character scores, more at
+    # the start of a word or right after the previous one, gaps cost. The
+    # score is normalized to (0, 1], 0 when the query is not a subsequence.
+    SCORE_MATCH = 16
+    SCORE_GAP_START = -3
+    SCORE_GAP_EXTENSION = -1
+    BONUS_BOUNDARY = 8
+    BONUS_CONSECUTIVE = 4
+    BOUNDARY_CHARS = set('/_-. ')
+    _bits = {}
+
+    def __init__(self, value):
+        self.value = value
+        self.mask = FuzzyMatch.get_mask(value)
+        self._max_score = len(value) * (FuzzyMatch.SCORE_MATCH + FuzzyMatch.BONUS_BOUNDARY)
+
+    @staticmethod
+    def get_bit(c):
+        # Letters and digits have their own bit, other characters share the rest
+        bit = FuzzyMatch._bits.get(c)
+        if bit is None:
+            if 'a' <= c <= 'z':
+                bit = 1 << (ord(c) - 97)
+            elif '0' <= c <= '9':
+                bit = 1 << (ord(c) - 22)
+            else:
+                bit = 1 << (36 + ord(c) % 28)
+            FuzzyMatch._bits[c] = bit
+        return bit
+
+    @staticmethod
+    def get_mask(value):
+        mask = 0
+        for c in set(value):
+            mask |= FuzzyMatch.get_bit(c)
+        return mask
+
+    def score(self, text, start, end):
+        # Scores text[start:end] without slicing it
+        value = self.value
+        if not value:
+            return 0
+        find = text.find
+        pos = start
+        for c in value:
+            pos = find(c, pos, end)
+            if pos < 0:
+                return 0
+            pos += 1
+        last = pos
+        rfind = text.rfind
+        for c in reversed(value):
+            pos = rfind(c, start, pos)
+
+        boundary_chars = FuzzyMatch.BOUNDARY_CHARS
+        score = 0
+        prev = -1
+        for c in value:
+            pos = find(c, pos, last)
+            if pos == start or text[pos - 1] in boundary_chars:
+                bonus = FuzzyMatch.BONUS_BOUNDARY
+            elif pos == prev + 1:
+                bonus = FuzzyMatch.BONUS_CONSECUTIVE
+            else:
+                bonus = 0
+            if prev >= 0 and pos > prev + 1:
+                score += FuzzyMatch.SCORE_GAP_START + FuzzyMatch.SCORE_GAP_EXTENSION * (pos - prev - 2)
+            score += FuzzyMatch.SCORE_MATCH + bonus
+            prev = pos
+            pos += 1
+        return max(score, 1) / self._max_score
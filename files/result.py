@@ -23,4 +23,25 @@ class Result:
         return str(self)
 
     def __hash__(self):
-        return hash(self.path)
\ No newline at end of file
+        return hash(self.path)
+
+class StatResult(Result):
+    # A line of the statistics, shown in place of files
+    def __init__(self, name, description):
+        super().__init__(None, False, None)
+        self._name = name
+        self.description = description
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def ext(self):
+        return None
+
+    def __str__(self):
+        return '{}: {}'.format(self.name, self.description)
+
+    def __hash__(self):
+        return hash(self.name)
@@ -0,0 +1,206 @@
+from time import time
+from threading import Condition, Thread
+from . import logging
+
+
+class ScanScheduler:
+    # Runs the scans in one worker thread. Every root is refreshed on its own
+    # interval after its last scan. Requests wait DEBOUNCE_SECONDS for more
+    # requests, MAX_DELAY_SECONDS at most, and are merged into the roots to
+    # scan, None for all of them. Due roots are scanned together by priority,
+    # the highest first. A refresh is given up once when a root of a higher
+    # priority is due, and roots of the scan in progress that are requested
+    # again or cancelled are given up by it.
+    # on_scan(root_paths, periodic, is_cancelled) runs the scans.
+    DEBOUNCE_SECONDS = 1.0
+    MAX_DELAY_SECONDS = 5.0
+
+    def __init__(self, on_scan):
+        self._on_scan = on_scan
+        self._condition = Condition()
+        self._thread = None
+        self._running = False
+        # root_path -> (interval seconds, priority), and when roots are due
+        self._roots = {}
+        self._refresh_at = {}
+        # Requested roots, None for all of them, and when to scan them
+        self._requested = False
+        self._pending = None
+        self._pending_at = None
+        self._requested_at = None
+        # Requested roots left for after roots of a higher priority
+        self._deferred = set()
+        # Roots of the scan in progress and the ones given up
+        self._scanning = None
+        self._cancelled = set()
+        self._cancelled_all = False
+        self._given_up = set()
+        # Refreshes are given up for a higher priority root once, then finish
+        self._preempt_at = None
+        self._preempted = set()
+        self._logger = logging.getLogger(__name__)
+
+    def start(self):
+        with self._condition:
+            self._running = True
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='files-scheduler', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._requested = False
+            self._deferred = set()
+            self._cancel(None)
+            self._condition.notify_all()
+
+    def set_roots(self, roots):
+        # root_path -> (interval seconds, priority), roots are not refreshed
+        # when their interval is not above 0
+        now = time()
+        with self._condition:
+            refresh_at = {}
+            for root_path, (interval, _) in roots.items():
+                previous = self._roots.get(root_path)
+                if previous is not None and previous[0] == interval:
+                    refresh_at[root_path] = self._refresh_at.get(root_path)
+                else:
+                    refresh_at[root_path] = now + interval if interval > 0 else None
+            self._roots = dict(roots)
+            self._refresh_at = refresh_at
+            self._preempted &= set(roots)
+            self._condition.notify_all()
+
+    def request(self, root_paths=None, delay=DEBOUNCE_SECONDS):
+        now = time()
+        with self._condition:
+            if not self._requested:
+                self._requested = True
+                self._pending = None if root_paths is None else set(root_paths)
+                self._requested_at = now
+            elif self._pending is not None:
+                if root_paths is None:
+                    self._pending = None
+                else:
+                    self._pending.update(root_paths)
+            self._pending_at = min(now + delay, self._requested_at + ScanScheduler.MAX_DELAY_SECONDS)
+            self._cancel(root_paths)
+            self._condition.notify_all()
+
+    def cancel(self, root_paths=None):
+        # Gives up the scan of the roots in progress, None for all of them
+        with self._condition:
+            self._cancel(root_paths)
+
+    def _cancel(self, root_paths):
+        if self._scanning is None:
+            return
+        if root_paths is None:
+            self._cancelled_all = True
+        else:
+            self._cancelled.update(root_paths)
+
+    def is_cancelled(self, root_path):
+        # Called by the scan, which gives up the root when it is
+        preempt_at = self._preempt_at
+        if (self._cancelled_all or root_path in self._cancelled or
+                (preempt_at is not None and root_path not in self._preempted and time() >= preempt_at)):
+            self._given_up.add(root_path)
+            return True
+        return False
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                'pending': self._requested,
+                'pending_roots': None if self._pending is None else sorted(self._pending),
+                'scanning': None if self._scanning is None else sorted(self._scanning),
+                'refresh_at': dict(self._refresh_at),
+            }
+
+    def _get_priority(self, root_path):
+        return self._roots.get(root_path, (0, 0))[1]
+
+    def _next(self):
+        # Returns (root_paths, periodic) of the next scan once it is due
+        with self._condition:
+            while True:
+                if not self._running:
+                    self._thread = None
+                    return None
+                now = time()
+                due = [at for at in self._refresh_at.values() if at is not None]
+                if self._requested:
+                    due.append(self._pending_at)
+                due = min(due, default=None)
+                if due is not None and due <= now:
+                    break
+                self._condition.wait(None if due is None else due - now)
+
+            requested = set()
+            if self._requested and self._pending_at <= now:
+                requested = set(self._roots) if self._pending is None else self._pending & set(self._roots)
+                full = self._pending is None
+                self._requested = False
+                self._pending = None
+                if full and not self._roots:
+                    return self._start_scan(None, False, now)
+                if not requested:
+                    # Only removed roots, the scan drops them
+                    return self._start_scan(set(), False, now)
+            requested |= self._deferred & set(self._roots)
+            due_roots = {root_path for root_path, at in self._refresh_at.items() if at is not None and at <= now}
+            candidates = requested | due_roots
+            priority = max(self._get_priority(root_path) for root_path in candidates)
+            root_paths = {root_path for root_path in candidates if self._get_priority(root_path) == priority}
+            # Requested roots of lower priorities are due next
+            self._deferred = requested - root_paths
+            for root_path in self._deferred:
+                self._refresh_at[root_path] = now
+            return self._start_scan(root_paths, not root_paths & requested, now)
+
+    def _start_scan(self, root_paths, periodic, now):
+        self._scanning = root_paths if root_paths is not None else set(self._roots)
+        self._cancelled = set()
+        self._cancelled_all = False
+        self._given_up = set()
+        self._preempt_at = None
+        if periodic:
+            priority = max(self._get_priority(root_path) for root_path in self._scanning)
+            self._preempt_at = min((
+                at for root_path, at in self._refresh_at.items()
+                if at is not None and self._get_priority(root_path) > priority
+            ), default=None)
+        for root_path in self._scanning:
+            self._refresh_at[root_path] = None
+        if root_paths is not None and root_paths == set(self._roots):
+            root_paths = None
+        return root_paths, periodic
+
+    def _run(self):
+        while True:
+            scan = self._next()
+            if scan is None:
+                return
+            root_paths, periodic = scan
+            try:
+                self._on_scan(root_paths, periodic, self.is_cancelled)
+            except Exception as e:
+                self._logger.warning('Scan failed: {}'.format(e))
+            now = time()
+            with self._condition:
+                for root_path in self._scanning:
+                    if root_path not in self._roots:
+                        continue
+                    interval = self._roots[root_path][0]
+                    if root_path in self._given_up:
+                        # Scanned again right away, a preempted one to the end this time
+                        if not self._cancelled_all and root_path not in self._cancelled:
+                            self._preempted.add(root_path)
+                        self._refresh_at[root_path] = now
+                        continue
+                    self._preempted.discard(root_path)
+                    self._refresh_at[root_path] = now + interval if interval > 0 else None
+                self._scanning = None
+                self._preempt_at = None
@@ -1,86 +1,268 @@
-from files.cache.search_results import SearchResults
 import os
 from time import time
 from configparser import ConfigParser, MissingSectionHeaderError
-from threading import RLock, Timer
+from queue import Queue
+from threading import Condition, RLock, Thread
 from . import logging
 from .launcher import Launcher
 from .icon import IconRegistry
 from .cache import Cache
-from .utils import lock, type_or_default, Singleton
+from .watcher import FilesWatcher
+from .scheduler import ScanScheduler
+from .result import StatResult
+from .utils import lock, type_or_default, get_cache_dir, Singleton
 
 class FilesService(metaclass=Singleton):
+    # Shows the statistics instead of searching
+    STATS_QUERY = '?:stats'
+
     def __init__(self):
         self._scan_every_minutes = 15
+        # Scan interval minutes, None for SCAN_EVERY_MINUTES, and priority of the directories
+        self._directories = {}
         self._lock = RLock()
         self._running = False
-        self._thread_id = 0
+        self._watch_filesystem = False
         self._logger = logging.getLogger(__name__)
+        self._scheduler = ScanScheduler(self._scan)
+        # Query of search_latest waiting for the search worker
+        self._search_condition = Condition()
+        self._search_request = None
+        self._search_thread = None
+        FilesWatcher().set_on_error(self._on_watch_error)
 
-    @lock
-    def _run_thread(self, thread_id):
-        if self._thread_id != thread_id:
-            return
-        if self._scan_every_minutes <= 0 or not self._running:
-            self._running = False
+    def _scan(self, root_paths, periodic, is_cancelled):
+        # Runs in the scheduler's worker, without the lock so settings and
+        # searches are not blocked. Periodic scans are only needed when the
+        # watcher is not keeping up the index.
+        with self._lock:
+            if not self._running or (periodic and self._watch_filesystem and FilesWatcher().watching):
+                return
+        if Cache().scan(root_paths, is_cancelled):
+            self._watch()
+            IconRegistry().add_folders(Cache().get_directory_names())
+
+    def _schedule(self):
+        self._scheduler.set_roots({
+            path: (60.0 * (self._scan_every_minutes if minutes is None else minutes), priority)
+            for path, (minutes, priority) in self._directories.items()
+        })
+
+    def _request_scan(self, root_paths=None, delay=ScanScheduler.DEBOUNCE_SECONDS):
+        # Settings changes scan the roots they affect once they settle.
+        # Scanning is off with SCAN_EVERY_MINUTES at 0 or lower, except for
+        # the roots with their own interval.
+        if not self._running:
             return
-        Cache().scan()
-        thread = Timer(self._scan_every_minutes * 60.0, self._run_thread, args=(thread_id,))
-        thread.setDaemon(True)
-        thread.start()
+        if self._scan_every_minutes <= 0:
+            root_paths = [
+                path for path in (self._directories if root_paths is None else root_paths)
+                if self._directories.get(path, (None, 0))[0] is not None
+            ]
+            if not root_paths:
+                return
+        self._scheduler.request(root_paths, delay)
 
-    @lock
-    def search(self, search_value):
-        return Cache().search(search_value)
+    def _watch(self):
+        with self._lock:
+            watch_filesystem = self._watch_filesystem and self._running
+        if watch_filesystem:
+            FilesWatcher().watch(Cache().get_directories())
+
+    def _on_watch_error(self):
+        with self._lock:
+            self._request_scan(delay=0.0)
+
+    def search(self, search_value, on_results=None):
+        if search_value.strip() == FilesService.STATS_QUERY:
+            return self.get_stats_results()
+        return Cache().search(search_value, on_results)
+
+    def search_latest(self, search_value):
+        # For launchers that search from a thread for each query: the
+        # searches run one at a time in a worker, a newer query cancels the
+        # running one and replaces the waiting one, which return None.
+        found = Queue()
+        Cache().cancel_search()
+        with self._search_condition:
+            if self._search_request is not None:
+                self._search_request[1].put(None)
+            self._search_request = (search_value, found)
+            if self._search_thread is None:
+                self._search_thread = Thread(target=self._search_worker, name='files-search', daemon=True)
+                self._search_thread.start()
+            self._search_condition.notify()
+        return found.get()
+
+    def _search_worker(self):
+        while True:
+            with self._search_condition:
+                while self._search_request is None:
+                    self._search_condition.wait()
+                search_value, found = self._search_request
+                self._search_request = None
+            try:
+                found.put(self.search(search_value))
+            except Exception as e:
+                self._logger.warning('Search failed: {}'.format(e))
+                found.put([])
+
+    def get_stats(self):
+        stats = Cache().get_stats()
+        with self._lock:
+            stats['service'] = {
+                'running': self._running,
+                'scan_every_minutes': self._scan_every_minutes,
+                'watch_filesystem': self._watch_filesystem,
+                'watching': FilesWatcher().watching,
+                'scheduler': self._scheduler.get_stats(),
+                'directories': {
+                    path: {'scan_every_minutes': self._scan_every_minutes if minutes is None else minutes, 'priority': priority}
+                    for path, (minutes, priority) in self._directories.items()
+                },
+            }
+        return stats
+
+    def get_stats_results(self):
+        stats = self.get_stats()
+        results = []
+        scan = stats['scan']
+        if scan is None:
+            results.append(StatResult('Not scanned yet', 'Watching' if stats['service']['watching'] else ''))
+        else:
+            results.append(StatResult(
+                'Last scan took {:.2f}s'.format(scan['seconds']),
+                'Walk {:.2f}s, ignore {:.2f}s, entries {:.2f}s, index {:.2f}s'.format(
+                    scan['walk_seconds'], scan['ignore_seconds'], scan['entries_seconds'], scan['index_seconds']
+                )
+            ))
+            results.append(StatResult(
+                '{} directories and {} files'.format(scan['directories'], scan['files']),
+                '{} directories pruned, {} unchanged, {} roots kept from the last scan'.format(scan['pruned'], scan['unchanged'], scan['carried'])
+            ))
+
+        index = stats['index']
+        results.append(StatResult(
+            'Index of {} entries'.format(index['entries']),
+            'Store {:.1f}MB, n-grams {:.1f}MB, {} added and {} removed since the scan, {} opened recently'.format(
+                index['store_bytes'] / 2 ** 20, index['index_bytes'] / 2 ** 20, index['added'], index['removed'], index['used']
+            )
+        ))
+        if scan is not None:
+            directories = stats['service']['directories']
+            for root_path, entries in scan['roots'].items():
+                directory = directories.get(root_path)
+                if directory is None:
+                    results.append(StatResult('{} entries'.format(entries), root_path))
+                    continue
+                results.append(StatResult('{} entries'.format(entries), '{}, every {:g} minutes, priority {}'.format(
+                    root_path, directory['scan_every_minutes'], directory['priority'])))
+
+        search = stats['search']
+        latencies = search['latencies']['all']
+        results_cache = search['results_cache']
+        results.append(StatResult(
+            '{} searches, p50 {:.2f}ms, p99 {:.2f}ms'.format(latencies['count'], latencies['p50_ms'], latencies['p99_ms']),
+            'Max {:.2f}ms, {:.0%} cached, {:.0%} from a previous query, {} replaced by a newer query'.format(
+                latencies['max_ms'], results_cache['hit_ratio'], results_cache['prefix_hit_ratio'], search['cancelled']
+            )
+        ))
+        results.append(StatResult(
+            'Search latencies',
+            ', '.join('{}: {}'.format(bucket, count) for bucket, count in latencies['buckets'].items() if count)
+        ))
+        return results
 
     @lock
     def run(self, force=False):
         if self._running and not force:
             return
         self._running = True
-        self._thread_id += 1
-        thread = Timer(0.0, self._run_thread, args=(self._thread_id,))
-        thread.setDaemon(True)
-        thread.run()
+        self._schedule()
+        self._scheduler.start()
+        # Startup does not wait for the index, it is loaded or scanned in the background
+        thread = Thread(target=self._start_thread, daemon=True)
+        thread.start()
+
+    def _start_thread(self):
+        # Serve the saved index right away, then refresh it
+        if Cache().load():
+            IconRegistry().add_folders(Cache().get_directory_names())
+        with self._lock:
+            self._request_scan(delay=0.0)
+
+    @staticmethod
+    def _get_index_path():
+        return os.path.join(get_cache_dir(), '{}.index'.format(Launcher.get_name() or 'files'))
+
+    @staticmethod
+    def _get_usage_path():
+        return os.path.join(get_cache_dir(), '{}.usage'.format(Launcher.get_name() or 'files'))
+
+    @staticmethod
+    def _get_icons_path():
+        return os.path.join(get_cache_dir(), '{}.icons'.format(Launcher.get_name() or 'files'))
+
+    def record_open(self, path):
+        Cache().record_open(path)
 
     @lock
     def stop(self):
         self._running = False
+        self._scheduler.stop()
+        FilesWatcher().stop()
+        Cache().stop()
+        IconRegistry().save()
     
     @lock
     def set_scan_every_minutes(self, scan_every_minutes, _set=True):
         scan_every_minutes = type_or_default(scan_every_minutes, float, 15)
         if _set:
             self._logger.info('Updating SCAN_EVERY_MINUTES to {}'.format(scan_every_minutes))
+            enabled = self._scan_every_minutes <= 0 < scan_every_minutes
             self._scan_every_minutes = scan_every_minutes
-            SearchResults.KEEP_FOR = scan_every_minutes * 60
-            self.run(force=True)
+            self._schedule()
+            if enabled:
+                self._request_scan()
         return scan_every_minutes
 
     @lock
     def set_directories(self, directories, _set=True):
+        # A directory in each line as path=depth:minutes:priority, the
+        # options are optional, e.g. ~/Downloads=:1:10
         paths = []
         depths = []
+        options = {}
         for path in directories.splitlines():
             path = path.strip()
             path = path.rsplit('=', 1)
             if len(path) == 2:
-                path, depth = path
-                depth = depth.strip()
+                path, values = path
+                values = values.split(':')
             else:
-                path, depth = path[0], 0
+                path, values = path[0], []
             path = path.strip()
             path = os.path.expanduser(path)
             path = os.path.abspath(path)
             paths.append(path)
 
-            depth = type_or_default(depth, int, 0)
+            depth = type_or_default(values[0].strip() if values else 0, int, 0)
             depths.append(depth)
+            minutes = type_or_default(values[1] if len(values) > 1 else None, float, None)
+            priority = type_or_default(values[2] if len(values) > 2 else 0, int, 0)
+            options[path] = (minutes, priority)
         if _set:
             self._logger.info('Updating DIRECTORIES to {}'.format(directories))
+            # Only new roots and roots with a new depth are scanned, the
+            # entries of the others are kept and the removed ones dropped
+            previous = Cache().get_paths()
             Cache().set_paths(paths, depths)
-            self.run(force=True)
-        return paths, depths
+            self._directories = options
+            self._schedule()
+            FilesWatcher().retry()
+            self._scheduler.cancel()
+            self._request_scan([path for path, depth in zip(paths, depths) if previous.get(path) != depth])
+        return paths, depths, options
 
     @lock
     def set_search_after_characters(self, search_after_characters, _set=True):
@@ -107,6 +289,23 @@ class FilesService(metaclass=Singleton):
             Cache().set_search_threshold(search_threshold)
         return search_threshold
 
+    @lock
+    def set_search_processes(self, search_processes, _set=True):
+        search_processes = type_or_default(search_processes, int, 0)
+        if _set:
+            self._logger.info('Updating SEARCH_PROCESSES to {}'.format(search_processes))
+            Cache().set_search_processes(search_processes)
+        return search_processes
+
+    @lock
+    def set_search_fuzzy(self, search_fuzzy, _set=True):
+        search_fuzzy = (search_fuzzy or '').strip() or 'false'
+        search_fuzzy = search_fuzzy.lower() == 'true'
+        if _set:
+            self._logger.info('Updating FUZZY_SEARCH to {}'.format(search_fuzzy))
+            Cache().set_search_fuzzy(search_fuzzy)
+        return search_fuzzy
+
     @lock
     def set_ignore_filename(self, ignore_filename, _set=True):
         fallback = None
@@ -117,7 +316,9 @@ class FilesService(metaclass=Singleton):
         if _set:
             self._logger.info('Updating IGNORE_FILENAME to {}'.format(ignore_filename))
             Cache().set_ignore_filename(ignore_filename)
-            self.run(force=True)
+            FilesWatcher().retry()
+            self._scheduler.cancel()
+            self._request_scan()
         return ignore_filename
 
     @lock
@@ -137,11 +338,26 @@ class FilesService(metaclass=Singleton):
             IconRegistry().set_use_built_in_folder_theme(use_built_in_folder_theme)
         return use_built_in_folder_theme
         
+    @lock
+    def set_watch_filesystem(self, watch_filesystem, _set=True):
+        watch_filesystem = (watch_filesystem or '').strip() or 'false'
+        watch_filesystem = watch_filesystem.lower() == 'true'
+        if _set:
+            self._logger.info('Updating WATCH_FILESYSTEM to {}'.format(watch_filesystem))
+            self._watch_filesystem = watch_filesystem
+            if watch_filesystem:
+                FilesWatcher().retry()
+                self._watch()
+            else:
+                FilesWatcher().stop()
+        return watch_filesystem
+
     @lock
     def load_settings_ulauncher(self, scan_every_minutes, directories,
                                 search_after_characters, search_max_results,
                                 search_threshold, ignore_filename, icon_theme,
-                                use_built_in_folder_theme):
+                                use_built_in_folder_theme, watch_filesystem, search_processes,
+                                search_fuzzy):
         
         self._logger.info('Loading settings')
         now = time()
@@ -150,11 +366,16 @@ class FilesService(metaclass=Singleton):
         search_max_results = self.set_search_max_results(search_max_results, _set=False)
         search_threshold = self.set_search_threshold(search_threshold, _set=False)
         ignore_filename = self.set_ignore_filename(ignore_filename, _set=False)
-        paths, depths = self.set_directories(directories, _set=False)
+        paths, depths, options = self.set_directories(directories, _set=False)
         icon_theme = self.set_icon_theme(icon_theme, _set=False)
         use_built_in_folder_theme = self.set_use_built_in_folder_theme(use_built_in_folder_theme, _set=False)
+        watch_filesystem = self.set_watch_filesystem(watch_filesystem, _set=False)
+        search_processes = self.set_search_processes(search_processes, _set=False)
+        search_fuzzy = self.set_search_fuzzy(search_fuzzy, _set=False)
 
         self._scan_every_minutes = scan_every_minutes
+        self._watch_filesystem = watch_filesystem
+        self._directories = options
         time_elapsed = 1000 * (time() - now)
         self._logger.info(
             'Loaded Settings in {:.2f}ms:'
@@ -165,18 +386,27 @@ class FilesService(metaclass=Singleton):
             '\n\tIgnore Filename = {}'
             '\n\tIcon theme = {}'
             '\n\tUse built in folder theme = {}'
+            '\n\tWatch filesystem = {}'
+            '\n\tSearch processes = {}'
+            '\n\tFuzzy search = {}'
             '\n\tDirectories = {}'.format(
                 time_elapsed, scan_every_minutes, search_after_characters, search_max_results,
-                search_threshold, ignore_filename, icon_theme, use_built_in_folder_theme, paths
+                search_threshold, ignore_filename, icon_theme, use_built_in_folder_theme,
+                watch_filesystem, search_processes, search_fuzzy, paths
             )
         )
 
-        SearchResults.KEEP_FOR = scan_every_minutes * 60
         Cache().set_search_after_characters(search_after_characters)
         Cache().set_search_max_results(search_max_results)
         Cache().set_search_threshold(search_threshold)
+        Cache().set_search_processes(search_processes)
+        Cache().set_search_fuzzy(search_fuzzy)
         Cache().set_ignore_filename(ignore_filename)
         Cache().set_paths(paths, depths)
+        Cache().set_index_path(self._get_index_path())
+        self._schedule()
+        Cache().set_usage_path(self._get_usage_path())
+        IconRegistry().set_cache_path(self._get_icons_path())
         IconRegistry().set_icon_pack(icon_theme)
         IconRegistry().set_use_built_in_folder_theme(use_built_in_folder_theme)
 
@@ -215,8 +445,19 @@ class FilesService(metaclass=Singleton):
         use_built_in_folder_theme = default.get('USE_BUILT_IN_FOLDER_THEME')
         use_built_in_folder_theme = self.set_use_built_in_folder_theme(use_built_in_folder_theme, _set=False)
 
+        watch_filesystem = default.get('WATCH_FILESYSTEM')
+        watch_filesystem = self.set_watch_filesystem(watch_filesystem, _set=False)
+
+        search_processes = default.get('SEARCH_PROCESSES')
+        search_processes = self.set_search_processes(search_processes, _set=False)
+
+        search_fuzzy = default.get('FUZZY_SEARCH')
+        search_fuzzy = self.set_search_fuzzy(search_fuzzy, _set=False)
+
+
         paths = []
         depths = []
+        options = {}
         for section in config.sections():
             if not section.strip().startswith('DIRECTORY'):
                 continue
@@ -225,10 +466,15 @@ class FilesService(metaclass=Singleton):
             path = os.path.abspath(path)
             depth = config[section].get('DEPTH', 0.0)
             depth = type_or_default(depth, float, 0.0)
+            minutes = type_or_default(config[section].get('SCAN_EVERY_MINUTES'), float, None)
+            priority = type_or_default(config[section].get('PRIORITY', 0), int, 0)
             paths.append(path)
             depths.append(depth)
+            options[path] = (minutes, priority)
         
         self._scan_every_minutes = scan_every_minutes
+        self._watch_filesystem = watch_filesystem
+        self._directories = options
         time_elapsed = 1000 * (time() - now)
         self._logger.info(
             'Loaded Settings in {:.2f}ms:'
@@ -239,17 +485,26 @@ class FilesService(metaclass=Singleton):
             '\n\tIGNORE_FILENAME={}'
             '\n\tICON_THEME={}'
             '\n\tUSE_BUILT_IN_ICON_THEME={}'
-            '\n\DIRECTORIES={}'.format(
+            '\n\tWATCH_FILESYSTEM={}'
+            '\n\tSEARCH_PROCESSES={}'
+            '\n\tFUZZY_SEARCH={}'
+            '\n\tDIRECTORIES={}'.format(
                 time_elapsed, scan_every_minutes, search_after_characters, search_max_results,
-                search_threshold, ignore_filename, icon_theme, use_built_in_folder_theme, paths
+                search_threshold, ignore_filename, icon_theme, use_built_in_folder_theme,
+                watch_filesystem, search_processes, search_fuzzy, paths
             )
         )
 
-        SearchResults.KEEP_FOR = scan_every_minutes * 60
         Cache().set_search_after_characters(search_after_characters)
         Cache().set_search_max_results(search_max_results)
         Cache().set_search_threshold(search_threshold)
+        Cache().set_search_processes(search_processes)
+        Cache().set_search_fuzzy(search_fuzzy)
         Cache().set_ignore_filename(ignore_filename)
         Cache().set_paths(paths, depths)
+        Cache().set_index_path(self._get_index_path())
+        self._schedule()
+        Cache().set_usage_path(self._get_usage_path())
+        IconRegistry().set_cache_path(self._get_icons_path())
         IconRegistry().set_icon_pack(icon_theme)
         IconRegistry().set_use_built_in_folder_theme(use_built_in_folder_theme)
@@ -1,3 +1,4 @@
+import os
 from functools import wraps
 
 def lock(func):
@@ -13,6 +14,10 @@ def type_or_default(value, _type, default):
     except Exception:
         return default
 
+def get_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'ulauncher-albert-files')
+
 class Singleton(type):
     _instances = {}
     def __call__(cls, *args, **kwargs):
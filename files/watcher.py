@@ -0,0 +1,284 @@
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from time import time
+from threading import RLock, Thread
+from . import logging
+from .cache import Cache
+from .match import Ignore
+from .utils import lock, Singleton
+
+
+class Inotify:
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_EXCL_UNLINK = 0x04000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT = struct.Struct('iIII')
+    _libc = None
+
+    def __init__(self):
+        libc = Inotify._get_libc()
+        fd = libc.inotify_init1(Inotify.IN_NONBLOCK | Inotify.IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._libc = libc
+        self.fd = fd
+        # Written to by wake() to stop a read
+        try:
+            self._wake_fd, self._waker_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        except OSError:
+            os.close(fd)
+            raise
+
+    @classmethod
+    def _get_libc(cls):
+        if cls._libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+            cls._libc = libc
+        return cls._libc
+
+    @staticmethod
+    def is_available():
+        try:
+            Inotify._get_libc().inotify_init1
+        except (OSError, AttributeError):
+            return False
+        return True
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        # Returns a list of (wd, mask, cookie, name), empty when woken up
+        readable, _, _ = select.select([self.fd, self._wake_fd], [], [], timeout)
+        if self.fd not in readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + Inotify.EVENT.size <= len(data):
+            wd, mask, cookie, length = Inotify.EVENT.unpack_from(data, offset)
+            offset += Inotify.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def wake(self):
+        try:
+            os.write(self._waker_fd, b'\0')
+        except OSError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self._wake_fd)
+        os.close(self._waker_fd)
+
+
+class FilesWatcher(metaclass=Singleton):
+    # Applies inotify events on the scanned directories to the Cache. When the
+    # event queue overflows or an ignore file changes, on_error is called so
+    # a full scan can be done instead. After reaching the watch limit or an
+    # overflow, watching would fail the same way again: it is not tried again
+    # until a backoff that doubles every time expires or retry() is called,
+    # the periodic scans keep the index up to date meanwhile.
+    MASK = (
+        Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_MOVED_FROM |
+        Inotify.IN_MOVED_TO | Inotify.IN_CLOSE_WRITE | Inotify.IN_ONLYDIR |
+        Inotify.IN_DONT_FOLLOW | Inotify.IN_EXCL_UNLINK
+    )
+    MIN_BACKOFF_SECONDS = 60.0
+    MAX_BACKOFF_SECONDS = 3600.0
+
+    def __init__(self):
+        self._lock = RLock()
+        self._inotify = None
+        self._thread = None
+        self._watches = {}
+        self._wds = {}
+        self._on_error = None
+        self._backoff = 0.0
+        self._retry_at = None
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    @lock
+    def watching(self):
+        return self._inotify is not None
+
+    @lock
+    def set_on_error(self, on_error):
+        self._on_error = on_error
+
+    @lock
+    def retry(self):
+        # The settings changed, the next watch does not wait for the backoff
+        self._retry_at = None
+
+    @lock
+    def watch(self, directories):
+        # Watch the given directories, stop watching the rest
+        if self._retry_at is not None and time() < self._retry_at:
+            return False
+        if self._inotify is None:
+            if not Inotify.is_available():
+                self._logger.warning('inotify is not available, file watching is disabled')
+                return False
+            try:
+                self._inotify = Inotify()
+            except OSError as e:
+                self._logger.warning('Could not initialize inotify: {}'.format(e))
+                return False
+            self._thread = Thread(target=self._run, args=(self._inotify,))
+            self._thread.daemon = True
+            self._thread.start()
+
+        directories = set(directories)
+        for directory in list(self._wds):
+            if directory not in directories:
+                self._unwatch(directory)
+        if not self._add_watches(d for d in directories if d not in self._wds):
+            return False
+        self._backoff = 0.0
+        self._logger.info('Watching {} directories'.format(len(self._wds)))
+        return True
+
+    @lock
+    def stop(self):
+        # The reading thread closes inotify once it stopped reading it
+        if self._inotify is None:
+            return
+        inotify = self._inotify
+        self._reset()
+        inotify.wake()
+
+    def _reset(self):
+        self._inotify = None
+        self._thread = None
+        self._watches = {}
+        self._wds = {}
+
+    def _add_watches(self, directories):
+        for directory in directories:
+            try:
+                wd = self._inotify.add_watch(directory, FilesWatcher.MASK)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    # The entries were just read, they do not need a scan
+                    self._fall_back('Reached the inotify watch limit, falling back to scanning', scan=False, back_off=True)
+                    return False
+                # Directory was removed or is not readable
+                continue
+            self._watches[wd] = directory
+            self._wds[directory] = wd
+        return True
+
+    def _unwatch(self, directory):
+        wd = self._wds.pop(directory, None)
+        if wd is None:
+            return
+        self._watches.pop(wd, None)
+        try:
+            self._inotify.rm_watch(wd)
+        except OSError:
+            pass
+
+    def _fall_back(self, message, scan=True, back_off=False):
+        self._logger.warning(message)
+        self.stop()
+        if back_off:
+            self._backoff = min(max(2 * self._backoff, FilesWatcher.MIN_BACKOFF_SECONDS), FilesWatcher.MAX_BACKOFF_SECONDS)
+            self._retry_at = time() + self._backoff
+            self._logger.info('Watching again in {:.0f}s'.format(self._backoff))
+        if scan and self._on_error is not None:
+            Thread(target=self._on_error, daemon=True).start()
+
+    def _run(self, inotify):
+        try:
+            while True:
+                with self._lock:
+                    if self._inotify is not inotify:
+                        return
+                try:
+                    events = inotify.read()
+                except (OSError, ValueError) as e:
+                    self._logger.warning('Could not read inotify events: {}'.format(e))
+                    return
+                if events:
+                    self._handle(inotify, events)
+        finally:
+            with self._lock:
+                if self._inotify is inotify:
+                    self._reset()
+            inotify.close()
+
+    @lock
+    def _handle(self, inotify, events):
+        if self._inotify is not inotify:
+            return
+        cache = Cache()
+        try:
+            self._apply(cache, events)
+        finally:
+            # Once for the whole batch, the merge is built in the background
+            if cache.flush_changes():
+                Thread(target=cache.merge_changes, daemon=True).start()
+
+    def _apply(self, cache, events):
+        for wd, mask, _, name in events:
+            if mask & Inotify.IN_Q_OVERFLOW:
+                self._fall_back('inotify queue overflowed, falling back to scanning', back_off=True)
+                return
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            if mask & Inotify.IN_IGNORED:
+                self._watches.pop(wd, None)
+                if self._wds.get(directory) == wd:
+                    del self._wds[directory]
+                continue
+            if not name:
+                continue
+
+            path = os.path.join(directory, name)
+            if name == Ignore.IGNORE_FILENAME and mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_DELETE | Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO):
+                # Rules changed for the whole subtree
+                self._fall_back('Ignore file {} changed, scanning again'.format(path))
+                return
+            if mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                cache.remove_path(path)
+                if mask & Inotify.IN_ISDIR:
+                    prefix = path + os.sep
+                    for watched in [d for d in self._wds if d == path or d.startswith(prefix)]:
+                        self._unwatch(watched)
+            elif mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                if not self._add_watches(cache.add_path(path)):
+                    return
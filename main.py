@@ -3,12 +3,15 @@ Launcher.set('ulauncher')
 import os
 from files.service import FilesService
 from files.icon import IconRegistry
+from files.result import StatResult
 from ulauncher.api.client.Extension import Extension
 from ulauncher.api.client.EventListener import EventListener
-from ulauncher.api.shared.event import KeywordQueryEvent, PreferencesEvent, PreferencesUpdateEvent, SystemExitEvent
+from ulauncher.api.shared.event import KeywordQueryEvent, ItemEnterEvent, PreferencesEvent, PreferencesUpdateEvent, SystemExitEvent
 from ulauncher.api.shared.item.ExtensionResultItem import ExtensionResultItem
 from ulauncher.api.shared.action.RenderResultListAction import RenderResultListAction
 from ulauncher.api.shared.action.OpenAction import OpenAction
+from ulauncher.api.shared.action.CopyToClipboardAction import CopyToClipboardAction
+from ulauncher.api.shared.action.ExtensionCustomAction import ExtensionCustomAction
 
 home = os.path.expanduser('~')
 replace_home = lambda path: path.replace(home, '~', 1)
@@ -17,6 +20,7 @@ class FilesExtension(Extension):
     def __init__(self):
         super(FilesExtension, self).__init__()
         self.subscribe(KeywordQueryEvent, KeywordQueryEventListener())
+        self.subscribe(ItemEnterEvent, ItemEnterEventListener())
         self.subscribe(PreferencesEvent, PreferencesEventListener())
         self.subscribe(PreferencesUpdateEvent, PreferencesUpdateEventListener())
         self.subscribe(SystemExitEvent, SystemExitEventListener)
@@ -25,24 +29,40 @@ class KeywordQueryEventListener(EventListener):
     def on_event(self, event, extension):
         query_str = event.get_argument() or ''
         results = FilesService().search(query_str)
-        
+        # A newer query replaced this one
+        if results is None:
+            return None
+        return self.render(results)
+
+    @staticmethod
+    def render(results):
         items = []
         for result in results:
             icon = IconRegistry().get_icon(result)
             name = result.name
-            path = result.path
-            on_enter = OpenAction(path)
+            if isinstance(result, StatResult):
+                description = result.description
+                on_enter = CopyToClipboardAction('{}: {}'.format(name, description))
+            else:
+                description = replace_home(result.path)
+                on_enter = ExtensionCustomAction(result.path)
         
             items.append(ExtensionResultItem(
                 icon=icon,
                 name=name,
-                description=replace_home(path),
+                description=description,
                 highlightable=True,
                 on_enter=on_enter
             ))
-        
         return RenderResultListAction(items)
 
+class ItemEnterEventListener(EventListener):
+    def on_event(self, event, extension):
+        # Record the open so the path ranks higher next time
+        path = event.get_data()
+        FilesService().record_open(path)
+        return OpenAction(path)
+
 class PreferencesEventListener(EventListener):
     def on_event(self, event, extension):
         super().on_event(event, extension)
@@ -55,11 +75,16 @@ class PreferencesEventListener(EventListener):
         ignore_filename = event.preferences['ignore_filename']
         icon_theme = event.preferences['icon_theme'] 
         use_built_in_folder_theme = event.preferences['use_built_in_folder_theme']
+        watch_filesystem = event.preferences['watch_filesystem']
+        search_processes = event.preferences['search_processes']
+        search_fuzzy = event.preferences['search_fuzzy']
 
         FilesService().load_settings_ulauncher(scan_every_minutes, directories, 
                                                search_after_characters, search_max_results,
                                                search_threshold, ignore_filename,
-                                               icon_theme, use_built_in_folder_theme)
+                                               icon_theme, use_built_in_folder_theme,
+                                               watch_filesystem, search_processes,
+                                               search_fuzzy)
         FilesService().run()
 
 class PreferencesUpdateEventListener(EventListener):
@@ -83,6 +108,12 @@ class PreferencesUpdateEventListener(EventListener):
             service.set_icon_theme(event.new_value)
         elif event.id == 'use_built_in_folder_theme':
             service.set_use_built_in_folder_theme(event.new_value)
+        elif event.id == 'watch_filesystem':
+            service.set_watch_filesystem(event.new_value)
+        elif event.id == 'search_processes':
+            service.set_search_processes(event.new_value)
+        elif event.id == 'search_fuzzy':
+            service.set_search_fuzzy(event.new_value)
 
 class SystemExitEventListener(EventListener):
     def on_event(event, extension):
@@ -0,0 +1,43 @@
+import os
+import sys
+import subprocess
+from files.cache import Cache
+from benchmarks.tree import TreeGenerator
+from benchmarks.measure import ROOT_DIR, get_keystrokes
+from .utils import set_cache_settings
+
+def _list(path):
+    return sorted(os.path.relpath(os.path.join(root, name), path) for root, _, names in os.walk(path) for name in names)
+
+def test_benchmark_tree(tmp_path):
+    first = TreeGenerator(str(tmp_path / 'first'), 500, seed=1).generate()
+    second = TreeGenerator(str(tmp_path / 'second'), 500, seed=1).generate()
+    assert _list(first) == _list(second)
+    assert len(_list(first)) >= 500
+
+    set_cache_settings('.albertignore2', 2, 0.5, [first], [0])
+    Cache().scan()
+    # Ignored by the project ignore files
+    directories = [os.path.relpath(path, first).split(os.sep) for path in Cache().get_directories()]
+    assert len(directories) > 1
+    assert not any('node_modules' in parts or 'build' in parts for parts in directories)
+
+    store = Cache()._snapshot.store
+    names = sorted({store.name(entry_id) for entry_id in range(len(store))})
+    # The relative paths repeat their parents
+    arenas = store.get_arena_stats()
+    assert arenas['lowers_chars'] > arenas['names_chars']
+    assert store.get_memory_size() > arenas['names_bytes'] + arenas['lowers_bytes']
+    assert get_keystrokes(names, 5, 1) == get_keystrokes(names, 5, 1)
+
+def test_startup_imports():
+    # Ignore files, icons, scoring and search processes import their dependencies on first use
+    code = (
+        'import sys\n'
+        'from files.launcher import Launcher\n'
+        'Launcher.set("ulauncher")\n'
+        'import files.service, files.icon\n'
+        'print(" ".join(sorted({"pathspec", "gi", "numpy", "multiprocessing"} & set(sys.modules))))\n'
+    )
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT_DIR)
+    assert output.decode().strip() == ''
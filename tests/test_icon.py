@@ -0,0 +1,38 @@
+import os
+from collections import OrderedDict
+from files.icon import IconRegistry
+from files.result import Result
+
+def test_icon_registry(tmp_path, monkeypatch):
+    path = str(tmp_path / 'files.icons')
+    registry = IconRegistry()
+    registry.set_cache_path(path)
+    registry.set_icon_pack('square-o')
+    registry.set_use_built_in_folder_theme(False)
+
+    # File icons by extension, in any case
+    assert registry.get_icon(Result('/a/b.PDF', False, 1.0)).endswith('pdf.svg')
+    assert registry.get_icon(Result('/a/b', False, 1.0)) == registry.get_icon(Result('/a/b.unknown', False, 1.0))
+
+    # Scanned folder names are resolved ahead and saved
+    registry.add_folders(['downloads', 'src'])
+    assert registry._folder_kinds['downloads'] == 'folder_download'
+    assert registry._folder_kinds['src'] == ''
+    assert os.path.isfile(path)
+    assert registry.get_icon(Result('/a/Downloads', True, 1.0)) is not None
+
+    # Loaded back for the same theme, without resolving the icons again
+    registry.set_cache_path(None)
+    registry._folder_kinds.clear()
+    registry.set_cache_path(path)
+    registry.get_icon(Result('/a/Downloads', True, 1.0))
+    assert registry._folder_kinds['downloads'] == 'folder_download'
+    assert not registry._changed
+
+    # Once full, the names in use are not evicted by the scans
+    monkeypatch.setattr(IconRegistry, 'MAX_FOLDERS', len(registry._folder_kinds) + 1)
+    registry.add_folders(['music', 'video', 'games'])
+    assert 'downloads' in registry._folder_kinds
+    assert len(registry._folder_kinds) == IconRegistry.MAX_FOLDERS
+    registry._folder_kinds = OrderedDict()
+    registry.set_cache_path(None)
@@ -1,5 +1,10 @@
+import os
+import shutil
 from os.path import join
+from pathspec import PathSpec
 from files.cache import Cache
+from files.cache.scanner import Scanner
+from files.cache.snapshot import CacheSnapshot
 from .utils import SCAN_DIRECTORY, PATHS, DEPTHS, set_cache_settings
 
 def test_scan():
@@ -94,3 +99,194 @@ def test_scan_depth_3():
     assert join(SCAN_DIRECTORY, 'Projects', 'my_project') in Cache()
     assert join(SCAN_DIRECTORY, 'Projects', 'my_project', '.git') in Cache()
     assert join(SCAN_DIRECTORY, 'Projects', 'my_project', 'project_file.py') in Cache()
+
+def test_scan_prunes_ignored_directories(monkeypatch):
+    set_cache_settings('.albertignore2', 2, 0.5, PATHS, [2])
+    scanned = []
+    scandir = Scanner._scandir
+    def _scandir(directory):
+        scanned.append(directory)
+        return scandir(directory)
+    monkeypatch.setattr(Scanner, '_scandir', staticmethod(_scandir))
+    Cache()._listings = {}
+    Cache().scan()
+
+    assert SCAN_DIRECTORY in scanned
+    assert join(SCAN_DIRECTORY, 'Downloads') in scanned
+    assert join(SCAN_DIRECTORY, '.hidden_directory') not in scanned
+    assert join(SCAN_DIRECTORY, 'Downloads', 'two_level_dir') not in scanned
+    assert join(SCAN_DIRECTORY, 'Downloads', 'two_level_dir') in Cache()
+
+def test_scan_saves_and_loads_index(tmp_path):
+    set_cache_settings('.albertignore2', 2, 0.5, PATHS, DEPTHS)
+    Cache().set_index_path(str(tmp_path / 'files.index'))
+    try:
+        Cache().scan()
+        store = Cache()._snapshot.store
+        paths = set(store.path(entry_id) for entry_id in range(len(store)))
+        Cache()._snapshot = CacheSnapshot()
+
+        assert Cache().load()
+        store = Cache()._snapshot.store
+        assert set(store.path(entry_id) for entry_id in range(len(store))) == paths
+        assert join(SCAN_DIRECTORY, 'Downloads', 'some_other_file.pdf') in Cache()
+        results = Cache().search('some_other')
+        assert results[0].path == join(SCAN_DIRECTORY, 'Downloads', 'some_other_file.pdf')
+
+        # Scans carrying roots over do not write the index
+        Cache().scan()
+        os.remove(str(tmp_path / 'files.index'))
+        assert Cache().scan([])
+        assert Cache().get_stats()['scan']['carried'] == 1
+        assert not os.path.exists(str(tmp_path / 'files.index'))
+        Cache().scan()
+        assert os.path.exists(str(tmp_path / 'files.index'))
+
+        # A truncated index is not loaded
+        with open(str(tmp_path / 'files.index'), 'r+b') as f:
+            f.truncate(os.path.getsize(str(tmp_path / 'files.index')) // 2)
+        Cache()._snapshot = CacheSnapshot()
+        assert not Cache().load()
+        Cache().scan()
+
+        # Changing depths or the ignore filename invalidates the saved index
+        Cache()._snapshot = CacheSnapshot()
+        set_cache_settings('.albertignore2', 2, 0.5, PATHS, [1])
+        assert not Cache().load()
+        set_cache_settings('.ulauncherignore', 2, 0.5, PATHS, DEPTHS)
+        assert not Cache().load()
+    finally:
+        Cache().set_index_path(None)
+
+def test_scan_reuses_unchanged_directories(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    os.makedirs(join(root, 'Documents', 'Reports'))
+    open(join(root, 'Documents', 'Reports', 'report.pdf'), 'w').close()
+    with open(join(root, '.albertignore2'), 'w') as f:
+        f.write('*.tmp\n')
+    # Directories modified right before a scan are always read again
+    for directory in (root, join(root, 'Documents'), join(root, 'Documents', 'Reports')):
+        os.utime(directory, (1, 1))
+
+    set_cache_settings('.albertignore2', 2, 0.5, [root], [0])
+    Cache()._listings = {}
+    Cache().scan()
+
+    scanned = []
+    scandir = Scanner._scandir
+    def _scandir(directory):
+        scanned.append(directory)
+        return scandir(directory)
+    monkeypatch.setattr(Scanner, '_scandir', staticmethod(_scandir))
+
+    Cache().scan()
+    assert scanned == []
+    assert join(root, 'Documents', 'Reports', 'report.pdf') in Cache()
+
+    open(join(root, 'Documents', 'notes.txt'), 'w').close()
+    Cache().scan()
+    assert scanned == [join(root, 'Documents')]
+    assert join(root, 'Documents', 'notes.txt') in Cache()
+
+    # Ignore file changes apply to unchanged directories too
+    with open(join(root, '.albertignore2'), 'w') as f:
+        f.write('Reports/\n')
+    os.utime(root, (1, 1))
+    Cache().scan()
+    assert join(root, 'Documents', 'Reports') not in Cache()
+    assert join(root, 'Documents', 'Reports', 'report.pdf') not in Cache()
+
+def test_scan_is_the_same_with_workers(monkeypatch):
+    set_cache_settings('.albertignore2', 2, 0.5, PATHS + [join(SCAN_DIRECTORY, 'Downloads')], DEPTHS + [0])
+    Cache()._listings = {}
+    monkeypatch.setattr(Scanner, 'WORKERS', 1)
+    Cache().scan()
+    store = Cache()._snapshot.store
+    paths = [store.path(entry_id) for entry_id in range(len(store))]
+
+    Cache()._listings = {}
+    monkeypatch.setattr(Scanner, 'WORKERS', 8)
+    Cache().scan()
+    store = Cache()._snapshot.store
+    assert [store.path(entry_id) for entry_id in range(len(store))] == paths
+    assert join(SCAN_DIRECTORY, 'Downloads', 'some_other_file.pdf') in paths
+
+def test_scan_composes_ignore_files(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    os.makedirs(join(root, 'Documents', 'Drafts'))
+    for name in ('notes.txt', 'keep.txt', 'report.pdf'):
+        open(join(root, 'Documents', 'Drafts', name), 'w').close()
+    with open(join(root, '.albertignore2'), 'w') as f:
+        f.write('*.txt\n*.pdf\n')
+    with open(join(root, 'Documents', '.albertignore2'), 'w') as f:
+        f.write('!keep.txt\n')
+    set_cache_settings('.albertignore2', 2, 0.5, [root], [0])
+
+    compiled = []
+    from_lines = PathSpec.from_lines
+    def _from_lines(*args):
+        compiled.append(args)
+        return from_lines(*args)
+    monkeypatch.setattr(PathSpec, 'from_lines', _from_lines)
+    Cache().scan()
+    Cache().scan()
+
+    assert len(compiled) == 2
+    assert join(root, 'Documents', 'Drafts', 'keep.txt') in Cache()
+    assert join(root, 'Documents', 'Drafts', 'notes.txt') not in Cache()
+    assert join(root, 'Documents', 'Drafts', 'report.pdf') not in Cache()
+
+def test_scan_only_nested_root(tmp_path):
+    root = str(tmp_path)
+    for directory in (join('a', 'b', 'y9', 'd'), join('a', 'x1')):
+        os.makedirs(join(root, directory))
+    for filename in (join('a', 'b', 'y9', 'd', 'deep.txt'), join('a', 'x1', 'f.txt'), join('a', 'b', 'top.txt')):
+        open(join(root, filename), 'w').close()
+    # The walk of a adds the entries of b deeper than its depth
+    roots = [join(root, 'a'), join(root, 'a', 'b')]
+    set_cache_settings('.albertignore2', 2, 0.5, roots, [0, 1])
+    Cache().scan()
+    assert join(root, 'a', 'b', 'y9', 'd', 'deep.txt') in Cache()
+
+    shutil.rmtree(join(root, 'a', 'b', 'y9'))
+    open(join(root, 'a', 'b', 'new.txt'), 'w').close()
+    assert Cache().scan([join(root, 'a', 'b')])
+    store = Cache()._snapshot.store
+    paths = sorted(store.path(entry_id) for entry_id in range(len(store)))
+    assert all(os.path.lexists(path) for path in paths)
+    Cache().scan()
+    store = Cache()._snapshot.store
+    assert paths == sorted(store.path(entry_id) for entry_id in range(len(store)))
+
+def test_scan_only_requested_roots(tmp_path):
+    root = str(tmp_path)
+    for directory in ('Documents', 'Downloads', join('Downloads', 'Music')):
+        os.makedirs(join(root, directory))
+    open(join(root, 'Documents', 'notes.txt'), 'w').close()
+    roots = [join(root, 'Documents'), join(root, 'Downloads'), join(root, 'Downloads', 'Music')]
+    set_cache_settings('.albertignore2', 2, 0.5, roots, [0, 0, 0])
+    Cache().scan()
+    store = Cache()._snapshot.store
+    paths = set(store.path(entry_id) for entry_id in range(len(store)))
+
+    # Only Downloads is read again, Documents keeps its entries and the
+    # changes reported by the watcher
+    open(join(root, 'Documents', 'report.pdf'), 'w').close()
+    Cache().add_path(join(root, 'Documents', 'report.pdf'))
+    open(join(root, 'Documents', 'unseen.txt'), 'w').close()
+    open(join(root, 'Downloads', 'setup.iso'), 'w').close()
+    assert Cache().scan([join(root, 'Downloads')])
+    assert Cache().get_stats()['scan']['carried'] == 2
+    assert join(root, 'Downloads', 'setup.iso') in Cache()
+    assert join(root, 'Documents', 'report.pdf') in Cache()
+    assert join(root, 'Documents', 'unseen.txt') not in Cache()
+    store = Cache()._snapshot.store
+    assert set(store.path(entry_id) for entry_id in range(len(store))) == paths | {join(root, 'Downloads', 'setup.iso')}
+
+    # Given up roots keep their entries
+    open(join(root, 'Downloads', 'Music', 'song.mp3'), 'w').close()
+    assert Cache().scan(is_cancelled=lambda root_path: root_path == join(root, 'Downloads', 'Music'))
+    assert join(root, 'Downloads', 'Music', 'song.mp3') not in Cache()
+    assert join(root, 'Documents', 'unseen.txt') in Cache()
+    Cache().scan()
+    assert join(root, 'Downloads', 'Music', 'song.mp3') in Cache()
@@ -0,0 +1,143 @@
+import os
+import shutil
+from time import sleep
+from threading import Event
+from os.path import expanduser, join
+from files.cache import Cache
+from files.scheduler import ScanScheduler
+from files.service import FilesService
+
+def _wait(scans, count):
+    for _ in range(500):
+        if len(scans) >= count:
+            return
+        sleep(0.01)
+
+def test_scheduler_merges_requests():
+    scans = []
+    scanned = Event()
+    def _scan(root_paths, periodic, is_cancelled):
+        scans.append((root_paths, periodic))
+        scanned.set()
+
+    scheduler = ScanScheduler(_scan)
+    scheduler.set_roots({'/a': (0, 0), '/b': (0, 0), '/c': (0, 0)})
+    scheduler.start()
+    try:
+        scheduler.request(['/a'], delay=0.05)
+        scheduler.request(['/b'], delay=0.05)
+        assert scanned.wait(2)
+        sleep(0.1)
+        assert scans == [({'/a', '/b'}, False)]
+
+        scanned.clear()
+        scheduler.request(['/a'], delay=0.05)
+        scheduler.request(None, delay=0.05)
+        assert scanned.wait(2)
+        assert scans[-1] == (None, False)
+
+        # Roots are refreshed on their own interval
+        scanned.clear()
+        scheduler.set_roots({'/a': (0.05, 0), '/b': (0, 0), '/c': (0, 0)})
+        assert scanned.wait(2)
+        assert scans[-1] == ({'/a'}, True)
+    finally:
+        scheduler.stop()
+
+def test_scheduler_cancels_requested_roots():
+    scans = []
+    started = Event()
+    def _scan(root_paths, periodic, is_cancelled):
+        started.set()
+        for _ in range(20):
+            if is_cancelled('/a'):
+                scans.append((root_paths, 'cancelled'))
+                return
+            sleep(0.01)
+        scans.append((root_paths, 'done'))
+
+    scheduler = ScanScheduler(_scan)
+    scheduler.set_roots({'/a': (0, 0), '/b': (0, 0)})
+    scheduler.start()
+    try:
+        scheduler.request(['/a', '/b'], delay=0)
+        assert started.wait(2)
+        # Requested again, the scan in progress gives it up and it is scanned next
+        scheduler.request(['/a'], delay=0)
+        _wait(scans, 2)
+        assert scans == [(None, 'cancelled'), ({'/a'}, 'done')]
+    finally:
+        scheduler.stop()
+
+def test_scheduler_preempts_refreshes_once():
+    scans = []
+    def _scan(root_paths, periodic, is_cancelled):
+        if '/archive' in root_paths:
+            for _ in range(100):
+                if is_cancelled('/archive'):
+                    scans.append((root_paths, 'cancelled'))
+                    return
+                sleep(0.01)
+        scans.append((root_paths, 'done'))
+
+    scheduler = ScanScheduler(_scan)
+    # The archive is due first, the downloads come first once due
+    scheduler.set_roots({'/archive': (0.05, 0), '/downloads': (0.3, 1)})
+    scheduler.start()
+    try:
+        _wait(scans, 3)
+        assert scans[:3] == [({'/archive'}, 'cancelled'), ({'/downloads'}, 'done'), ({'/archive'}, 'done')]
+    finally:
+        scheduler.stop()
+
+def test_directory_options():
+    paths, depths, options = FilesService().set_directories('~/Downloads=:1:10\n/archive=2::-1\n/tmp', _set=False)
+    assert paths == [expanduser('~/Downloads'), '/archive', '/tmp']
+    assert depths == [0, 2, 0]
+    assert options == {expanduser('~/Downloads'): (1.0, 10), '/archive': (None, -1), '/tmp': (None, 0)}
+
+def test_scan_requests_with_scanning_off(tmp_path, monkeypatch):
+    service = FilesService()
+    requests = []
+    monkeypatch.setattr(service._scheduler, 'request', lambda root_paths=None, delay=0: requests.append(root_paths))
+    monkeypatch.setattr(service, '_running', True)
+    monkeypatch.setattr(service, '_scan_every_minutes', 0)
+    monkeypatch.setattr(service, '_directories', {})
+    own, default = str(tmp_path / 'own'), str(tmp_path / 'default')
+    # Only the roots with their own interval are scanned
+    service.set_directories('{}=:5\n{}'.format(own, default))
+    assert requests == [[own]]
+    service._request_scan()
+    assert requests == [[own], [own]]
+    service._request_scan([default])
+    assert requests == [[own], [own]]
+
+def test_scan_nested_root_on_its_interval(tmp_path, monkeypatch):
+    service = FilesService()
+    requests = []
+    monkeypatch.setattr(service._scheduler, 'request', lambda root_paths=None, delay=0: requests.append(root_paths))
+    monkeypatch.setattr(service, '_running', True)
+    monkeypatch.setattr(service, '_watch_filesystem', False)
+    monkeypatch.setattr(service, '_directories', {})
+    root = str(tmp_path)
+    for directory in (join('a', 'b', 'y9', 'd'), join('a', 'x1')):
+        os.makedirs(join(root, directory))
+    for filename in (join('a', 'b', 'y9', 'd', 'deep.txt'), join('a', 'x1', 'f.txt')):
+        open(join(root, filename), 'w').close()
+    Cache().set_ignore_filename('.albertignore2')
+    service.set_directories('{}\n{}=1:5'.format(join(root, 'a'), join(root, 'a', 'b')))
+    service._scan(None, False, lambda root_path: False)
+    assert join(root, 'a', 'b', 'y9', 'd', 'deep.txt') in Cache()
+
+    # Only the nested root is due, the index matches a full scan
+    shutil.rmtree(join(root, 'a', 'b', 'y9'))
+    open(join(root, 'a', 'b', 'new.txt'), 'w').close()
+    service._scan({join(root, 'a', 'b')}, True, lambda root_path: False)
+    store = Cache()._snapshot.store
+    paths = sorted(store.path(entry_id) for entry_id in range(len(store)))
+    assert join(root, 'a', 'b', 'new.txt') in Cache()
+    assert join(root, 'a', 'b', 'y9', 'd', 'deep.txt') not in Cache()
+    assert join(root, 'a', 'x1', 'f.txt') in Cache()
+    service._scan(None, False, lambda root_path: False)
+    store = Cache()._snapshot.store
+    assert sorted(store.path(entry_id) for entry_id in range(len(store))) == paths
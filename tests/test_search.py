@@ -1,5 +1,13 @@
+import pytest
 from os.path import join
-from files.cache import Cache
+from time import sleep
+from threading import Event, Thread
+from files.cache import Cache, scoring
+from files.cache.search_results import SearchResults
+from files.cache.shards import ShardPool
+from files.match import Match, FuzzyMatch
+from files.result import StatResult
+from files.service import FilesService
 from .utils import SCAN_DIRECTORY, PATHS, DEPTHS, set_cache_settings
 
 def test_search():
@@ -24,3 +32,341 @@ def test_search():
     assert results[0].is_directory == True
     assert results[1].path == join(SCAN_DIRECTORY, 'Downloads', 'two_level_dir', 'three_level_dir')
     assert results[1].is_directory == True
+
+def test_search_index():
+    set_cache_settings(None, 2, 0.5, PATHS, DEPTHS)
+    Cache().scan()
+
+    store = Cache()._snapshot.store
+    candidates = Cache()._snapshot.index.candidates('level_dir')
+    assert sorted(store.path(entry_id) for entry_id in candidates) == [
+        join(SCAN_DIRECTORY, 'Downloads', 'two_level_dir'),
+        join(SCAN_DIRECTORY, 'Downloads', 'two_level_dir', 'another_file.zip'),
+        join(SCAN_DIRECTORY, 'Downloads', 'two_level_dir', 'three_level_dir'),
+        join(SCAN_DIRECTORY, 'Downloads', 'two_level_dir', 'three_level_dir', 'three_level_file'),
+    ]
+    # Wildcard queries are narrowed down by their literal parts
+    assert [store.path(entry_id) for entry_id in Cache()._snapshot.index.candidates('*.png')] == [
+        join(SCAN_DIRECTORY, 'Downloads', 'some_file.png'),
+    ]
+    assert Cache()._snapshot.index.candidates('*.p?') is None
+    assert Cache()._snapshot.index.candidates('qqq') == []
+    assert Cache().search('qqqq') == []
+    # The features are built by the scan, not by the first search
+    assert Cache()._snapshot._features[store]._shallow_first is not None
+
+def test_search_during_scan():
+    set_cache_settings(None, 2, 0.5, PATHS, DEPTHS)
+    Cache().scan()
+    snapshot = Cache()._snapshot
+
+    # Hold the scan lock from another thread as a running scan would
+    scanning = Event()
+    done = Event()
+    def _scan():
+        with Cache()._scan_lock:
+            scanning.set()
+            done.wait(5)
+    thread = Thread(target=_scan)
+    thread.start()
+    scanning.wait(5)
+
+    results = Cache().search('some')
+    done.set()
+    thread.join()
+
+    assert len(results) == 2
+    assert Cache()._snapshot is snapshot
+
+def test_match_literals():
+    assert Match.get_literals('*report*2023*.pdf') == (['report', '2023', '.pdf'], '.pdf')
+    assert Match.get_literals('report[0-9]_?.tar.gz') == (['report', '_', '.tar.gz'], '.tar.gz')
+    assert Match.get_literals('notes*') == (['notes'], '')
+    assert Match.get_literals('[!]]x') == (['x'], 'x')
+
+    matcher = Match('*Report*.PDF')
+    assert matcher('2023/report_final.pdf', ignorecase=True)
+    assert not matcher('2023/report_final.pdf')
+    assert Match('notes.txt')('NOTES.txt', ignorecase=True)
+    assert not Match('notes')('notes.txt', ignorecase=True)
+
+def test_search_keeps_the_best_results():
+    set_cache_settings(None, 2, 0.0, PATHS, DEPTHS)
+    Cache().scan()
+    try:
+        Cache().set_search_max_results(100)
+        results = [(result.path, result.score) for result in Cache().search('file')]
+        assert len(results) > 3
+        assert [score for _, score in results] == sorted((score for _, score in results), reverse=True)
+
+        Cache().set_search_max_results(3)
+        assert [(result.path, result.score) for result in Cache().search('file')] == results[:3]
+
+        Cache().set_search_threshold(results[1][1])
+        assert [(result.path, result.score) for result in Cache().search('file')] == [
+            (path, score) for path, score in results[:3] if score >= results[1][1]
+        ]
+    finally:
+        Cache().set_search_max_results(5)
+
+def test_search_reuses_previous_entries():
+    set_cache_settings(None, 0, 0.0, PATHS, DEPTHS)
+    Cache().scan()
+    queries = ['f', 'fi', 'fil', 'file', 'fil', 'file_', 'file', 'f']
+    expected = []
+    for query in queries:
+        Cache().set_search_threshold(0.0)
+        expected.append([result.path for result in Cache().search(query)])
+
+    stats = Cache().get_search_stats()
+    assert [[result.path for result in Cache().search(query)] for query in queries] == expected
+    new_stats = Cache().get_search_stats()
+    assert new_stats['hits'] > stats['hits']
+    assert new_stats['prefix_hits'] > stats['prefix_hits']
+
+def test_search_typed_patterns():
+    set_cache_settings(None, 0, 0.0, PATHS, DEPTHS)
+    Cache().scan()
+    Cache().set_search_max_results(100)
+    try:
+        for query in ['*.py', 'some*.pdf']:
+            Cache().set_search_threshold(0.0)
+            expected = [result.path for result in Cache().search(query)]
+            assert expected
+            # Typed key by key, the entries of the prefixes are not searched again
+            Cache().set_search_threshold(0.0)
+            for end in range(1, len(query) + 1):
+                results = [result.path for result in Cache().search(query[:end])]
+            assert results == expected
+    finally:
+        Cache().set_search_max_results(5)
+
+def test_search_patterns_run_on_entries_with_their_literals(monkeypatch):
+    set_cache_settings(None, 0, 0.0, PATHS, DEPTHS)
+    Cache().scan()
+    queries = ['*level*dir*', 'some*file*', '*_*']
+    matched = []
+    matches_ignorecase = Match.matches_ignorecase
+    monkeypatch.setattr(Match, 'matches_ignorecase', lambda self, value: matched.append(value) or matches_ignorecase(self, value))
+    contains_in_order = scoring.contains_in_order
+    monkeypatch.setattr(scoring, 'contains_in_order', lambda *args: True)
+    expected = [[(result.path, result.score) for result in Cache().search(query)] for query in queries]
+    runs = len(matched)
+
+    monkeypatch.setattr(scoring, 'contains_in_order', contains_in_order)
+    Cache()._snapshot.search_results.clear()
+    del matched[:]
+    assert [[(result.path, result.score) for result in Cache().search(query)] for query in queries] == expected
+    assert len(matched) < runs
+
+def test_search_results_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(SearchResults, 'MAX_ENTRIES', 4)
+    search_results = SearchResults()
+    search_results.add_entries('ab', [(None, [1, 2])])
+    search_results.add_entries('abc', [(None, [1])])
+    assert search_results.get_entries('abx') == [(None, [1, 2])]
+    search_results.add_entries('x', [(None, [3, 4])])
+
+    # abc was used least recently
+    assert search_results.get_entries('abcd') == [(None, [1, 2])]
+    assert search_results.get_stats()['evictions'] == 1
+    assert search_results.get_stats()['entries'] == 4
+
+def test_search_caches_empty_results():
+    set_cache_settings(None, 0, 0.0, PATHS, DEPTHS)
+    Cache().scan()
+    index = Cache()._snapshot.index
+    assert index.may_match('fi*')
+    assert not index.may_match('fq*')
+    assert not index.may_match('*.q?')
+
+    assert Cache().search('zzq') == []
+    stats = Cache().get_search_stats()
+    assert Cache().search('zzqx') == []
+    assert Cache().get_search_stats()['prefix_hits'] == stats['prefix_hits'] + 1
+    assert Cache().search('fq*') == []
+    # Patterns that match nothing do not leave empty entries for longer queries
+    assert Cache()._snapshot.search_results.get_entries('fq*') is None
+
+def test_search_is_the_same_without_numpy(monkeypatch):
+    set_cache_settings(None, 0, 0.6, PATHS, DEPTHS)
+    Cache().scan()
+    queries = ['file', 'dir', '*.py', 'level', 'two_level_dir/']
+    results = [[(result.path, result.score) for result in Cache().search(query)] for query in queries]
+    assert any(results)
+
+    monkeypatch.setattr(scoring, 'numpy', None)
+    Cache().set_search_threshold(0.6)
+    Cache()._snapshot._features = {}
+    assert [[(result.path, result.score) for result in Cache().search(query)] for query in queries] == results
+
+def test_search_is_the_same_with_processes(monkeypatch):
+    set_cache_settings(None, 0, 0.0, PATHS, DEPTHS)
+    Cache().scan()
+    queries = ['file', 'dir', '*.py', 'level', 'two_level_dir/']
+    results = [[(result.path, result.score) for result in Cache().search(query)] for query in queries]
+
+    monkeypatch.setattr(ShardPool, 'MIN_ENTRIES', 1)
+    split = []
+    search = ShardPool.search
+    monkeypatch.setattr(ShardPool, 'search', lambda self, *args: split.append(1) or search(self, *args))
+    Cache().set_search_processes(3)
+    try:
+        Cache().set_search_threshold(0.0)
+        # Searched in process until the workers have the store
+        assert [[(result.path, result.score) for result in Cache().search(query)] for query in queries] == results
+        for _ in range(500):
+            shard_pool = Cache()._shard_pool
+            if shard_pool is not None and shard_pool.store is Cache()._snapshot.store:
+                break
+            sleep(0.01)
+        assert Cache()._shard_pool.store is Cache()._snapshot.store
+        Cache()._snapshot.search_results.clear()
+        assert [[(result.path, result.score) for result in Cache().search(query)] for query in queries] == results
+        assert split
+    finally:
+        Cache().set_search_processes(0)
+
+def test_search_in_process_when_embedded(monkeypatch):
+    set_cache_settings(None, 0, 0.0, PATHS, DEPTHS)
+    Cache().scan()
+    results = [(result.path, result.score) for result in Cache().search('file')]
+
+    # The launcher embeds Python, its executable cannot start the workers
+    monkeypatch.setattr('sys.executable', '/usr/bin/albert')
+    monkeypatch.setattr(ShardPool, 'MIN_ENTRIES', 1)
+    Cache().set_search_processes(3)
+    try:
+        Cache()._snapshot.search_results.clear()
+        assert [(result.path, result.score) for result in Cache().search('file')] == results
+        for _ in range(500):
+            if Cache()._search_processes == 0:
+                break
+            sleep(0.01)
+        assert Cache()._search_processes == 0
+        assert Cache()._shard_pool is None
+    finally:
+        Cache().set_search_processes(0)
+
+def test_search_fuzzy():
+    set_cache_settings(None, 2, 0.3, PATHS, DEPTHS)
+    Cache().scan()
+    assert Cache().search('dlsmfl') == []
+
+    Cache().set_search_fuzzy(True)
+    try:
+        results = Cache().search('dlsmfl')
+        assert [result.path for result in results[:2]] == [
+            join(SCAN_DIRECTORY, 'Downloads', 'some_file.png'),
+            join(SCAN_DIRECTORY, 'Downloads', 'some_other_file.pdf'),
+        ]
+        # Leading matches still rank first
+        assert Cache().search('some_other')[0].path == join(SCAN_DIRECTORY, 'Downloads', 'some_other_file.pdf')
+        assert Cache().search('zzqq') == []
+    finally:
+        Cache().set_search_fuzzy(False)
+
+def test_fuzzy_match():
+    matcher = FuzzyMatch('dlsmfl')
+    text = 'x/downloads/some_file'
+    assert matcher.score(text, 2, len(text)) > matcher.score('xdxlxsxmxfxl', 0, 12) > 0
+    assert matcher.score(text, 0, 12) == 0
+    assert FuzzyMatch.get_mask('abc') & FuzzyMatch.get_mask('cab_') == FuzzyMatch.get_mask('abc')
+
+    store = Cache()._snapshot.store
+    features = scoring.Features(store)
+    masks = features.get_masks()
+    assert [int(mask) for mask in masks] == [
+        FuzzyMatch.get_mask(store.lowers[store.lower_offsets[entry_id]:store.lower_offsets[entry_id + 1]])
+        for entry_id in range(len(store))
+    ]
+
+def test_stats():
+    set_cache_settings('.albertignore2', 2, 0.5, PATHS, DEPTHS)
+    Cache().scan()
+    Cache().search('some')
+    Cache().search('some')
+    Cache().search('some_')
+
+    stats = Cache().get_stats()
+    scan = stats['scan']
+    assert scan['roots'] == {SCAN_DIRECTORY: stats['index']['entries']}
+    assert scan['directories'] + scan['files'] == stats['index']['entries']
+    # .git and the hidden directory are ignored
+    assert scan['pruned'] >= 2
+    assert stats['index']['store_bytes'] > 0 and stats['index']['index_bytes'] > 0
+    latencies = stats['search']['latencies']
+    assert latencies['cached']['count'] >= 1 and latencies['prefix']['count'] >= 1
+    assert latencies['all']['count'] == sum(latencies[kind]['count'] for kind in ('cached', 'prefix', 'index'))
+    assert sum(latencies['all']['buckets'].values()) == latencies['all']['count']
+
+    results = FilesService().search(FilesService.STATS_QUERY)
+    assert all(isinstance(result, StatResult) for result in results)
+    assert any(result.description == SCAN_DIRECTORY for result in results)
+
+def test_search_newest_query_wins():
+    set_cache_settings(None, 2, 0.5, PATHS, DEPTHS)
+    Cache().scan()
+    generation = Cache()._search_generation
+    cancelled = Cache().get_stats()['search']['cancelled']
+
+    # Both searches wait for the lock, only the newest one runs
+    results = {}
+    threads = []
+    with Cache()._lock:
+        for i, query in enumerate(['som', 'some']):
+            thread = Thread(target=lambda query=query: results.__setitem__(query, Cache().search(query)))
+            thread.start()
+            threads.append(thread)
+            while Cache()._search_generation != generation + i + 1:
+                sleep(0.001)
+    for thread in threads:
+        thread.join()
+
+    assert results['som'] is None
+    assert len(results['some']) == 2
+    assert Cache().get_stats()['search']['cancelled'] == cancelled + 1
+    assert Cache()._snapshot.search_results.get_results('som') is None
+
+def test_search_cancelled_while_scoring():
+    set_cache_settings(None, 2, 0.0, PATHS, DEPTHS)
+    Cache().scan()
+    store = Cache()._snapshot.store
+    features = Cache()._snapshot.get_features(store)
+    def _cancel(scorer):
+        raise scoring.SearchCancelled()
+
+    scorer = scoring.Scorer('file', '', 0.0, 5, on_chunk=_cancel)
+    scoring.Scorer.CHUNK, chunk = 4, scoring.Scorer.CHUNK
+    try:
+        with pytest.raises(scoring.SearchCancelled):
+            scorer.score(store, features, range(len(store)))
+    finally:
+        scoring.Scorer.CHUNK = chunk
+
+def test_search_reports_results_so_far(monkeypatch):
+    set_cache_settings(None, 2, 0.0, PATHS, DEPTHS)
+    Cache().scan()
+    expected = [(result.path, result.score) for result in Cache().search('*file*')]
+
+    monkeypatch.setattr(scoring.Scorer, 'CHUNK', 2)
+    Cache().set_search_threshold(0.0)
+    Cache().set_search_budget(0.001)
+    try:
+        provisional = []
+        results = Cache().search('*file*', provisional.append)
+        assert [(result.path, result.score) for result in results] == expected
+        assert provisional and all(len(results) <= len(expected) for results in provisional)
+        # Shallow entries come first
+        assert provisional[0][0].path.count('/') <= expected[-1][0].count('/')
+
+    finally:
+        Cache().set_search_budget(0)
+
+    # The launchers only render the final results
+    Cache().set_search_threshold(0.0)
+    assert [(result.path, result.score) for result in FilesService().search_latest('*file*')] == expected
+    thread = FilesService()._search_thread
+    assert [(result.path, result.score) for result in FilesService().search_latest('*file*')] == expected
+    # The searches run in the same worker
+    assert FilesService()._search_thread is thread
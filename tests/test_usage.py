@@ -0,0 +1,81 @@
+from os.path import join
+from files.cache import Cache
+from files.cache.usage import UsageStore
+from .utils import SCAN_DIRECTORY, PATHS, DEPTHS, set_cache_settings
+
+def test_usage_store(tmp_path):
+    path = str(tmp_path / 'files.usage')
+    usage = UsageStore(path)
+    usage.add('/a', now=0)
+    usage.add('/a', now=0)
+    usage.add('/b', now=0)
+    usage.add('/b', now=UsageStore.HALF_LIFE)
+    weights = usage.get_weights(now=UsageStore.HALF_LIFE)
+    assert abs(weights['/a'] - 1.0) < 1e-6
+    assert abs(weights['/b'] - 1.5) < 1e-6
+
+    # The log is read back the same, a torn record at the end is ignored
+    with open(path, 'ab') as f:
+        f.write(UsageStore.RECORD.pack(0, 1.0, 10) + b'/c')
+    loaded = UsageStore(path)
+    assert loaded.get_weights(now=UsageStore.HALF_LIFE) == weights
+
+    # Compacted to one record per path, forgotten paths are dropped
+    loaded.add('/old', now=-20 * UsageStore.HALF_LIFE)
+    loaded.compact(now=UsageStore.HALF_LIFE)
+    assert len(loaded) == 2
+    compacted = UsageStore(path)
+    compacted.load()
+    assert compacted._records == 2
+    assert compacted.get_weights(now=UsageStore.HALF_LIFE).keys() == weights.keys()
+
+def test_usage_store_compacts_by_itself(tmp_path):
+    usage = UsageStore(str(tmp_path / 'files.usage'))
+    for i in range(UsageStore.MIN_RECORDS * 2):
+        usage.add('/a', now=i)
+    assert usage._records <= UsageStore.MIN_RECORDS
+    assert abs(UsageStore(usage.path).get_weights(now=0)['/a'] - usage.get_weights(now=0)['/a']) < 1e-3
+
+def test_usage_store_rewrites_unreadable_logs(tmp_path):
+    path = str(tmp_path / 'files.usage')
+    with open(path, 'wb') as f:
+        f.write(b'not a usage log')
+    usage = UsageStore(path)
+    usage.add('/a', now=0)
+    assert UsageStore(path).get_weights(now=0) == {'/a': 1.0}
+
+def test_search_ranks_opened_entries_first(tmp_path):
+    set_cache_settings(None, 2, 0.5, PATHS, DEPTHS)
+    Cache().scan()
+    other_file = join(SCAN_DIRECTORY, 'Downloads', 'some_other_file.pdf')
+    assert Cache().search('some')[0].path != other_file
+
+    Cache().set_usage_path(str(tmp_path / 'files.usage'))
+    try:
+        assert Cache().search('some')[0].path != other_file
+        # Results ranked before the open are not returned again
+        Cache().record_open(other_file)
+        results = Cache().search('some')
+        assert results[0].path == other_file
+        assert len(results) == 2
+        # Boosted entries are not ranked twice when searching previous entries
+        assert [result.path for result in Cache().search('some_')].count(other_file) == 1
+    finally:
+        Cache().set_usage_path(None)
+
+def test_search_keeps_boosted_entries_as_candidates(tmp_path):
+    # Below the threshold without its boost, above it with it
+    set_cache_settings(None, 2, 0.95, PATHS, DEPTHS)
+    Cache().scan()
+    three_level_file = join(SCAN_DIRECTORY, 'Downloads', 'two_level_dir', 'three_level_dir', 'three_level_file')
+    assert Cache().search('three_level_file') == []
+
+    Cache().set_usage_path(str(tmp_path / 'files.usage'))
+    try:
+        Cache().record_open(three_level_file)
+        assert [result.path for result in Cache().search('three_level_file')] == [three_level_file]
+        store, entry_id = Cache()._snapshot.get(three_level_file)
+        entries = Cache()._snapshot.search_results.get_entries('three_level_file')
+        assert any(entry_id in entry_ids for entry_store, entry_ids in entries if entry_store is store)
+    finally:
+        Cache().set_usage_path(None)
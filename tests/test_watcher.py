@@ -0,0 +1,144 @@
+import os
+import errno
+import pytest
+from os.path import join
+from time import sleep, time
+from threading import Event
+from files.cache import Cache
+from files.cache.snapshot import CacheSnapshot
+from files.watcher import FilesWatcher, Inotify
+from .utils import set_cache_settings
+
+def _wait_for(condition, timeout=5.0):
+    end = time() + timeout
+    while time() < end:
+        if condition():
+            return True
+        sleep(0.02)
+    return False
+
+def test_watcher(tmp_path):
+    root = str(tmp_path)
+    os.makedirs(join(root, 'Documents'))
+    os.makedirs(join(root, 'node_modules'))
+    with open(join(root, '.albertignore2'), 'w') as f:
+        f.write('node_modules/\n')
+
+    set_cache_settings('.albertignore2', 2, 0.5, [root], [0])
+    Cache().scan()
+    assert FilesWatcher().watch(Cache().get_directories())
+    try:
+        open(join(root, 'Documents', 'watched_file.txt'), 'w').close()
+        assert _wait_for(lambda: join(root, 'Documents', 'watched_file.txt') in Cache())
+        assert Cache().search('watched_file')[0].path == join(root, 'Documents', 'watched_file.txt')
+
+        os.makedirs(join(root, 'Documents', 'new_dir'))
+        assert _wait_for(lambda: join(root, 'Documents', 'new_dir') in Cache())
+        open(join(root, 'Documents', 'new_dir', 'nested_file'), 'w').close()
+        assert _wait_for(lambda: join(root, 'Documents', 'new_dir', 'nested_file') in Cache())
+
+        # Ignored directories are not watched
+        open(join(root, 'node_modules', 'ignored_file'), 'w').close()
+        os.rename(join(root, 'Documents', 'new_dir'), join(root, 'moved_dir'))
+        assert _wait_for(lambda: join(root, 'moved_dir', 'nested_file') in Cache())
+        assert join(root, 'Documents', 'new_dir') not in Cache()
+        assert join(root, 'Documents', 'new_dir', 'nested_file') not in Cache()
+        assert join(root, 'node_modules', 'ignored_file') not in Cache()
+
+        os.remove(join(root, 'Documents', 'watched_file.txt'))
+        assert _wait_for(lambda: join(root, 'Documents', 'watched_file.txt') not in Cache())
+        assert Cache().search('watched_file') == []
+
+        # The reading thread closes inotify once stopped
+        thread = FilesWatcher()._thread
+        fd = FilesWatcher()._inotify.fd
+        FilesWatcher().stop()
+        thread.join(2)
+        assert not thread.is_alive()
+        with pytest.raises(OSError):
+            os.fstat(fd)
+    finally:
+        FilesWatcher().stop()
+
+def test_watch_limit_does_not_scan_again(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    os.makedirs(join(root, 'Documents'))
+    set_cache_settings('.albertignore2', 2, 0.5, [root], [0])
+    Cache().scan()
+
+    def _add_watch(self, path, mask):
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), path)
+    monkeypatch.setattr(Inotify, 'add_watch', _add_watch)
+    errors = []
+    scanned = Event()
+    monkeypatch.setattr(FilesWatcher(), '_on_error', lambda: errors.append(1) or scanned.set())
+    now = [time()]
+    monkeypatch.setattr('files.watcher.time', lambda: now[0])
+
+    watcher = FilesWatcher()
+    try:
+        # Watching is given up until the backoff expires, the index is not scanned again
+        assert not watcher.watch(Cache().get_directories())
+        assert not watcher.watching
+        now[0] += FilesWatcher.MIN_BACKOFF_SECONDS - 1
+        assert not watcher.watch(Cache().get_directories())
+        assert errors == []
+
+        # Overflows scan once, and do not watch again either
+        monkeypatch.setattr(Inotify, 'add_watch', lambda self, path, mask: 1)
+        now[0] += 1
+        assert watcher.watch(Cache().get_directories())
+        watcher._handle(watcher._inotify, [(-1, Inotify.IN_Q_OVERFLOW, 0, '')])
+        assert scanned.wait(5)
+        assert errors == [1]
+        assert not watcher.watching
+        assert not watcher.watch(Cache().get_directories())
+
+        # Settings changes watch again right away
+        now[0] += FilesWatcher.MIN_BACKOFF_SECONDS - 1
+        assert not watcher.watch(Cache().get_directories())
+        watcher.retry()
+        assert watcher.watch(Cache().get_directories())
+        assert errors == [1]
+    finally:
+        watcher.stop()
+        watcher.retry()
+
+def test_merge_added_entries(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    for directory in ('Documents', 'Music'):
+        os.makedirs(join(root, directory))
+    open(join(root, 'Documents', 'notes.txt'), 'w').close()
+    open(join(root, 'Music', 'song.mp3'), 'w').close()
+    set_cache_settings('.albertignore2', 2, 0.5, [root], [0])
+    Cache().scan()
+    monkeypatch.setattr(CacheSnapshot, 'MAX_ADDED', 4)
+
+    os.makedirs(join(root, 'Documents', 'new_dir', 'nested_dir'))
+    open(join(root, 'Documents', 'new_dir', 'nested_dir', 'nested_file'), 'w').close()
+    for name in ('report.pdf', 'summary.txt'):
+        open(join(root, 'Documents', name), 'w').close()
+        Cache().add_path(join(root, 'Documents', name))
+    assert not Cache().flush_changes()
+    Cache().add_path(join(root, 'Documents', 'new_dir'))
+    os.remove(join(root, 'Music', 'song.mp3'))
+    Cache().remove_path(join(root, 'Music', 'song.mp3'))
+    assert Cache().flush_changes()
+    # Only one merge at a time
+    assert not Cache().flush_changes()
+
+    assert Cache().merge_changes()
+    snapshot = Cache()._snapshot
+    assert len(snapshot.added) == 0 and not snapshot.removed
+    store = snapshot.store
+    paths = [store.path(entry_id) for entry_id in range(len(store))]
+    assert join(root, 'Documents', 'new_dir', 'nested_dir', 'nested_file') in Cache()
+    assert join(root, 'Music', 'song.mp3') not in Cache()
+    assert Cache().search('summary')[0].path == join(root, 'Documents', 'summary.txt')
+    for entry_id, path in enumerate(paths):
+        assert store.find(path) == entry_id
+
+    # Same entries as a scan
+    Cache().scan()
+    store = Cache()._snapshot.store
+    assert sorted(paths) == sorted(store.path(entry_id) for entry_id in range(len(store)))
@@ -6,7 +6,13 @@ SCAN_DIRECTORY = os.path.join(ROOT_DIR, 'template_structure')
 PATHS = [SCAN_DIRECTORY]
 DEPTHS = [0]
 
+def make_template_structure():
+    # Git cannot track the nested .git directory of the template structure
+    os.makedirs(os.path.join(SCAN_DIRECTORY, 'Projects', 'my_project', '.git'), exist_ok=True)
+
 def set_cache_settings(ignore_filename, search_after_characters, search_threshold, paths, depths):
+    if SCAN_DIRECTORY in paths:
+        make_template_structure()
     Cache().set_ignore_filename(ignore_filename)
     Cache().set_search_after_characters(search_after_characters)
     Cache().set_search_threshold(search_threshold)